@@ -21,13 +21,16 @@
 # results.
 #
 
-import json
 import matplotlib.pyplot
 import matplotlib.mlab
 import pprint
 import math
 import sys
 
+sys.path.insert(0, 'neubot/dataset')
+
+import histstore
+
 def __heavy_queue(stats, maximum):
     nstats = []
     for elem in stats:
@@ -49,9 +52,9 @@ def __per_city(cities, cityname, table, feature, scalefactor, bins,
     else:
         raise ValueError('Invalid feature')
 
-    for isp in city.keys():
-        if not isp.startswith('AS30722') and not isp.startswith('AS1267') and not isp.startswith('AS12874') and not isp.startswith('AS3269'):
-            del city[isp]
+    city = dict((isp, stats) for isp, stats in city.items()
+                if isp.startswith('AS30722') or isp.startswith('AS1267')
+                or isp.startswith('AS12874') or isp.startswith('AS3269'))
 
     side = int(math.sqrt(len(city))) + 1
     index = 1
@@ -93,9 +96,7 @@ def __per_city(cities, cityname, table, feature, scalefactor, bins,
 # Uncomment/comment to decide what to print.
 #
 
-filep = open(sys.argv[1], 'rb')
-cities = json.load(filep)
-filep.close()
+cities = histstore.load(sys.argv[1])
 
 #__per_city(cities, 'Turin', 'speedtest', 'rtt', scalefactor=4, bins=200,
 #           cumulative=False, xrange=(0, 200), ext='pdf')
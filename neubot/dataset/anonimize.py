@@ -23,26 +23,59 @@ import sqlite3
 import sys
 import syslog
 
+import copyout
+
+TABLES = ('speedtest', 'bittorrent')
+
+# Zap the addresses of the tests that cannot be published
+ZAPPED = "CASE WHEN privacy_can_publish != 1 THEN '0.0.0.0' ELSE %s END"
+
+USAGE = 'Usage: anonimize.py [-o output] file'
+
 def main():
 
     ''' Anonimize Neubot database '''
 
     syslog.openlog('anonimize.py', syslog.LOG_PERROR, syslog.LOG_USER)
+    output = None
 
     try:
-        arguments = getopt.getopt(sys.argv[1:], '')[1]
+        options, arguments = getopt.getopt(sys.argv[1:], 'o:')
     except getopt.error:
-        sys.exit('Usage: anonimize.py file')
+        sys.exit(USAGE)
     if len(arguments) != 1:
-        sys.exit('Usage: anonimize.py file')
+        sys.exit(USAGE)
+
+    for name, value in options:
+        if name == '-o':
+            output = value
 
     syslog.syslog(syslog.LOG_INFO, 'Anonimize: %s' % arguments[0])
     connection = sqlite3.connect(arguments[0])
-    for table in ('speedtest', 'bittorrent'):
+
+    #
+    # With -o the anonymized rows are written once into a new
+    # database and the original one is not modified, otherwise
+    # we update in place and VACUUM, writing the database twice.
+    #
+    if output:
+        syslog.syslog(syslog.LOG_INFO, 'Output: %s' % output)
+        transforms = {}
+        for table in TABLES:
+            transforms[table] = {
+                'internal_address': ZAPPED % 'internal_address',
+                'real_address': ZAPPED % 'real_address',
+            }
+        copyout.copy_out(connection, output, transforms)
+        return
+
+    for table in TABLES:
         syslog.syslog(syslog.LOG_INFO, 'Table: %s' % table)
         connection.execute('''UPDATE %s SET internal_address='0.0.0.0',
           real_address='0.0.0.0' WHERE privacy_can_publish != 1;''' % table)
 
+    # VACUUM is not allowed within a transaction
+    connection.commit()
     connection.execute('VACUUM;')
     connection.commit()
 
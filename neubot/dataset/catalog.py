@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Catalog of the collected Neubot databases.  The catalog is a small
+ sqlite3 database that records, for each input, its size, mtime and
+ checksum, its schema version and, for each table, the number of tests
+ and the first and last timestamp.  It also remembers into which
+ destinations each input has been merged, so that merges can skip
+ the inputs that did not change.  Destinations are known by an id
+ kept in their config table rather than by path, so that removing,
+ replacing or restoring one does not make merges skip inputs.
+
+ When run as a script, lists the catalogued databases that contain
+ tests in the selected time range.
+'''
+
+import calendar
+import getopt
+import hashlib
+import os
+import sqlite3
+import sys
+import syslog
+import time
+import uuid
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dumps (path TEXT PRIMARY KEY, size INTEGER,
+  mtime REAL, checksum TEXT, version TEXT);
+CREATE TABLE IF NOT EXISTS dump_tables (path TEXT, name TEXT,
+  count INTEGER, first INTEGER, last INTEGER, PRIMARY KEY (path, name));
+CREATE TABLE IF NOT EXISTS merged (checksum TEXT, destination TEXT,
+  PRIMARY KEY (checksum, destination));
+'''
+
+TABLES = ('speedtest', 'bittorrent')
+
+def connect(path):
+    ''' Open the catalog at @path, creating it if needed '''
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.commit()
+    return connection
+
+def checksum(path):
+    ''' Return the SHA1 of the content of the file at @path '''
+    digest = hashlib.sha1()
+    filep = open(path, 'rb')
+    chunk = filep.read(262144)
+    while chunk:
+        digest.update(chunk)
+        chunk = filep.read(262144)
+    filep.close()
+    return digest.hexdigest()
+
+def fingerprint(catalog, path):
+
+    '''
+     Return the checksum of the file at @path.  The checksum stored
+     in the @catalog is reused when size and mtime did not change,
+     so that unchanged inputs are not read at all.
+    '''
+
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+
+    cursor = catalog.cursor()
+    cursor.execute('SELECT size, mtime, checksum FROM dumps WHERE path=?;',
+                   (path,))
+    row = cursor.fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+        return row[2]
+
+    digest = checksum(path)
+    if row and row[2] == digest:
+        # Touched or copied but not modified
+        catalog.execute('UPDATE dumps SET size=?, mtime=? WHERE path=?;',
+                        (stat.st_size, stat.st_mtime, path))
+        catalog.commit()
+    return digest
+
+def destination_id(catalog, connection):
+
+    '''
+     Return the id under which the merges into the destination
+     database referenced by @connection are recorded in @catalog.
+     The id is kept into the config table of the destination and
+     renewed at each run, carrying over the merges recorded under
+     the previous one.  So a destination that was removed, replaced
+     or restored from a backup, whose id is missing or stale, is
+     merged into from scratch rather than skipped.
+    '''
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT value FROM config WHERE name='catalog_id';")
+    row = cursor.fetchone()
+
+    # Destination first: if we stop in between everything is merged again
+    identifier = str(uuid.uuid4())
+    connection.execute("INSERT OR REPLACE INTO config VALUES ('catalog_id', "
+                       "?);", (identifier,))
+    connection.commit()
+
+    if row:
+        catalog.execute('UPDATE merged SET destination=? WHERE '
+                        'destination=?;', (identifier, row[0]))
+        catalog.commit()
+    return identifier
+
+def is_merged(catalog, digest, destination):
+    ''' Whether the input with @digest was merged into @destination id '''
+    cursor = catalog.cursor()
+    cursor.execute('SELECT COUNT(*) FROM merged WHERE checksum=? AND '
+                   'destination=?;', (digest, destination))
+    return next(cursor)[0] > 0
+
+def mark_merged(catalog, digest, destination):
+    ''' Remember that the input with @digest went into @destination id '''
+    catalog.execute('INSERT OR IGNORE INTO merged VALUES (?, ?);',
+                    (digest, destination))
+    catalog.commit()
+
+def schema_version(connection):
+    ''' Return the version stored into the config table '''
+    cursor = connection.cursor()
+    cursor.execute("SELECT value FROM config WHERE name='version';")
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return row[0]
+
+def __info_table(connection, table):
+    ''' Return count, first and last timestamp of @table '''
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM %s;'
+                   % table)
+    count, first, last = next(cursor)
+    return count or 0, first or 0, last or 0
+
+def record(catalog, path, digest, connection, version):
+
+    '''
+     Record into the @catalog the file at @path, with checksum @digest
+     and schema @version, reading per-table information from the
+     database referenced by @connection (which may be a decompressed
+     copy).  The @version must be read before the input is migrated,
+     e.g. with schema_version(), because @connection usually refers
+     to the migrated database.
+    '''
+
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+
+    catalog.execute('INSERT OR REPLACE INTO dumps VALUES (?, ?, ?, ?, ?);',
+                    (path, stat.st_size, stat.st_mtime, digest, version))
+    for table in TABLES:
+        count, first, last = __info_table(connection, table)
+        catalog.execute('''INSERT OR REPLACE INTO dump_tables
+          VALUES (?, ?, ?, ?, ?);''', (path, table, count, first, last))
+    catalog.commit()
+
+def overlapping(catalog, since, until):
+
+    '''
+     Return the paths of the catalogued databases with at least
+     one test in [@since, @until).
+    '''
+
+    cursor = catalog.cursor()
+    cursor.execute('''SELECT DISTINCT path FROM dump_tables WHERE count > 0
+      AND first < ? AND last >= ? ORDER BY path;''', (until, since))
+    return [row[0] for row in cursor]
+
+def __mktime(string, fmt):
+    ''' Convert string to time '''
+    # Force GMT using timegm()
+    return int(calendar.timegm(time.strptime(string, fmt)))
+
+USAGE = '''\
+Usage: catalog.py [-D name=value] catalog
+Macros: format=DATE_FMT since=DATE until=DATE'''
+
+def main():
+
+    ''' List the databases that overlap a time range '''
+
+    syslog.openlog('catalog.py', syslog.LOG_PERROR, syslog.LOG_USER)
+    since, until = 0, int(time.time())
+    fmt = '%d-%m-%Y'
+
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'D:')
+    except getopt.error:
+        sys.exit(USAGE)
+    if len(arguments) != 1:
+        sys.exit(USAGE)
+
+    for name, value in options:
+        if name == '-D':
+            name, value = value.split('=', 1)
+            if name == 'format':
+                fmt = value
+            elif name == 'since':
+                since = __mktime(value, fmt)
+            elif name == 'until':
+                until = __mktime(value, fmt)
+
+    catalog = connect(arguments[0])
+    for path in overlapping(catalog, since, until):
+        sys.stdout.write('%s\n' % path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Copy-out of Neubot databases.  Rather than updating a database in
+ place and then rebuilding it with VACUUM, which writes it twice,
+ the rows are streamed once into a fresh database through INSERT ...
+ SELECT, rewriting some columns on the fly.  The source is only read.
+'''
+
+import os
+import sqlite3
+
+import copytable
+
+def __schema(source):
+    ''' Return type, name and SQL of the objects of the @source schema '''
+    cursor = source.cursor()
+    cursor.execute('''SELECT type, name, sql FROM main.sqlite_master
+      WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%';''')
+    return cursor.fetchall()
+
+def __analyzed(source):
+    ''' Whether the @source has planner statistics (see prepare.py) '''
+    cursor = source.cursor()
+    cursor.execute('''SELECT COUNT(*) FROM main.sqlite_master
+      WHERE name = 'sqlite_stat1';''')
+    return next(cursor)[0] > 0
+
+def __create_tables(source, path, schema, added):
+    ''' Create the tables of @schema, plus the @added columns, at @path '''
+    cursor = source.cursor()
+    cursor.execute('PRAGMA main.page_size;')
+    page_size = next(cursor)[0]
+
+    output = sqlite3.connect(path)
+    output.execute('PRAGMA page_size = %d;' % page_size)
+    for kind, name, sql in schema:
+        if kind != 'table':
+            continue
+        output.execute(sql)
+        # Same as ALTER TABLE in place, so the schema is the same too
+        for column, declaration in added.get(name, ()):
+            output.execute('ALTER TABLE %s ADD COLUMN %s %s;' %
+              (copytable.sanitize(name), column, declaration))
+    if __analyzed(source):
+        # Creates an empty sqlite_stat1, filled by copy_out()
+        output.execute('ANALYZE sqlite_master;')
+    output.commit()
+    output.close()
+
+def __create_indexes(path, schema):
+    ''' Create indexes, views and triggers of @schema at @path '''
+    output = sqlite3.connect(path)
+    for kind, _, sql in schema:
+        if kind != 'table':
+            output.execute(sql)
+    output.commit()
+    output.close()
+
+def copy_out(source, path, transforms=None, added=None):
+
+    '''
+     Copy the database referenced by @source into a new database at
+     @path.  The @transforms map a table name to a dictionary that
+     maps column names to the SQL expression that computes their
+     value from the source row.  The @added columns, a dictionary
+     mapping a table name to a list of (name, declaration), are
+     appended to the output tables, and are NULL unless transformed.
+     Indexes are built after the data, planner statistics are copied
+     as they are, and the output is removed if anything goes wrong.
+    '''
+
+    transforms = transforms or {}
+    added = added or {}
+
+    if os.path.exists(path):
+        raise RuntimeError('Output already exists')
+
+    schema = __schema(source)
+    try:
+        __create_tables(source, path, schema, added)
+
+        # ATTACH is not allowed within a transaction
+        source.commit()
+        source.execute('ATTACH DATABASE ? AS output;', (path,))
+        try:
+            # The output is removed on failure, so no need for a journal
+            source.execute('PRAGMA output.journal_mode = OFF;')
+            for kind, name, _ in schema:
+                if kind != 'table':
+                    continue
+                columns = copytable.table_columns(source, name)
+                expressions = []
+                for column in copytable.table_columns(source, name,
+                                                      'output'):
+                    if column in transforms.get(name, {}):
+                        expressions.append(transforms[name][column])
+                    elif column in columns:
+                        expressions.append(column)
+                    else:
+                        expressions.append('NULL')
+                source.execute('''INSERT INTO output.%s SELECT %s
+                  FROM main.%s;''' % (copytable.sanitize(name),
+                  ', '.join(expressions), copytable.sanitize(name)))
+            if __analyzed(source):
+                source.execute('''INSERT INTO output.sqlite_stat1
+                  SELECT * FROM main.sqlite_stat1;''')
+            source.commit()
+        finally:
+            source.execute('DETACH DATABASE output;')
+
+        __create_indexes(path, schema)
+
+    except:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
@@ -0,0 +1,278 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Bulk copy of tables between Neubot databases.  Used by merge.py
+ and by tool.py -M when the bulk mode is selected.
+
+ Rows are selected either by a timestamp watermark (@beginning) or,
+ when @beginning is None, all of them are offered to the destination
+ and the unique test key created by ensure_key() filters duplicates
+ via INSERT OR IGNORE, so that sources can be merged in any order.
+'''
+
+import os
+import re
+import syslog
+import time
+
+import mergestats
+
+# Number of rows per executemany() in the batched path
+BATCH = 4096
+
+def sanitize(table):
+
+    '''
+     Make sure that the table name contains only lowercase
+     letters or underscores and return it.
+    '''
+
+    stripped = re.sub(r'[^a-z_]', '', table)
+    if stripped != table:
+        raise RuntimeError('Invalid table name')
+
+    return table
+
+def table_columns(connection, table, schema='main'):
+    ''' Return the list of columns of @table in @schema '''
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA %s.table_info(%s);' % (sanitize(schema),
+                                                  sanitize(table)))
+    return [row[1] for row in cursor]
+
+def database_path(connection):
+
+    '''
+     Return the path of the file backing the main database of
+     @connection, or the empty string for in-memory databases.
+     SQLite always reports the full path of real files, while
+     deserialized databases have a dummy relative name.
+    '''
+
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA database_list;')
+    for row in cursor:
+        if row[1] == 'main' and row[2] and os.path.isabs(row[2]):
+            return row[2]
+    return ''
+
+def ensure_key(connection, table):
+
+    '''
+     Make sure that @table has a unique index on the natural test
+     key, i.e. (uuid, timestamp), where a missing uuid counts as the
+     empty one, since SQLite never finds NULLs equal.  Rows that
+     already duplicate the key are removed keeping the oldest copy,
+     because otherwise the index cannot be created.  An index made
+     on the plain columns by older versions is replaced.
+    '''
+
+    cursor = connection.cursor()
+    cursor.execute('''SELECT sql FROM sqlite_master WHERE type='index'
+      AND name=?;''', ('%s_test_key' % sanitize(table),))
+    row = cursor.fetchone()
+    if row and 'COALESCE' in row[0]:
+        return
+    if row:
+        connection.execute('DROP INDEX %s_test_key;' % sanitize(table))
+
+    cursor.execute('''DELETE FROM %s WHERE id NOT IN (SELECT MIN(id)
+      FROM %s GROUP BY COALESCE(uuid, ''), timestamp);'''
+      % (sanitize(table), sanitize(table)))
+    if cursor.rowcount > 0:
+        syslog.syslog(syslog.LOG_WARNING, 'Removed %d duplicate tests from %s'
+                      % (cursor.rowcount, table))
+
+    connection.execute('''CREATE UNIQUE INDEX IF NOT EXISTS %s_test_key
+      ON %s (COALESCE(uuid, ''), timestamp);''' % (sanitize(table),
+                                                  sanitize(table)))
+    connection.commit()
+
+def __where(beginning):
+    ''' Return the WHERE clause and the params for @beginning '''
+    if beginning is None:
+        return '', ()
+    return ' WHERE timestamp > ?', (beginning,)
+
+def __remap(table, source_columns, destination_columns):
+
+    '''
+     Map the @source_columns onto the @destination_columns by
+     name.  The row ID is never copied (otherwise we overwrite
+     our data) and columns unknown to the destination are dropped.
+    '''
+
+    columns, dropped = [], []
+    for name in source_columns:
+        if name == 'id':
+            continue
+        if name not in destination_columns:
+            dropped.append(name)
+            continue
+        columns.append(name)
+
+    if dropped:
+        syslog.syslog(syslog.LOG_WARNING, 'Dropping %s columns: %s' %
+                      (table, ', '.join(dropped)))
+
+    return columns
+
+def copy_attached(source, destination, table, beginning, ignore=False,
+                  stats=None):
+
+    '''
+     Copy the content of @table of the @source database that has
+     timestamp greater than @beginning into @destination using a
+     single INSERT ... SELECT.  The @source is either a path or the
+     serialized bytes of an in-memory database.  When @ignore is True
+     rows that violate the test key are skipped.  Returns the number
+     of inserted rows.  When @stats is not None, the selected rows
+     are counted beforehand, since INSERT ... SELECT does not tell
+     how many rows it has read.
+    '''
+
+    # ATTACH is not allowed within a transaction
+    destination.commit()
+
+    if isinstance(source, bytes):
+        destination.execute("ATTACH DATABASE ':memory:' AS source;")
+        destination.deserialize(source, name='source')
+    else:
+        destination.execute('ATTACH DATABASE ? AS source;', (source,))
+    try:
+        columns = __remap(table, table_columns(destination, table, 'source'),
+                          table_columns(destination, table))
+        names = ', '.join(columns)
+        where, params = __where(beginning)
+        cursor = destination.cursor()
+
+        if stats is not None:
+            ticks = time.time()
+            cursor.execute('SELECT COUNT(*) FROM source.%s%s;' %
+                           (sanitize(table), where), params)
+            selected = next(cursor)[0]
+            mergestats.add(stats, 'scan', time.time() - ticks,
+                           rows_read=selected)
+
+        ticks = time.time()
+        cursor.execute('''INSERT %s INTO main.%s (%s) SELECT %s
+          FROM source.%s%s;''' % ('OR IGNORE' if ignore else '',
+          sanitize(table), names, names, sanitize(table), where), params)
+        count = cursor.rowcount
+        destination.commit()
+
+        if stats is not None:
+            mergestats.add(stats, 'insert', time.time() - ticks,
+                           rows_inserted=count,
+                           rows_skipped=selected - count)
+    finally:
+        destination.execute('DETACH DATABASE source;')
+
+    return count
+
+def insert_query(destination, table, source_columns, ignore=False):
+
+    '''
+     Return the query that inserts rows having @source_columns into
+     @table of @destination, and the indexes of the row fields that
+     must be bound to it, remapping the columns by name.
+    '''
+
+    columns = __remap(table, source_columns,
+                      table_columns(destination, table))
+    indexes = [source_columns.index(name) for name in columns]
+
+    query = 'INSERT %s INTO %s (%s) VALUES (%s);' % ('OR IGNORE' if ignore
+      else '', sanitize(table), ', '.join(columns),
+      ', '.join(['?'] * len(columns)))
+
+    return query, indexes
+
+def copy_batched(source, destination, table, beginning, batch=BATCH,
+                 ignore=False, stats=None):
+
+    '''
+     Copy from @source to @destination the content of @table that
+     has timestamp greater than @beginning, remapping the columns by
+     name and inserting @batch rows at a time.  When @ignore is True
+     rows that violate the test key are skipped.  Returns the number
+     of inserted rows.  Reading and writing are accounted separately
+     into @stats.
+    '''
+
+    ticks = time.time()
+    where, params = __where(beginning)
+    cursor = source.cursor()
+    cursor.execute('SELECT * FROM %s%s;' % (sanitize(table), where), params)
+
+    query, indexes = insert_query(destination, table, [description[0]
+                                  for description in cursor.description],
+                                  ignore)
+
+    changes = destination.total_changes
+    scanning, inserting, selected = time.time() - ticks, 0.0, 0
+    while True:
+        ticks = time.time()
+        rows = cursor.fetchmany(batch)
+        scanning += time.time() - ticks
+        if not rows:
+            break
+        selected += len(rows)
+        ticks = time.time()
+        destination.executemany(query, [tuple([row[index] for index
+                                               in indexes]) for row in rows])
+        inserting += time.time() - ticks
+
+    ticks = time.time()
+    destination.commit()
+    inserting += time.time() - ticks
+
+    count = destination.total_changes - changes
+    mergestats.add(stats, 'scan', scanning, rows_read=selected)
+    mergestats.add(stats, 'insert', inserting, rows_inserted=count,
+                   rows_skipped=selected - count)
+    return count
+
+def copy_table(source, destination, table, beginning, batch=BATCH,
+               ignore=False, stats=None):
+
+    '''
+     Copy from @source to @destination the content of @table that
+     has timestamp greater than @beginning.  The copy happens inside
+     SQLite when the source is backed by a file or can be serialized
+     (in-memory databases, Python >= 3.11); otherwise we fall back to
+     batched executemany().
+    '''
+
+    path = database_path(source)
+    if path:
+        return copy_attached(path, destination, table, beginning, ignore,
+                             stats)
+    if hasattr(source, 'serialize'):
+        ticks = time.time()
+        data = source.serialize()
+        mergestats.add(stats, 'scan', time.time() - ticks)
+        return copy_attached(data, destination, table, beginning, ignore,
+                             stats)
+    return copy_batched(source, destination, table, beginning, batch,
+                        ignore, stats)
+
+def rate(count, elapsed):
+    ''' Return the rows per second rate '''
+    if elapsed <= 0:
+        return 0.0
+    return count / elapsed
@@ -0,0 +1,253 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Content-addressed cache of decompressed Neubot databases.  Each
+ compressed database is decompressed once into the cache directory,
+ under the checksum of the compressed file.  Callers migrate the
+ cached copy in place, so that the next run finds it already migrated.
+ Non-compressed databases can be copied into the cache as well,
+ when they must be migrated but the original must not be touched.
+ The least recently used copies are evicted when the cache grows
+ beyond its size cap, except the ones leased to a process that is
+ still using them, e.g. the writer of a pipelined merge.
+'''
+
+import bz2
+import os
+import shutil
+import sqlite3
+import syslog
+import tempfile
+import time
+
+import catalog
+import mergestats
+
+# Default size cap, in MiB
+CAP = 4096
+
+# Process that uses the copies returned by get(), if not the caller
+CONSUMER = None
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, size INTEGER,
+  mtime REAL, checksum TEXT);
+CREATE TABLE IF NOT EXISTS entries (checksum TEXT PRIMARY KEY, atime REAL);
+CREATE TABLE IF NOT EXISTS versions (checksum TEXT PRIMARY KEY,
+  version TEXT);
+CREATE TABLE IF NOT EXISTS leases (checksum TEXT, pid INTEGER);
+'''
+
+def __index(directory):
+    ''' Open the index of the cache in @directory '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Many processes may share the cache
+    connection = sqlite3.connect(os.path.join(directory, 'index.sqlite3'),
+                                 timeout=60)
+    connection.executescript(SCHEMA)
+    connection.commit()
+    return connection
+
+def __fingerprint(index, path):
+
+    '''
+     Return the checksum of the file at @path, reusing
+     the one in @index when size and mtime did not change.
+    '''
+
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+
+    cursor = index.cursor()
+    cursor.execute('SELECT size, mtime, checksum FROM sources WHERE path=?;',
+                   (path,))
+    row = cursor.fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+        return row[2]
+
+    digest = catalog.checksum(path)
+    index.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?);',
+                  (path, stat.st_size, stat.st_mtime, digest))
+    index.commit()
+    return digest
+
+def __alive(pid):
+    ''' Whether the process @pid is running '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def __leased(index):
+    ''' Return the checksums of the entries leased to live processes '''
+    cursor = index.cursor()
+    cursor.execute('SELECT DISTINCT pid FROM leases;')
+    for pid in [row[0] for row in cursor]:
+        if not __alive(pid):
+            index.execute('DELETE FROM leases WHERE pid=?;', (pid,))
+    cursor.execute('SELECT DISTINCT checksum FROM leases;')
+    return set(row[0] for row in cursor)
+
+def __evict(directory, index, cap, keep):
+
+    '''
+     Remove the least recently used entries until the total size
+     of the cache in @directory is below @cap bytes.  The entry
+     whose checksum is @keep and the leased ones are never removed.
+     Must run in the same write transaction that added @keep.
+    '''
+
+    leased = __leased(index)
+    entries, total = [], 0
+    cursor = index.cursor()
+    cursor.execute('SELECT checksum FROM entries ORDER BY atime;')
+    for row in cursor:
+        path = os.path.join(directory, '%s.sqlite3' % row[0])
+        if not os.path.exists(path):
+            entries.append((row[0], None, 0))
+            continue
+        size = os.path.getsize(path)
+        entries.append((row[0], path, size))
+        total += size
+
+    for digest, path, size in entries:
+        if path and total <= cap:
+            break
+        if digest == keep or digest in leased:
+            continue
+        if path:
+            syslog.syslog(syslog.LOG_INFO, 'Evict: %s' % path)
+            os.unlink(path)
+            total -= size
+        index.execute('DELETE FROM entries WHERE checksum=?;', (digest,))
+        index.execute('DELETE FROM versions WHERE checksum=?;', (digest,))
+
+    index.commit()
+
+def contains(directory, path):
+    ''' Whether @path is a copy in the cache @directory '''
+    return (os.path.dirname(os.path.realpath(path)) ==
+            os.path.realpath(directory))
+
+def __remember_version(index, digest, cached):
+    ''' Remember the version of the just created copy @cached '''
+    connection = sqlite3.connect(cached)
+    version = catalog.schema_version(connection)
+    connection.close()
+    index.execute('INSERT OR REPLACE INTO versions VALUES (?, ?);',
+                  (digest, version))
+    index.commit()
+
+def get(directory, path, cap=CAP * 1024 * 1024, copy=False, stats=None,
+        origin=None):
+
+    '''
+     Return the path of the decompressed copy of the compressed
+     database at @path in the cache @directory, decompressing it
+     if it is not in the cache.  Non-compressed databases are not
+     cached, and @path is returned as is, unless @copy is True.
+     The size of the cache is capped at @cap bytes.  Cache misses
+     are accounted as decompression into @stats.  Since callers
+     migrate the copy, the version it had when it was created is
+     stored into the @origin dictionary, if any, as 'version'.
+     When CONSUMER is set, the copy is leased to that process,
+     which must release() it once done, and until then it is not
+     evicted by anybody.
+    '''
+
+    if not path.endswith('.bz2') and not copy:
+        return path
+
+    index = __index(directory)
+    digest = __fingerprint(index, path)
+    cached = os.path.join(directory, '%s.sqlite3' % digest)
+
+    # Lease before looking, so the copy cannot go away in between
+    if CONSUMER:
+        index.execute('BEGIN IMMEDIATE;')
+        index.execute('INSERT INTO leases VALUES (?, ?);',
+                      (digest, CONSUMER))
+        index.commit()
+
+    if os.path.exists(cached):
+        syslog.syslog(syslog.LOG_INFO, 'Cache hit: %s -> %s' % (path, cached))
+
+    elif not path.endswith('.bz2'):
+        syslog.syslog(syslog.LOG_INFO, 'Cache copy: %s -> %s' % (path, cached))
+        outputfp, npath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        os.close(outputfp)
+        shutil.copyfile(path, npath)
+        os.rename(npath, cached)
+        __remember_version(index, digest, cached)
+
+    else:
+        syslog.syslog(syslog.LOG_INFO, 'Cache miss: %s -> %s' % (path, cached))
+        ticks, total = time.time(), 0
+        inputfp = bz2.BZ2File(path)
+        outputfp, npath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        outputfp = os.fdopen(outputfp, 'wb')
+        chunk = inputfp.read(262144)
+        while chunk:
+            total += len(chunk)
+            outputfp.write(chunk)
+            chunk = inputfp.read(262144)
+        outputfp.close()
+        inputfp.close()
+        mergestats.add(stats, 'decompress', time.time() - ticks, bytes=total)
+        # Atomic, in case another process is decompressing it too
+        os.rename(npath, cached)
+        __remember_version(index, digest, cached)
+
+    # Other processes may be adding and evicting entries as well
+    index.execute('BEGIN IMMEDIATE;')
+    index.execute('INSERT OR REPLACE INTO entries VALUES (?, ?);',
+                  (digest, time.time()))
+    __evict(directory, index, cap, digest)
+
+    if origin is not None:
+        cursor = index.cursor()
+        cursor.execute('SELECT version FROM versions WHERE checksum=?;',
+                       (digest,))
+        row = cursor.fetchone()
+        if row:
+            origin['version'] = row[0]
+
+    index.close()
+    return cached
+
+def release(path):
+
+    '''
+     Release the lease of the copy at @path that get() took for this
+     process (see CONSUMER), so that it may be evicted.  Paths that
+     are not in a cache are ignored.
+    '''
+
+    directory = os.path.dirname(os.path.realpath(path))
+    if not os.path.exists(os.path.join(directory, 'index.sqlite3')):
+        return
+    digest = os.path.splitext(os.path.basename(path))[0]
+    index = __index(directory)
+    index.execute('''DELETE FROM leases WHERE rowid IN (SELECT rowid
+      FROM leases WHERE checksum=? AND pid=? LIMIT 1);''',
+                  (digest, os.getpid()))
+    index.commit()
+    index.close()
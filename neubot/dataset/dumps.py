@@ -0,0 +1,138 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Open (possibly compressed) Neubot databases.  Compressed databases
+ that are smaller than the memory limit once decompressed are loaded
+ into an in-memory sqlite3 database using the deserialize API, and
+ the others are decompressed into a temporary file that is removed
+ at exit.
+'''
+
+import atexit
+import bz2
+import os
+import shutil
+import sqlite3
+import syslog
+import tempfile
+import time
+
+import mergestats
+
+# Memory limit is expressed in MiB on the command line
+MEGABYTE = 1024 * 1024
+
+# Temporary files created by this process
+TEMPORARY = set()
+
+def __cleanup(path):
+    ''' Cleanups temporary files '''
+    if os.path.exists(path):
+        syslog.syslog(syslog.LOG_INFO, 'Cleanup: %s' % path)
+        os.unlink(path)
+
+def decompress(path, memory_limit=0, directory='.', stats=None):
+
+    '''
+     Decompress the database at @path.  Returns the decompressed bytes
+     if they do not exceed @memory_limit bytes and the running Python
+     can deserialize them, otherwise the path of a temporary file in
+     @directory that will be removed at exit.  So: (data, None) or
+     (None, path).  Time and size are accounted into @stats.
+    '''
+
+    ticks = time.time()
+
+    if not hasattr(sqlite3.Connection, 'deserialize'):
+        memory_limit = 0
+
+    inputfp = bz2.BZ2File(path)
+    outputfp, npath = None, None
+    chunks, total = [], 0
+
+    chunk = inputfp.read(262144)
+    while chunk:
+        total += len(chunk)
+
+        # Spill to disk when over the limit
+        if outputfp is None:
+            if total <= memory_limit:
+                chunks.append(chunk)
+                chunk = inputfp.read(262144)
+                continue
+            outputfp, npath = tempfile.mkstemp(suffix='.sqlite3',
+                                               dir=directory)
+            syslog.syslog(syslog.LOG_INFO, 'Bunzip2: %s -> %s' % (path, npath))
+            outputfp = os.fdopen(outputfp, 'wb')
+            atexit.register(__cleanup, npath)
+            TEMPORARY.add(os.path.realpath(npath))
+            for pending in chunks:
+                outputfp.write(pending)
+            chunks = []
+
+        outputfp.write(chunk)
+        chunk = inputfp.read(262144)
+
+    inputfp.close()
+    mergestats.add(stats, 'decompress', time.time() - ticks, bytes=total)
+
+    if outputfp is None and not memory_limit:
+        outputfp, npath = tempfile.mkstemp(suffix='.sqlite3', dir=directory)
+        atexit.register(__cleanup, npath)
+        TEMPORARY.add(os.path.realpath(npath))
+        outputfp = os.fdopen(outputfp, 'wb')
+
+    if outputfp is None:
+        syslog.syslog(syslog.LOG_INFO, 'Bunzip2: %s -> memory' % path)
+        return b''.join(chunks), None
+
+    outputfp.close()
+    return None, npath
+
+def copy(path, directory='.'):
+    ''' Copy @path into a temporary file in @directory, return its path '''
+    outputfp, npath = tempfile.mkstemp(suffix='.sqlite3', dir=directory)
+    os.close(outputfp)
+    atexit.register(__cleanup, npath)
+    TEMPORARY.add(os.path.realpath(npath))
+    syslog.syslog(syslog.LOG_INFO, 'Copy: %s -> %s' % (path, npath))
+    shutil.copyfile(path, npath)
+    return npath
+
+def is_temporary(path):
+    ''' Whether @path is a temporary file created by decompress() '''
+    return os.path.realpath(path) in TEMPORARY
+
+def connect(path, memory_limit=0, stats=None):
+
+    '''
+     Return a connection to the database at @path, decompressing it
+     if needed, either into memory or into a temporary file depending
+     on @memory_limit (in bytes).  Decompression is accounted into
+     @stats.
+    '''
+
+    if not path.endswith('.bz2'):
+        return sqlite3.connect(path)
+
+    data, npath = decompress(path, memory_limit, stats=stats)
+    if data is None:
+        return sqlite3.connect(npath)
+
+    connection = sqlite3.connect(':memory:')
+    connection.deserialize(data)
+    return connection
@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Distribution curves computed with NumPy.  Values are scaled and
+ bounded as whole arrays, and the curves are computed before they
+ reach matplotlib, which only draws them: the exact empirical CDF
+ comes from sorting the values, and histograms from binning them.
+'''
+
+import numpy
+
+def prepare(values, scalingfactor=None, lowerbound=None, upperbound=None,
+            exclude=False):
+
+    '''
+     Return @values as an array of floats, without missing values,
+     scaled by @scalingfactor.  Values out of [@lowerbound,
+     @upperbound] are moved to the bounds or, if @exclude, removed.
+    '''
+
+    array = numpy.array(values, dtype=numpy.float64)
+    array = array[~numpy.isnan(array)]
+    if scalingfactor is not None:
+        array *= scalingfactor
+    if exclude:
+        if lowerbound is not None:
+            array = array[array >= lowerbound]
+        if upperbound is not None:
+            array = array[array <= upperbound]
+    elif lowerbound is not None or upperbound is not None:
+        array = numpy.clip(array, lowerbound, upperbound)
+    return array
+
+def cdf(array, normed=True):
+
+    '''
+     Return the exact empirical CDF of @array, i.e. its distinct
+     values and the fraction (or, unless @normed, the number) of
+     values that are less than or equal to each of them.
+    '''
+
+    xdata, counts = numpy.unique(array, return_counts=True)
+    ydata = numpy.cumsum(counts, dtype=numpy.float64)
+    if normed and len(array):
+        ydata /= len(array)
+    return xdata, ydata
+
+def histogram(array, bins=10, cumulative=False, normed=False):
+
+    '''
+     Return the centers of @bins equal bins spanning @array and the
+     number of values in each bin.  If @cumulative the counts are
+     accumulated, and if @normed they are normalized, so that the
+     cumulative histogram ends at one and the plain one is a density.
+    '''
+
+    counts, edges = numpy.histogram(array, bins=bins)
+    xdata = (edges[:-1] + edges[1:]) / 2
+    ydata = counts.astype(numpy.float64)
+    if cumulative:
+        ydata = numpy.cumsum(ydata)
+        if normed and len(array):
+            ydata /= len(array)
+    elif normed and len(array):
+        ydata /= len(array) * numpy.diff(edges)
+    return xdata, ydata
+
+def bound_cdf(xdata, ydata, lowerbound=None, upperbound=None,
+              exclude=False):
+
+    '''
+     Apply the bounds to the normalized CDF (@xdata, @ydata), like
+     prepare() does to values.  When points are excluded the CDF is
+     rescaled, so that it is the CDF of the values within bounds.
+    '''
+
+    xdata = numpy.asarray(xdata, dtype=numpy.float64)
+    ydata = numpy.asarray(ydata, dtype=numpy.float64)
+    if not exclude:
+        if lowerbound is not None or upperbound is not None:
+            xdata = numpy.clip(xdata, lowerbound, upperbound)
+        return xdata, ydata
+
+    inside = numpy.ones(len(xdata), dtype=bool)
+    base = 0.0
+    if lowerbound is not None:
+        inside &= xdata >= lowerbound
+        below = ydata[xdata < lowerbound]
+        if len(below):
+            base = below[-1]
+    if upperbound is not None:
+        inside &= xdata <= upperbound
+    xdata, ydata = xdata[inside], ydata[inside]
+    if len(ydata) and ydata[-1] > base:
+        ydata = (ydata - base) / (ydata[-1] - base)
+    return xdata, ydata
@@ -0,0 +1,379 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Geolocation of the addresses of Neubot tests, shared by the tools
+ that need it.  Clients run many tests from the same address, so the
+ results are memoized, either in a bounded LRU memo for lookups made
+ row by row, or in bulk, resolving each distinct address of a table
+ once.  Moreover, results can be kept across runs in a persistent
+ cache, which is invalidated when the GeoIP databases change.
+
+ Records are reduced to the country_code and city fields, the
+ only ones we use, so that they can be cached.
+
+ There are two backends: the GeoIP library, which is queried one
+ address at a time, and the range tables of geotable.py, which are
+ queried a column at a time.  The tables are used when their CSVs
+ are in the directory of the databases, and otherwise GeoIP is.
+ Either way, batches can be spread over a pool of processes, each
+ with its own handles.
+'''
+
+import collections
+import multiprocessing
+import os
+import sqlite3
+import syslog
+
+import copytable
+
+DIRECTORY = '/usr/local/share/GeoIP'
+CITY = 'GeoLiteCity.dat'
+ASNUM = 'GeoIPASNum.dat'
+
+# Default number of addresses in the memo
+MEMO = 65536
+
+# Default persistent cache
+CACHE = 'geocache.sqlite3'
+
+# Commit the persistent cache every so many new addresses
+BATCH = 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS locations (tag TEXT, utf8 INTEGER, address TEXT,
+  known INTEGER, asname, country_code, city,
+  PRIMARY KEY (tag, utf8, address));
+'''
+
+class FakeGeoIP(object):
+    ''' Fake geoip provider '''
+
+    def record_by_addr(self, address):
+        ''' Fake record_by_addr method '''
+
+    def org_by_addr(self, address):
+        ''' Fake org_by_addr method '''
+
+def open_database(path, utf8=False, fallback=False):
+
+    '''
+     Open the GeoIP database at @path, asking for UTF-8 strings if
+     @utf8 is True.  If @fallback is True and GeoIP is not available,
+     return a fake database that knows no address.
+    '''
+
+    try:
+        import GeoIP
+        handle = GeoIP.open(path, GeoIP.GEOIP_STANDARD)
+        if utf8:
+            handle.set_charset(GeoIP.GEOIP_CHARSET_UTF8)
+        return handle
+    except Exception:
+        if not fallback:
+            raise
+        return FakeGeoIP()
+
+def open_backend(directory, utf8=False, fallback=False):
+
+    '''
+     Return the city and ASN databases in @directory, preferring the
+     range tables, if they are there and NumPy is available, to GeoIP.
+     The @utf8 and @fallback parameters are as in open_database().
+    '''
+
+    try:
+        import geotable
+        if geotable.available(directory):
+            return (geotable.CityTable(directory, utf8),
+                    geotable.ASNumTable(directory, utf8))
+    except ImportError:
+        pass
+    return (open_database('%s/%s' % (directory, CITY), utf8, fallback),
+            open_database('%s/%s' % (directory, ASNUM), utf8, fallback))
+
+def identity(paths):
+    ''' Return a tag that changes when any file at @paths changes '''
+    vector = []
+    for path in paths:
+        stat = os.stat(path)
+        vector.append('%s:%d:%r' % (os.path.realpath(path), stat.st_size,
+                                    stat.st_mtime))
+    return ' '.join(vector)
+
+# Geolocator of a worker process
+WORKER = None
+
+def worker_init(directory, utf8, fallback):
+    ''' Open the databases of a worker process '''
+    global WORKER
+    WORKER = Geolocator(directory, utf8, fallback)
+
+def worker_locate(addresses):
+    ''' Geolocate @addresses in a worker process '''
+    return WORKER.locate(addresses)
+
+class Geolocator(object):
+
+    '''
+     Geolocates addresses using the GeoIP city and ASN databases
+     in @directory, and memoizes up to @size addresses.  If @cache
+     is not None, it is the path of the persistent cache.  Batches
+     are spread over @workers processes, if more than one.
+    '''
+
+    def __init__(self, directory=DIRECTORY, utf8=False, fallback=False,
+                 size=MEMO, cache=None, workers=0):
+        self.directory = directory
+        self.fallback = fallback
+        self.workers = workers
+        self.pool = None
+        self.utf8 = int(utf8)
+        self.city, self.asnum = open_backend(directory, utf8, fallback)
+        self.paths = (getattr(self.city, 'paths', ('%s/%s' % (directory,
+                      CITY),)) + getattr(self.asnum, 'paths', ('%s/%s' %
+                      (directory, ASNUM),)))
+        self.memo = collections.OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.cached = 0
+        self.misses = 0
+        self.cache = None
+        self.tag = None
+        self.pending = 0
+        if cache:
+            self.open_cache(cache)
+
+    def open_cache(self, path):
+
+        '''
+         Read from and fill the persistent cache at @path, after
+         removing the entries of other versions of the GeoIP
+         databases.  Nothing is cached when GeoIP is not available.
+        '''
+
+        if (isinstance(self.city, FakeGeoIP) or
+            isinstance(self.asnum, FakeGeoIP)):
+            return
+
+        self.tag = identity(self.paths)
+        # Many processes may share the cache
+        self.cache = sqlite3.connect(path, timeout=60)
+        self.cache.executescript(SCHEMA)
+        self.cache.execute('DELETE FROM locations WHERE tag != ?;',
+                           (self.tag,))
+        self.cache.commit()
+
+    def close(self):
+        ''' Save and close the persistent cache, stop the workers '''
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.cache:
+            self.cache.commit()
+            self.cache.close()
+            self.cache = None
+
+    def __load(self, address):
+        ''' Return the location of @address in the cache, or None '''
+        if not self.cache:
+            return None
+        cursor = self.cache.cursor()
+        cursor.execute('''SELECT known, asname, country_code, city
+          FROM locations WHERE tag=? AND utf8=? AND address=?;''',
+          (self.tag, self.utf8, address))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        if not row[0]:
+            return row[1], None
+        return row[1], {'country_code': row[2], 'city': row[3]}
+
+    def __store(self, address, location):
+        ''' Save the @location of @address into the cache '''
+        if not self.cache:
+            return
+        org, record = location
+        record = record or {}
+        self.cache.execute('''INSERT OR REPLACE INTO locations
+          VALUES (?, ?, ?, ?, ?, ?, ?);''', (self.tag, self.utf8, address,
+          int(bool(record)), org, record.get('country_code'),
+          record.get('city')))
+        self.pending += 1
+        if self.pending >= BATCH:
+            self.cache.commit()
+            self.pending = 0
+
+    def __record(self, address):
+        ''' Query the backend for the city record of @address '''
+        record = self.city.record_by_addr(address)
+        if record:
+            record = {'country_code': record['country_code'],
+                      'city': record['city']}
+        return record
+
+    def __locate(self, address):
+        ''' Query the backend for the location of @address '''
+        return self.asnum.org_by_addr(address), self.__record(address)
+
+    def __query(self, addresses):
+        ''' Query the backend for the locations of @addresses '''
+        if hasattr(self.asnum, 'orgs'):
+            orgs = self.asnum.orgs(addresses)
+        else:
+            orgs = [self.asnum.org_by_addr(address) for address in addresses]
+        if hasattr(self.city, 'records'):
+            return list(zip(orgs, self.city.records(addresses)))
+        return [(org, self.__record(address))
+                for org, address in zip(orgs, addresses)]
+
+    def locate(self, addresses):
+
+        '''
+         Query the backend for the locations of @addresses, bypassing
+         memo and cache.  With workers, the addresses are split into
+         chunks that are geolocated in parallel, and the results are
+         returned in the same order as the serial query would.
+        '''
+
+        if self.workers <= 1 or not addresses:
+            return self.__query(addresses)
+
+        if not self.pool:
+            self.pool = multiprocessing.Pool(self.workers, worker_init,
+              (self.directory, bool(self.utf8), self.fallback))
+
+        # A few chunks per worker to balance the load
+        size = -(-len(addresses) // (self.workers * 4))
+        chunks = [addresses[index:index + size]
+                  for index in range(0, len(addresses), size)]
+        locations = []
+        for chunk in self.pool.map(worker_locate, chunks):
+            locations.extend(chunk)
+        return locations
+
+    def __remember(self, address, location):
+        ''' Add the @location of @address to the memo '''
+        self.memo[address] = location
+        if len(self.memo) > self.size:
+            self.memo.popitem(last=False)
+
+    def lookup(self, address):
+        ''' Return the (org, record) pair of @address '''
+        if address in self.memo:
+            self.memo.move_to_end(address)
+            self.hits += 1
+            return self.memo[address]
+        location = self.__load(address)
+        if location is not None:
+            self.cached += 1
+        else:
+            self.misses += 1
+            location = self.__locate(address)
+            self.__store(address, location)
+        self.__remember(address, location)
+        return location
+
+    def lookup_many(self, addresses):
+
+        '''
+         Return the (org, record) pairs of the @addresses, in order.
+         The addresses that are neither memoized nor cached are sent
+         to the backend in a single batch (see locate()).
+        '''
+
+        locations = {}
+        missing = []
+        for address in addresses:
+            if address in locations or address in self.memo:
+                if address in self.memo:
+                    self.memo.move_to_end(address)
+                    locations[address] = self.memo[address]
+                self.hits += 1
+                continue
+            locations[address] = self.__load(address)
+            if locations[address] is not None:
+                self.cached += 1
+            else:
+                missing.append(address)
+
+        self.misses += len(missing)
+        for address, location in zip(missing, self.locate(missing)):
+            self.__store(address, location)
+            locations[address] = location
+        for address in addresses:
+            if address not in self.memo:
+                self.__remember(address, locations[address])
+
+        return [locations[address] for address in addresses]
+
+    def org(self, address):
+        ''' Return the provider of @address '''
+        return self.lookup(address)[0]
+
+    def record(self, address):
+        ''' Return the city record of @address '''
+        return self.lookup(address)[1]
+
+    def facet(self, address, facet):
+
+        '''
+         Given the @address attempt geolocation and then return
+         the selected geolocation @facet (if possible).
+        '''
+
+        if facet == 'provider':
+            return self.org(address)
+        elif facet in ('city', 'country_code'):
+            data = self.record(address)
+            if not data:
+                return None
+            return data[facet]
+        else:
+            raise RuntimeError('Invalid facet: %s' % facet)
+
+    def resolve(self, connection, table, where=''):
+
+        '''
+         Geolocate once each distinct real_address of the tests
+         in @table (filtered by the optional @where clause) of the
+         database referenced by @connection.  Returns a dictionary
+         that maps each address to its (org, record) pair.
+        '''
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT DISTINCT real_address FROM %s%s;' %
+                       (copytable.sanitize(table), ' WHERE %s' % where
+                        if where else ''))
+        addresses = [row[0] for row in cursor]
+        # Other tables likely share addresses, so use the memo
+        return dict(zip(addresses, self.lookup_many(addresses)))
+
+    def hit_rate(self):
+        ''' Return the fraction of lookups served by the memo '''
+        total = self.hits + self.cached + self.misses
+        if not total:
+            return 0.0
+        return self.hits / float(total)
+
+    def report(self):
+        ''' Log the effectiveness of the memo and of the cache '''
+        syslog.syslog(syslog.LOG_INFO, 'Geolocation: %d lookups, %.1f%% '
+                      'memo hit rate, %d from cache, %d backend queries' %
+                      (self.hits + self.cached + self.misses,
+                      self.hit_rate() * 100, self.cached, self.misses))
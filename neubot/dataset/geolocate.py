@@ -16,32 +16,79 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
-''' Geolocate Neubot database '''
+'''
+ Geolocate Neubot database.  Geolocation is incremental: the columns
+ are added only if they are missing and only the rows that are not
+ geolocated yet are updated, so that geolocating a database that
+ grows daily costs as much as the new rows.
+'''
 
-import GeoIP
 import getopt
 import sqlite3
 import sys
 import syslog
 
-def __geoip_open(path):
-    ''' Open geoip database '''
-    handle = GeoIP.open('/usr/local/share/GeoIP/%s' % path,
-                        GeoIP.GEOIP_STANDARD)
-    handle.set_charset(GeoIP.GEOIP_CHARSET_UTF8)
-    return handle
-
-def __geoip_query_org(handle, address):
-    ''' Query and return address '''
-    return handle.org_by_addr(address)
-
-def __geoip_query_location(handle, address):
-    ''' Query and return location '''
-    data = handle.record_by_addr(address)
-    if data:
-        return data['country_code'], data['city']
-    else:
-        return None, None
+import copytable
+import geoloc
+
+COLUMNS = ('asname', 'country_code', 'city')
+
+# The rows that are not geolocated yet
+PENDING = 'asname IS NULL AND country_code IS NULL AND city IS NULL'
+
+# Number of rows updated (and committed) at a time
+BATCH = 8192
+
+def __add_columns(connection, table):
+    ''' Add to @table the geolocation columns it is missing '''
+    columns = copytable.table_columns(connection, table)
+    for column in COLUMNS:
+        if column not in columns:
+            connection.execute('ALTER TABLE %s ADD COLUMN %s TEXT;' %
+                               (table, column))
+    connection.commit()
+
+def __geolocate_table(connection, table, geolocator):
+
+    '''
+     Geolocate the rows of @table that are not geolocated yet, using
+     @geolocator, and return the number of updated rows.  Rows are
+     walked by id, in batches, and each batch is committed, so that
+     an interrupted run is resumed by the next one.
+    '''
+
+    # Geolocate each address once
+    locations = geolocator.resolve(connection, table, PENDING)
+
+    count, last = 0, -1
+    cursor = connection.cursor()
+    while True:
+        cursor.execute('''SELECT id, real_address FROM %s WHERE id > ?
+          AND %s ORDER BY id LIMIT ?;''' % (table, PENDING), (last, BATCH))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+
+        updates = []
+        for ident, address in rows:
+            org, data = locations[address]
+            country_code, city = None, None
+            if data:
+                country_code, city = data['country_code'], data['city']
+            # Unknown addresses would not change the row
+            if org is None and country_code is None and city is None:
+                continue
+            updates.append((org, city, country_code, ident))
+
+        connection.executemany('''UPDATE %s SET asname=?, city=?,
+          country_code=? WHERE id=?;''' % table, updates)
+        connection.commit()
+        count += len(updates)
+
+    return count
+
+USAGE = 'Usage: geolocate.py [-V] [-G cache] [-j workers] file'
 
 def main():
 
@@ -49,46 +96,46 @@ def main():
 
     syslog.openlog('geolocate.py', syslog.LOG_PERROR, syslog.LOG_USER)
 
+    cache = geoloc.CACHE
+    vacuum = False
+    workers = 0
+
     try:
-        arguments = getopt.getopt(sys.argv[1:], '')[1]
+        options, arguments = getopt.getopt(sys.argv[1:], 'G:j:V')
     except getopt.error:
-        sys.exit('Usage: geolocate.py file')
+        sys.exit(USAGE)
     if len(arguments) != 1:
-        sys.exit('Usage: geolocate.py file')
+        sys.exit(USAGE)
+
+    for name, value in options:
+        if name == '-G':
+            cache = value
+        elif name == '-j':
+            workers = int(value)
+        elif name == '-V':
+            vacuum = True
 
-    geoip_city = __geoip_open('GeoLiteCity.dat')
-    geoip_org = __geoip_open('GeoIPASNum.dat')
+    geolocator = geoloc.Geolocator(utf8=True, cache=cache,
+                                   workers=workers)
 
     syslog.syslog(syslog.LOG_INFO, 'Geolocate: %s' % arguments[0])
     connection = sqlite3.connect(arguments[0])
-    connection.row_factory = sqlite3.Row
-    connection.text_factory = str
 
     for table in ('speedtest', 'bittorrent'):
-        syslog.syslog(syslog.LOG_INFO, 'Table: %s' % table)
-
-        # Add columns
-        connection.execute(''' ALTER TABLE %s ADD COLUMN asname TEXT;'''
-                                    % table)
-        connection.execute(''' ALTER TABLE %s ADD COLUMN country_code TEXT;'''
-                                    % table)
-        connection.execute(''' ALTER TABLE %s ADD COLUMN city TEXT;'''
-                                    % table)
-
-        # Walk and add
-        cursor = connection.cursor()
-        cursor.execute('SELECT * FROM %s' % table)
-        for result in cursor:
-            org = __geoip_query_org(geoip_org, result['real_address'])
-            country_code, city = __geoip_query_location(geoip_city,
-              result['real_address'])
-            connection.execute(''' UPDATE %s SET asname=?, city=?,
-              country_code=? WHERE id=?; ''' % table, (org,
-              city, country_code, result['id']))
-
-    # Rebuild the database
-    connection.execute('VACUUM;')
-    connection.commit()
+        __add_columns(connection, table)
+        count = __geolocate_table(connection, table, geolocator)
+        syslog.syslog(syslog.LOG_INFO, 'Table: %s: %d rows geolocated' %
+                      (table, count))
+
+    geolocator.close()
+    geolocator.report()
+
+    # Rebuilding the database is only worth it now and then
+    if vacuum:
+        connection.commit()
+        connection.execute('VACUUM;')
+
+    connection.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,266 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Range-table geolocation backend.  Loads the CSV editions of the
+ GeoLite City and ASN databases into sorted NumPy arrays of address
+ ranges, so that a whole column of addresses is geolocated at once
+ by binary search, and without the GeoIP library.  The arrays are
+ cached as .npy files next to the CSVs, and are memory-mapped by the
+ following runs, which therefore start quickly.
+
+ The tables mimic the org_by_addr() and record_by_addr() methods of
+ GeoIP, and add the batch orgs() and records() methods.
+'''
+
+import csv
+import os
+import socket
+import struct
+import syslog
+
+import numpy
+
+ASNUM = 'GeoIPASNum2.csv'
+BLOCKS = 'GeoLiteCity-Blocks.csv'
+LOCATION = 'GeoLiteCity-Location.csv'
+
+# MaxMind CSVs are latin-1, as are GeoIP strings by default
+ENCODING = 'latin-1'
+
+def __read_csv(path):
+    ''' Yield the rows of the CSV at @path, skipping the headers '''
+    with open(path, 'r', encoding=ENCODING, newline='') as filep:
+        for row in csv.reader(filep):
+            if row and row[0].isdigit():
+                yield row
+
+def __cached(path, names):
+    ''' Return the arrays @names cached for @path, or None if stale '''
+    arrays = []
+    for name in names:
+        cachepath = '%s.%s.npy' % (path, name)
+        if (not os.path.exists(cachepath) or
+            os.path.getmtime(cachepath) < os.path.getmtime(path)):
+            return None
+        arrays.append(numpy.load(cachepath, mmap_mode='r'))
+    return arrays
+
+def __save(path, names, arrays):
+    ''' Cache @arrays, named @names, for the CSV at @path '''
+    try:
+        for name, array in zip(names, arrays):
+            cachepath = '%s.%s.npy' % (path, name)
+            # Other processes may be loading the same cache
+            temporary = '%s.%d' % (cachepath, os.getpid())
+            with open(temporary, 'wb') as filep:
+                numpy.save(filep, array)
+            os.rename(temporary, cachepath)
+    except (IOError, OSError) as error:
+        syslog.syslog(syslog.LOG_WARNING, 'Cannot cache %s: %s' %
+                      (path, error))
+
+def __sorted(starts, ends, codes):
+    ''' Return the ranges as arrays sorted by their start '''
+    starts = numpy.array(starts, dtype=numpy.uint32)
+    order = numpy.argsort(starts, kind='stable')
+    return (starts[order], numpy.array(ends, dtype=numpy.uint32)[order],
+            numpy.array(codes, dtype=numpy.int64)[order])
+
+def __parse_asnum(path):
+    ''' Parse the ASN CSV at @path into starts, ends, codes, names '''
+    starts, ends, names = [], [], []
+    for row in __read_csv(path):
+        starts.append(int(row[0]))
+        ends.append(int(row[1]))
+        names.append(row[2])
+    labels, codes = numpy.unique(numpy.array(names, dtype=str),
+                                 return_inverse=True)
+    return __sorted(starts, ends, codes) + (labels,)
+
+def __parse_city(path, location):
+
+    '''
+     Parse the blocks CSV at @path and the locations CSV at @location
+     into starts, ends, codes, countries and cities, where the codes
+     index the countries and cities arrays, or are -1 for blocks
+     with an unknown location.
+    '''
+
+    identifiers, countries, cities = [], [], []
+    for row in __read_csv(location):
+        identifiers.append(int(row[0]))
+        countries.append(row[1])
+        cities.append(row[3])
+    identifiers = numpy.array(identifiers, dtype=numpy.int64)
+    order = numpy.argsort(identifiers, kind='stable')
+    identifiers = identifiers[order]
+    countries = numpy.array(countries, dtype=str)[order]
+    cities = numpy.array(cities, dtype=str)[order]
+
+    starts, ends, blocks = [], [], []
+    for row in __read_csv(path):
+        starts.append(int(row[0]))
+        ends.append(int(row[1]))
+        blocks.append(int(row[2]))
+    blocks = numpy.array(blocks, dtype=numpy.int64)
+    codes = numpy.searchsorted(identifiers, blocks)
+    known = codes < len(identifiers)
+    known[known] = identifiers[codes[known]] == blocks[known]
+    codes[~known] = -1
+
+    return __sorted(starts, ends, codes) + (countries, cities)
+
+def load_asnum(path):
+    ''' Return the RangeTable and labels of the ASN CSV at @path '''
+    names = ('starts', 'ends', 'codes', 'labels')
+    arrays = __cached(path, names)
+    if arrays is None:
+        syslog.syslog(syslog.LOG_INFO, 'Loading %s' % path)
+        arrays = __parse_asnum(path)
+        __save(path, names, arrays)
+    return RangeTable(*arrays[:3]), arrays[3]
+
+def load_city(path, location):
+    ''' Return RangeTable, countries and cities of the city CSVs '''
+    names = ('starts', 'ends', 'codes', 'countries', 'cities')
+    arrays = __cached(path, names)
+    if arrays is not None and (os.path.getmtime(location) >
+                               os.path.getmtime('%s.codes.npy' % path)):
+        arrays = None
+    if arrays is None:
+        syslog.syslog(syslog.LOG_INFO, 'Loading %s' % path)
+        arrays = __parse_city(path, location)
+        __save(path, names, arrays)
+    return RangeTable(*arrays[:3]), arrays[3], arrays[4]
+
+def address_vector(addresses):
+
+    '''
+     Convert the dotted quad @addresses into an array of uint32.
+     Returns the array and a mask of the valid addresses; other
+     addresses (e.g. IPv6 or None) are never found.
+    '''
+
+    numbers = numpy.zeros(len(addresses), dtype=numpy.uint32)
+    valid = numpy.zeros(len(addresses), dtype=bool)
+    for index, address in enumerate(addresses):
+        try:
+            numbers[index] = struct.unpack('!I', socket.inet_pton(
+                                           socket.AF_INET, address))[0]
+        except (TypeError, ValueError, socket.error):
+            continue
+        valid[index] = True
+    return numbers, valid
+
+class RangeTable(object):
+
+    '''
+     Non overlapping address ranges [@starts, @ends], sorted by
+     their start, and the @codes of the value of each range.
+    '''
+
+    def __init__(self, starts, ends, codes):
+        self.starts = starts
+        self.ends = ends
+        self.codes = codes
+
+    def search(self, addresses):
+        ''' Return the codes of @addresses, or -1 when not found '''
+        numbers, valid = address_vector(addresses)
+        if not len(self.starts):
+            return numpy.full(len(addresses), -1, dtype=numpy.int64)
+        index = numpy.searchsorted(self.starts, numbers, side='right') - 1
+        found = valid & (index >= 0)
+        index[~found] = 0
+        found &= numbers <= self.ends[index]
+        return numpy.where(found, self.codes[index], -1)
+
+class ASNumTable(object):
+
+    '''
+     Provider of the addresses according to the ASN CSV in
+     @directory, as UTF-8 strings if @utf8 is True and otherwise
+     as latin-1 bytes, like GeoIP.  The CSV is loaded on first use.
+    '''
+
+    def __init__(self, directory, utf8=False):
+        self.paths = (os.path.join(directory, ASNUM),)
+        self.utf8 = utf8
+        self.table = None
+        self.labels = None
+
+    def orgs(self, addresses):
+        ''' Return the provider of each of the @addresses '''
+        if self.table is None:
+            self.table, self.labels = load_asnum(self.paths[0])
+        result = []
+        for code in self.table.search(addresses):
+            result.append(label(self.labels, code, self.utf8))
+        return result
+
+    def org_by_addr(self, address):
+        ''' Return the provider of @address '''
+        return self.orgs([address])[0]
+
+class CityTable(object):
+
+    '''
+     Country code and city of the addresses according to the city
+     CSVs in @directory.  Same conventions as ASNumTable.
+    '''
+
+    def __init__(self, directory, utf8=False):
+        self.paths = (os.path.join(directory, BLOCKS),
+                      os.path.join(directory, LOCATION))
+        self.utf8 = utf8
+        self.table = None
+        self.countries = None
+        self.cities = None
+
+    def records(self, addresses):
+        ''' Return the city record of each of the @addresses '''
+        if self.table is None:
+            self.table, self.countries, self.cities = load_city(
+                                                       *self.paths)
+        result = []
+        for code in self.table.search(addresses):
+            if code < 0:
+                result.append(None)
+                continue
+            result.append({
+                'country_code': label(self.countries, code, self.utf8),
+                'city': label(self.cities, code, self.utf8),
+            })
+        return result
+
+    def record_by_addr(self, address):
+        ''' Return the city record of @address '''
+        return self.records([address])[0]
+
+def label(labels, code, utf8):
+    ''' Return the string @code of @labels, or None '''
+    if code < 0 or not labels[code]:
+        return None
+    value = str(labels[code])
+    if not utf8:
+        return value.encode(ENCODING)
+    return value
+
+def available(directory):
+    ''' Whether @directory contains the CSVs we need '''
+    return all(os.path.exists(os.path.join(directory, name))
+               for name in (ASNUM, BLOCKS, LOCATION))
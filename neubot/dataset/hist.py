@@ -18,44 +18,26 @@
 
 ''' Build histograms on Neubot database '''
 
-import GeoIP
 import collections
 import getopt
 import json
+import numpy
 import pylab
 import sqlite3
 import sys
 import syslog
 
-def __open(path):
-    ''' Open GeoIP database given the @path '''
-    handle = GeoIP.open(path, GeoIP.GEOIP_STANDARD)
-    return handle
+import ecdf
+import geoloc
+import histstore
 
-CITY = __open('/usr/local/share/GeoIP/GeoLiteCity.dat')
-ASNAME = __open('/usr/local/share/GeoIP/GeoIPASNum.dat')
-
-def __geolocate(address, facet):
-
-    '''
-     Given the @address attempt geolocation and then return
-     the selected geolocation @facet (if possible).
-    '''
-
-    if facet == 'provider':
-        return ASNAME.org_by_addr(address)
-    elif facet in ('city', 'country_code'):
-        data = CITY.record_by_addr(address)
-        if not data:
-            return None
-        return data[facet]
-    else:
-        raise RuntimeError('Invalid facet: %s' % facet)
-
-def __load_table(connection, table, providers):
+def __load_table(connection, table, providers, geolocator):
 
     ''' Load from database table '''
 
+    # Geolocate each address once
+    locations = geolocator.resolve(connection, table)
+
     cursor = connection.cursor()
     cursor.execute('SELECT * FROM %s;' % table)
     for row in cursor:
@@ -64,7 +46,7 @@ def __load_table(connection, table, providers):
 
         # Locate uuid and provider
         uuid = line['uuid']
-        provider = __geolocate(line['real_address'], 'provider')
+        provider = locations[line['real_address']][0]
         if not uuid or not provider:
             continue
         provider = provider.decode('latin-1').split()[0]
@@ -97,48 +79,47 @@ def __load_table(connection, table, providers):
         for name, value in line.items():
             stats[name].append(value)
 
+def __select_values(provider, field, minimum, maximum):
+
+    '''
+     Return the values of @field of the neubots of @provider whose
+     maximum download speed, in Mbit/s, is in [@minimum, @maximum).
+    '''
+
+    arrays = []
+    for stats in provider.values():
+        speeds = ecdf.prepare(stats['download_speed'], 8e-06)
+        if not len(speeds):
+            continue
+        maxval = speeds.max()
+        if maxval < minimum or maxval >= maximum:
+            continue
+        if field == 'download_speed':
+            arrays.append(speeds)
+        else:
+            arrays.append(ecdf.prepare(stats[field]))
+    if not arrays:
+        return numpy.zeros(0)
+    return numpy.concatenate(arrays)
+
 def __plot_download_speed(providers, names, minimum, maximum):
 
     ''' Plot download speed cumulative distribution '''
 
-    for name in names:
-        provider = providers[name]
-        hist = []
-        for uuid, stats in provider.items():
-            maxval = max(stats['download_speed']) * 8e-06
-            if maxval < minimum or maxval >= maximum:
-                continue
-            for result in stats['download_speed']:
-                hist.append(result * 8e-06)
-
-        pylab.grid(True, color='black')
-        pylab.hist(hist, bins=100000, cumulative=True, normed=True,
-                   histtype='step', label=name)
-
-    legend = pylab.legend()
-    frame = legend.get_frame()
-    frame.set_alpha(0.25)
-
-    pylab.figure(2)
-    for name in names:
-        provider = providers[name]
-        hist = []
-        for uuid, stats in provider.items():
-            maxval = max(stats['download_speed']) * 8e-06
-            if maxval < minimum or maxval >= maximum:
-                continue
-            for result in stats['download_wnd']:
-                hist.append(result)
-
-        pylab.grid(True, color='black')
-        pylab.hist(hist, bins=100000, cumulative=True, normed=True,
-                   histtype='step', label=name)
-
-    legend = pylab.legend()
-    frame = legend.get_frame()
-    frame.set_alpha(0.25)
-
-USAGE = 'Usage: hist.py [-dJ] [-o file] file'
+    for figure, field in enumerate(('download_speed', 'download_wnd')):
+        pylab.figure(figure + 1)
+        for name in names:
+            hist = __select_values(providers[name], field, minimum,
+                                   maximum)
+            xdata, ydata = ecdf.cdf(hist)
+            pylab.grid(True, color='black')
+            pylab.plot(xdata, ydata, drawstyle='steps-post', label=name)
+
+        legend = pylab.legend()
+        frame = legend.get_frame()
+        frame.set_alpha(0.25)
+
+USAGE = 'Usage: hist.py [-dJs] [-C dir] [-G cache] [-o file] file'
 
 def main():
 
@@ -147,38 +128,55 @@ def main():
     syslog.openlog('hist.py', syslog.LOG_PERROR, syslog.LOG_USER)
 
     groups = []
+    cache = geoloc.CACHE
     fromjson = False
     outfile = None
     pretty = False
+    store = None
+    dtype = 'float64'
 
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'dJo:')
+        options, arguments = getopt.getopt(sys.argv[1:], 'C:dG:Jo:s')
     except getopt.error:
         sys.exit(USAGE)
     if len(arguments) != 1:
         sys.exit(USAGE)
 
     for name, value in options:
-        if name == '-d':
+        if name == '-C':
+            store = value
+        elif name == '-d':
             pretty = True
+        elif name == '-G':
+            cache = value
         elif name == '-J':
             fromjson = True
         elif name == '-o':
             outfile = value
+        elif name == '-s':
+            dtype = 'float32'
 
     syslog.syslog(syslog.LOG_INFO, 'Loading database')
 
+    # With -J the input is the output of -o or of -C
     if fromjson:
-        providers = json.load(open(arguments[0], 'r'))
+        providers = histstore.load(arguments[0])
     else:
         providers = {}
+        geolocator = geoloc.Geolocator(cache=cache)
         connection = sqlite3.connect(arguments[0])
         connection.row_factory = sqlite3.Row
         for table in ('speedtest', 'bittorrent'):
-            __load_table(connection, table, providers)
+            __load_table(connection, table, providers, geolocator)
+        geolocator.close()
+        geolocator.report()
 
     syslog.syslog(syslog.LOG_INFO, 'Database loaded')
 
+    if store:
+        histstore.write(providers, store, dtype)
+        sys.exit(0)
+
     if outfile:
         if outfile == '-':
             outfp = sys.stdout
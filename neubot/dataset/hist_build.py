@@ -18,7 +18,6 @@
 
 ''' Build histograms on Neubot database '''
 
-import GeoIP
 import collections
 import getopt
 import json
@@ -27,44 +26,42 @@ import sys
 import syslog
 import uuid
 
-def __open(path):
-    ''' Open GeoIP database given the @path '''
-    handle = GeoIP.open(path, GeoIP.GEOIP_STANDARD)
-    handle.set_charset(GeoIP.GEOIP_CHARSET_UTF8)
-    return handle
+import geoloc
+import histcode
+import histshard
+import histspill
+import histstore
+import sketch
 
-CITY = __open('/usr/local/share/GeoIP/GeoLiteCity.dat')
-ASNAME = __open('/usr/local/share/GeoIP/GeoIPASNum.dat')
+# Geolocator of a worker process (see -j)
+GEOLOCATOR = None
 
-def __geolocate(address, facet):
+def __anonymous(uuidcache, value):
+    ''' Return the random uuid that replaces @value in @uuidcache '''
+    if not value in uuidcache:
+        uuidcache[value] = str(uuid.uuid4())
+    return uuidcache[value]
 
-    '''
-     Given the @address attempt geolocation and then return
-     the selected geolocation @facet (if possible).
-    '''
-
-    if facet == 'provider':
-        return ASNAME.org_by_addr(address)
-    elif facet in ('city', 'country_code'):
-        data = CITY.record_by_addr(address)
-        if not data:
-            return None
-        return data[facet]
-    else:
-        raise RuntimeError('Invalid facet: %s' % facet)
-
-def __build_hist(connection, table, hist, groups):
+def __build_hist(connection, table, hist, groups, geolocator,
+                 spiller=None, sketches=False, shard=('', ()),
+                 uuidcache=None):
 
     '''
      This function walks the @table of the database referenced by
      @connection and builds the @hist.  Depending on the groups
      the result dictionary contains more or less aggregated data.
+     Addresses are geolocated using @geolocator.  If @spiller is
+     not None, it keeps @hist within its memory budget.  If
+     @sketches is True, each metric is summarized by a sketch
+     rather than listed.  The @shard is the (condition, params)
+     pair that selects the rows to walk (see histshard.py).  Uuids
+     are replaced using @uuidcache, unless it is None.
     '''
 
-    uuidcache = {}
-
+    condition, params = shard
     cursor = connection.cursor()
-    cursor.execute('SELECT * FROM %s;' % table)
+    cursor.execute('SELECT * FROM %s%s;' % (table, ' WHERE %s' %
+                   condition if condition else ''), params)
     for row in cursor:
 
         row = dict(row)
@@ -76,7 +73,7 @@ def __build_hist(connection, table, hist, groups):
             if group == 'uuid':
                 selector = row['uuid']
             elif group in ('provider', 'country_code', 'city'):
-                selector = __geolocate(row['real_address'], group)
+                selector = geolocator.facet(row['real_address'], group)
             else:
                 raise RuntimeError('Invalid group: %s' % group)
 
@@ -103,23 +100,85 @@ def __build_hist(connection, table, hist, groups):
         # We want to keep the uuid information to be able to
         # count the number of users per provider.
         #
-        if not row['uuid'] in uuidcache:
-            uuidcache[ row['uuid'] ] = str(uuid.uuid4())
-        row['uuid'] = uuidcache[ row['uuid'] ]
-
-        # Copy stats
-        if not table in stats:
-            stats[table] = collections.defaultdict(list)
-        for key, value in row.items():
-            stats[table][key].append(value)
+        if uuidcache is not None:
+            row['uuid'] = __anonymous(uuidcache, row['uuid'])
 
         # Add window
         for direction in ('download', 'upload'):
-            value = row['%s_speed' % direction] * row['latency']
-            stats[table]['%s_wnd' % direction].append(value)
+            row['%s_wnd' % direction] = (row['%s_speed' % direction] *
+                                          row['latency'])
+
+        #
+        # Copy stats, or summarize them.  Only numbers are summarized,
+        # so there is no sketch of uuids nor of the text columns added
+        # by geolocate.py, e.g. city.
+        #
+        if sketches:
+            if not table in stats:
+                stats[table] = collections.defaultdict(sketch.Sketch)
+            for key, value in row.items():
+                if isinstance(value, (int, float)):
+                    stats[table][key].add(value)
+        else:
+            if not table in stats:
+                stats[table] = collections.defaultdict(list)
+            for key, value in row.items():
+                stats[table][key].append(value)
+
+        if spiller:
+            spiller.tick(len(row))
+
+def __merge_stats(old, new):
+    ''' Append the lists, or merge the sketches, of @new to @old '''
+    for name, value in new.items():
+        if not name in old:
+            old[name] = value
+        elif isinstance(value, sketch.Sketch):
+            old[name].merge(value)
+        else:
+            old[name].extend(value)
+    return old
+
+def __replace_uuids(hist, depth, table, uuidcache):
+    ''' Replace the uuids of @table in @hist, grouped at @depth '''
+    for _, stats in histspill.flatten(hist, depth):
+        if stats and table in stats and 'uuid' in stats[table]:
+            stats[table]['uuid'] = [__anonymous(uuidcache, value)
+                                    for value in stats[table]['uuid']]
+
+def __count_values(hist, depth):
+    ''' Return the number of values of @hist, grouped at @depth '''
+    count = 0
+    for _, stats in histspill.flatten(hist, depth):
+        if stats:
+            count += sum(len(values) for values in stats.values())
+    return count
+
+def __build_init(cache):
+    ''' Set up the geolocation of a worker process '''
+    global GEOLOCATOR
+    GEOLOCATOR = geoloc.Geolocator(utf8=True, cache=cache)
+
+def __build_shard(task):
+
+    '''
+     Build and return the partial histogram of the shard @task, i.e.
+     (path, table, groups, sketches, shard).  Uuids are replaced
+     later, so that shards of the same table share the replacements.
+    '''
+
+    path, table, groups, sketches, shard = task
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    hist = {}
+    __build_hist(connection, table, hist, groups, GEOLOCATOR,
+                 sketches=sketches, shard=shard)
+    connection.close()
+    return hist
 
 USAGE = '''\
-Usage: hist_build.py [-d] [-D group] [-o file] file
+Usage: hist_build.py [-deks] [-C dir] [-D group] [-G cache] [-j workers]
+                     [-m megabytes] [-o file] file
 Groups: city, country_code, provider, uuid'''
 
 def main():
@@ -128,29 +187,118 @@ def main():
 
     syslog.openlog('hist_build.py', syslog.LOG_PERROR, syslog.LOG_USER)
     groups = []
+    cache = geoloc.CACHE
     outfp = sys.stdout
     pretty = False
+    store = None
+    dtype = 'float64'
+    budget = 0
+    sketches = False
+    workers = 0
+    encoding = False
 
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'D:dno:')
+        options, arguments = getopt.getopt(sys.argv[1:],
+                                           'C:D:deG:j:km:no:s')
     except getopt.error:
         sys.exit(USAGE)
     if len(arguments) != 1:
         sys.exit(USAGE)
 
     for name, value in options:
-        if name == '-D':
+        if name == '-C':
+            store = value
+        elif name == '-D':
             groups.append(value)
         elif name == '-d':
             pretty = True
+        elif name == '-e':
+            encoding = True
+        elif name == '-G':
+            cache = value
+        elif name == '-j':
+            workers = int(value)
+        elif name == '-k':
+            sketches = True
+        elif name == '-m':
+            budget = int(value) * 1024 * 1024
         elif name == '-o':
             outfp = open(value, 'w')
+        elif name == '-s':
+            dtype = 'float32'
+
+    # Sketches take constant space, so they need no budget
+    if sketches and budget:
+        sys.exit(USAGE)
+
+    # Strings are encoded once the whole histogram is built
+    if encoding and budget:
+        sys.exit(USAGE)
 
     hist = {}
+    spiller = None
+    if budget:
+        # Groups are the tables at the last grouping level
+        spiller = histspill.Spiller(hist, len(groups) + 1, budget)
+    geolocator = geoloc.Geolocator(utf8=True, cache=cache)
     connection = sqlite3.connect(arguments[0])
     connection.row_factory = sqlite3.Row
-    for table in ('speedtest', 'bittorrent'):
-        __build_hist(connection, table, hist, groups)
+
+    #
+    # With -j the tables are split into ranges of rowid that a pool
+    # of processes turns into partial histograms, which are merged
+    # in order (see histshard.py).  The addresses are geolocated
+    # here first, so that the workers find them in the cache.
+    #
+    if workers > 1:
+        tasks = []
+        for table in ('speedtest', 'bittorrent'):
+            if set(groups) & set(('provider', 'country_code', 'city')):
+                geolocator.resolve(connection, table)
+            for shard in histshard.slices(connection, table,
+                                          workers=workers):
+                tasks.append((arguments[0], table, groups, sketches, shard))
+        geolocator.close()
+        uuidcaches = collections.defaultdict(dict)
+        results = histshard.run(__build_shard, tasks, workers,
+                                __build_init, (cache,))
+        for task, partial in zip(tasks, results):
+            __replace_uuids(partial, len(groups), task[1],
+                            uuidcaches[task[1]])
+            histshard.merge(hist, partial, len(groups) + 1, __merge_stats)
+            if spiller:
+                spiller.tick(__count_values(partial, len(groups) + 1))
+    else:
+        for table in ('speedtest', 'bittorrent'):
+            __build_hist(connection, table, hist, groups, geolocator,
+                         spiller, sketches, uuidcache={})
+
+    geolocator.close()
+    geolocator.report()
+
+    # Sketches are saved as dictionaries (see hist_merge.py)
+    if sketches:
+        hist = sketch.to_tree(hist)
+
+    # With -e labels and uuids are replaced by codes (see histcode.py)
+    if encoding:
+        hist = histcode.encode(hist, len(groups))
+
+    # With -m groups are merged from disk and written as a stream
+    if spiller:
+        if store:
+            histspill.write_store(spiller.items(), store, dtype)
+        else:
+            histspill.dump_json(spiller.items(), outfp, pretty)
+            if pretty:
+                outfp.write("\n")
+        spiller.close()
+        return
+
+    # With -C write typed arrays that readers can memory-map
+    if store:
+        histstore.write(hist, store, dtype)
+        return
 
     indent, sort_keys = None, False
     if pretty:
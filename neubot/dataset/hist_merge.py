@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Merge the sketches written by hist_build.py -k for different
+ databases, shards or days into the sketches of the whole.
+'''
+
+import getopt
+import json
+import sys
+import syslog
+
+import histcode
+import histstore
+import sketch
+
+USAGE = 'Usage: hist_merge.py [-d] [-C dir] [-o file] file...'
+
+def main():
+
+    ''' Merge histogram sketches '''
+
+    syslog.openlog('hist_merge.py', syslog.LOG_PERROR, syslog.LOG_USER)
+    outfp = sys.stdout
+    pretty = False
+    store = None
+
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'C:do:')
+    except getopt.error:
+        sys.exit(USAGE)
+    if not arguments:
+        sys.exit(USAGE)
+
+    for name, value in options:
+        if name == '-C':
+            store = value
+        elif name == '-d':
+            pretty = True
+        elif name == '-o':
+            outfp = open(value, 'w')
+
+    hist = {}
+    for argument in arguments:
+        syslog.syslog(syslog.LOG_INFO, 'Merge: %s' % argument)
+        tree = histcode.decode(histstore.load(argument))
+        sketch.merge_tree(hist, sketch.from_tree(tree))
+    hist = sketch.to_tree(hist)
+
+    if store:
+        histstore.write(hist, store)
+        return
+
+    indent, sort_keys = None, False
+    if pretty:
+        indent, sort_keys = 4, True
+    json.dump(hist, outfp, indent=indent, sort_keys=sort_keys)
+    if pretty:
+        outfp.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -19,10 +19,15 @@
 ''' Plot histograms '''
 
 import getopt
-import json
+import numpy
 import pylab
 import sys
 
+import ecdf
+import histcode
+import histstore
+import sketch
+
 USAGE = '''
 Usage: hist_plot.py [-CENS] [-D selection] [-F scaling-factor]
                     [-L lower-bound] [-n bins] [-o file] [-T title]
@@ -30,14 +35,15 @@ Usage: hist_plot.py [-CENS] [-D selection] [-F scaling-factor]
 
 Options:
     -C                  : cumulative mode
-    -D selection        : select only this facet
+    -D selection        : select only this facet (values or sketch)
     -E                  : exclude out of bounds
     -F scaling-factor   : scaling factor
     -L lower-bound      : distribution lower-bound
     -N                  : normed mode
-    -n bins             : number of bins
+    -n bins             : number of bins (default: exact CDF in
+                          cumulative mode, otherwise 10 bins)
     -o file             : output file
-    -S                  : step histogram mode
+    -S                  : step curve mode
     -T title            : title
     -U upper-bound      : distribution upper-bound
     -X label            : X axis label
@@ -52,10 +58,10 @@ def main():
     scalingfactor = None
     lowerbound = None
     outfile = None
-    bins = 10
+    bins = None
     normed = False
     cumulative = False
-    histtype = 'bar'
+    drawstyle = 'default'
     upperbound = None
     exclude = False
     xlabel = ''
@@ -97,7 +103,7 @@ def main():
         elif name == '-o':
             outfile = value
         elif name == '-S':
-            histtype = 'step'
+            drawstyle = 'steps-post'
         elif name == '-T':
             title = value
         elif name == '-U':
@@ -109,56 +115,45 @@ def main():
 
     data = []
 
-    ohist = json.load(open(arguments[0], 'r'))
+    # Columnar stores load only the selected arrays
+    ohist = histstore.load(arguments[0])
     for selection in selections:
-        hist = ohist
-        for facet in selection.split('/')[1:]:
-            hist = hist[facet]
-
-        nhist = []
-        for elem in hist:
-            if scalingfactor != None:
-                elem = elem * scalingfactor
-            if lowerbound != None and elem < lowerbound:
-                if exclude:
-                    continue
-                elem = lowerbound
-            if upperbound != None and elem > upperbound:
-                if exclude:
-                    continue
-                elem = upperbound
-            nhist.append(elem)
-        hist = nhist
-
+        hist = histcode.select(ohist, selection)
         label = selection.split('/')[1]
-        ydata, xdata = pylab.hist(hist, bins=bins, cumulative=cumulative,
-                      normed=normed, histtype=histtype, label=label)[:2]
-        data.append((xdata, ydata, label))
 
-    #
-    # XXX Replace the histogram with the cumulative distribution
-    # line.  We need to replace binds edges with the value in the
-    # middle of the bin.
-    #
+        # Sketches (hist_build.py -k) already are distributions
+        if sketch.is_sketch(hist):
+            xdata, ydata = sketch.from_dict(hist).cdf()
+            xdata = ecdf.prepare(xdata, scalingfactor)
+            xdata, ydata = ecdf.bound_cdf(xdata, ydata, lowerbound,
+                                          upperbound, exclude)
+        else:
+            hist = ecdf.prepare(hist, scalingfactor, lowerbound,
+                                upperbound, exclude)
+            if cumulative and not bins:
+                xdata, ydata = ecdf.cdf(hist, normed)
+            else:
+                xdata, ydata = ecdf.histogram(hist, bins or 10,
+                                              cumulative, normed)
+
+        if len(xdata):
+            data.append((xdata, ydata, label))
 
     xmax = 0
-    for index in range(len(data)):
-        xdata, ydata, label = data[index]
-        diff = (xdata[1] - xdata[0])/2
-        xdata = map(lambda elem: elem + diff, xdata)
-        del xdata[-1]
-        if max(xdata) > xmax:
-            xmax = max(xdata)
-        data[index] = xdata, ydata, label
+    for xdata, ydata, label in data:
+        if xdata[-1] > xmax:
+            xmax = xdata[-1]
 
+    # Extend shorter curves to the right end of the plot
     pylab.clf()
     for xdata, ydata, label in data:
-        if max(xdata) < xmax:
-            xdata.append(xmax)
-            ydata = list(ydata)
-            ydata.append(1)
-        pylab.plot(xdata, ydata, label=label)
+        if xdata[-1] < xmax:
+            xdata = numpy.append(xdata, xmax)
+            ydata = numpy.append(ydata, ydata[-1])
+        pylab.plot(xdata, ydata, label=label, drawstyle=drawstyle)
 
+    if upperbound == None:
+        upperbound = xmax
     pylab.xlim([lowerbound, upperbound + (upperbound/100.0)])
     pylab.ylim([0, 1.01])
     pylab.grid(True, color='black')
@@ -22,6 +22,9 @@ import getopt
 import json
 import sys
 
+import histcode
+import histstore
+
 def main():
 
     ''' Plot information about providers '''
@@ -39,15 +42,24 @@ def main():
         if tpl[0] == '-J':
             json_output = True
 
-    providers = json.load(open(arguments[0], 'r'))
+    # Only the uuid lists are read from columnar stores
+    providers = histstore.load(arguments[0])
     results = []
 
+    # Encoded uuids (hist_build.py -e) are counted as codes
+    table = None
+    if histcode.is_encoded(providers):
+        table = histcode.strings(providers)
+        providers = providers['histogram']
+
     #
     # XXX Assume that the first level is providers and
     # the second level is the test table
     #
     for provider, tables in providers.items():
         stats = tables['speedtest']['uuid']
+        if table:
+            provider = histcode.label(table, provider)
         results.append((len(set(stats)), len(stats), provider))
 
     results = sorted(results)
@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Dictionary encoding of histograms.  The labels of the groups, e.g.
+ providers and cities, and the uuids, which repeat once per test,
+ are written once in a table of strings, and the histogram refers
+ to them by their index in the table:
+
+    {
+        "encoding": "dictionary",
+        "depth": 1,
+        "strings": ["AS1234 Provider", "0b6d5a4e-...", ...],
+        "histogram": {
+            "0": {
+                "speedtest": {"uuid": [1, 1, 2], "latency": [...]},
+                ...
+            }
+        }
+    }
+
+ where the keys of the first depth levels of the histogram, i.e.
+ the groups, and the values of the uuid lists are encoded.  Readers
+ can count and compare the codes without decoding them.  In columnar
+ stores (see histstore.py) the codes become int64 and the strings
+ become bytes, and both are converted back here.
+'''
+
+import collections.abc
+
+import histstore
+
+KIND = 'dictionary'
+
+# Lists whose values are encoded
+CODED = ('uuid',)
+
+class Encoder(object):
+
+    ''' Assigns codes to strings, in order of first use '''
+
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def code(self, string):
+        ''' Return the code of @string '''
+        if string not in self.codes:
+            self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        return self.codes[string]
+
+    def encode(self, tree, depth):
+        ''' Return @tree, whose groups are at @depth, encoded '''
+        result = {}
+        for key, value in tree.items():
+            if depth > 0:
+                result[str(self.code(key))] = self.encode(value, depth - 1)
+            elif key in CODED and isinstance(value, list):
+                result[key] = [self.code(string) for string in value]
+            elif isinstance(value, collections.abc.Mapping):
+                result[key] = self.encode(value, 0)
+            else:
+                result[key] = value
+        return result
+
+def encode(tree, depth):
+    ''' Return the encoded document of @tree, grouped at @depth '''
+    encoder = Encoder()
+    histogram = encoder.encode(tree, depth)
+    return {
+        'encoding': KIND,
+        'depth': depth,
+        'strings': encoder.strings,
+        'histogram': histogram,
+    }
+
+def is_encoded(document):
+    ''' Whether @document is an encoded histogram '''
+    return (isinstance(document, collections.abc.Mapping) and
+            document.get('encoding') == KIND)
+
+def strings(document):
+    ''' Return the table of strings of the encoded @document '''
+    return [string.decode('utf-8') if isinstance(string, bytes)
+            else string for string in document['strings']]
+
+def label(table, code):
+    ''' Return the string of @code, a key or value, in @table '''
+    return table[int(code)]
+
+def decode(document):
+    ''' Return the histogram of @document, which may be not encoded '''
+    if not is_encoded(document):
+        return document
+    table = strings(document)
+
+    def visit(tree, depth):
+        ''' Decode @tree, whose groups are at @depth '''
+        result = {}
+        for key, value in tree.items():
+            if depth > 0:
+                result[label(table, key)] = visit(value, depth - 1)
+            elif key in CODED and not isinstance(value,
+                                                 collections.abc.Mapping):
+                result[key] = [label(table, code) for code in value]
+            elif isinstance(value, collections.abc.Mapping):
+                result[key] = visit(value, 0)
+            else:
+                result[key] = value
+        return result
+
+    return visit(document['histogram'], int(document['depth']))
+
+def select(document, selection):
+
+    '''
+     Return the subtree of @document at @selection, e.g. /Turin/rtt,
+     like histstore.select(), encoding the groups of the selection if
+     @document is encoded.  The subtree itself is not decoded.
+    '''
+
+    if not is_encoded(document):
+        return histstore.select(document, selection)
+
+    codes = dict((string, index) for index, string in
+                 enumerate(strings(document)))
+    tree = document['histogram']
+    depth = int(document['depth'])
+    for key in selection.split('/')[1:]:
+        if depth > 0:
+            key = str(codes[key])
+            depth -= 1
+        tree = tree[key]
+    return tree
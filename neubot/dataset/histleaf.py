@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Compact groups of the histograms of tool.py -H.  Rather than a
+ dictionary of dictionaries of lists of boxed floats, each group
+ keeps the download speed, upload speed and connect time of the
+ tests of each table interleaved in one array of doubles, where
+ None is NaN, and created on the first test.  A group reads like
+ the dictionary it replaces, which is what JSON and columnar stores
+ (see histstore.py) get:
+
+    {
+        "bittorrent": {"dload": [...], "upload": [...], "rtt": [...]},
+        "speedtest": {"dload": [...], "upload": [...], "rtt": [...]},
+        "first_test": 1300000000,
+        "last_test": 1300000000
+    }
+
+ A group without tests reads like an empty dictionary.
+'''
+
+import array
+import collections.abc
+
+TABLES = ('bittorrent', 'speedtest')
+METRICS = ('dload', 'upload', 'rtt')
+KEYS = TABLES + ('first_test', 'last_test')
+
+# Size of a value in the arrays of a group (see histspill.py)
+VALUE = array.array('d').itemsize
+
+def to_float(value):
+    ''' Return @value as a float, where None is NaN '''
+    if value is None:
+        return float('nan')
+    return value
+
+def to_list(values):
+    ''' Return the array @values as a list, where NaN is None '''
+    result = values.tolist()
+    for index, value in enumerate(result):
+        if value != value:
+            result[index] = None
+    return result
+
+class Stats(collections.abc.Mapping):
+
+    ''' Tests of a group of the histogram, per table '''
+
+    __slots__ = ('bittorrent', 'speedtest', 'first_test', 'last_test')
+
+    def __init__(self):
+        self.bittorrent = None
+        self.speedtest = None
+        self.first_test = 0
+        self.last_test = 0
+
+    def add(self, table, timestamp, dload, upload, rtt):
+        ''' Add a test of @table that ran at @timestamp '''
+        if not self.first_test:
+            self.first_test = timestamp
+        if timestamp > self.last_test:
+            self.last_test = timestamp
+        values = getattr(self, table)
+        if values is None:
+            values = array.array('d')
+            setattr(self, table, values)
+        values.append(to_float(dload))
+        values.append(to_float(upload))
+        values.append(to_float(rtt))
+
+    def merge(self, other):
+        ''' Append the tests of the group @other and return self '''
+        for table in TABLES:
+            values = getattr(other, table)
+            if values is None:
+                continue
+            if getattr(self, table) is None:
+                setattr(self, table, array.array('d'))
+            getattr(self, table).extend(values)
+        if not self.first_test:
+            self.first_test = other.first_test
+        self.last_test = max(self.last_test, other.last_test)
+        return self
+
+    def size(self):
+        ''' Return the number of values of the group '''
+        return sum(len(getattr(self, table)) for table in TABLES
+                   if getattr(self, table) is not None)
+
+    def clear(self):
+        ''' Remove all the tests '''
+        self.__init__()
+
+    def column(self, table, metric):
+        ''' Return the array of @metric values of @table '''
+        values = getattr(self, table)
+        if values is None:
+            return array.array('d')
+        return values[METRICS.index(metric)::len(METRICS)]
+
+    def __getitem__(self, key):
+        if not self.size():
+            raise KeyError(key)
+        if key in TABLES:
+            return dict((metric, self.column(key, metric))
+                        for metric in METRICS)
+        if key in ('first_test', 'last_test'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        if not self.size():
+            return iter(())
+        return iter(KEYS)
+
+    def __len__(self):
+        if not self.size():
+            return 0
+        return len(KEYS)
+
+    def to_dict(self):
+        ''' Return the group as a dictionary of lists '''
+        result = {}
+        for key in self:
+            if key in TABLES:
+                result[key] = dict((metric, to_list(self.column(key,
+                                   metric))) for metric in METRICS)
+            else:
+                result[key] = getattr(self, key)
+        return result
+
+def merge(old, new):
+    ''' Merge two groups of the same histogram (see histspill.py) '''
+    return old.merge(new)
+
+def to_json(value):
+    ''' Hook for json.dump() that converts groups into dictionaries '''
+    if isinstance(value, Stats):
+        return value.to_dict()
+    raise TypeError('Cannot serialize %r' % (value,))
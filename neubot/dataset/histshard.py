@@ -0,0 +1,144 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Multi-core building of histograms.  Each table of each input
+ database is split into shards, i.e. contiguous slices of the rows
+ in the order the serial code reads them: ranges of rowid when the
+ query has no ORDER BY, and ranges of its first ORDER BY column
+ otherwise.  Worker processes build a partial histogram for each
+ shard, and the partials are merged by group key in shard order, so
+ that the result is the same the serial code builds, down to the
+ order of the values and of the keys.
+'''
+
+import multiprocessing
+
+import copytable
+
+# Tables with fewer rows than this are not split
+SHARD = 65536
+
+def __cuts(connection, table, column, where, count):
+    ''' Return up to @count - 1 values of @column that split @table '''
+
+    if column == 'id':
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM %s%s;' % (table, where))
+        total = cursor.fetchone()[0]
+        cuts = []
+        for index in range(1, count):
+            cursor.execute('SELECT id FROM %s%s ORDER BY id LIMIT 1 '
+                           'OFFSET ?;' % (table, where),
+                           (total * index // count,))
+            row = cursor.fetchone()
+            if row and (not cuts or row[0] > cuts[-1]):
+                cuts.append(row[0])
+        return cuts
+
+    # A slice never splits the rows with the same value
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, COUNT(*) FROM %s%s GROUP BY 1 ORDER BY 1;'
+                   % (column, table, where))
+    values = cursor.fetchall()
+    total = sum(row[1] for row in values)
+    cuts, seen = [], 0
+    for value, number in values:
+        if seen >= total * (len(cuts) + 1) // count and seen:
+            cuts.append(value)
+            if len(cuts) == count - 1:
+                break
+        seen += number
+    return cuts
+
+def slices(connection, table, column='id', where='', workers=1):
+
+    '''
+     Split the rows of @table, filtered by the optional @where clause,
+     into at most @workers slices of about the same size, by ranges
+     of @column, which is either id or the first ORDER BY expression.
+     Returns a list of (condition, params) pairs, in order, where the
+     condition is to be ANDed to @where.  Small tables are one slice,
+     whose condition is empty.
+    '''
+
+    table = copytable.sanitize(table)
+    clause = ' WHERE %s' % where if where else ''
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM %s%s;' % (table, clause))
+    count = min(workers, cursor.fetchone()[0] // SHARD)
+    if count <= 1:
+        return [('', ())]
+
+    cuts = __cuts(connection, table, column, clause, count)
+    if not cuts:
+        return [('', ())]
+    result = [('%s < ?' % column, (cuts[0],))]
+    for lower, upper in zip(cuts, cuts[1:]):
+        result.append(('%s >= ? AND %s < ?' % (column, column),
+                       (lower, upper)))
+    result.append(('%s >= ?' % column, (cuts[-1],)))
+    return result
+
+def merge(old, new, depth, leaf):
+
+    '''
+     Merge the partial histogram @new into @old, whose groups are at
+     @depth, and return it.  Groups missing from @old are added after
+     the existing ones, and equal groups are combined by @leaf, which
+     appends the values of its second argument to the first one.
+     Without grouping the histograms are groups, maybe empty, so that
+     @leaf must accept empty groups.
+    '''
+
+    if not depth:
+        return leaf(old, new)
+    for key, value in new.items():
+        if key not in old:
+            old[key] = value
+        else:
+            merge(old[key], value, depth - 1, leaf)
+    return old
+
+def run(function, tasks, workers, initializer=None, initargs=()):
+
+    '''
+     Yield the result of @function for each of @tasks, in order.  The
+     tasks run in @workers processes, set up by @initializer, except
+     the ones whose first item, the path of the database as returned
+     by copytable.database_path(), is empty, i.e. whose database is
+     only in memory.  Those run here, while the workers are busy, and
+     carry the connection as second item.
+    '''
+
+    remote = [task for task in tasks if task[0]]
+    if not remote:
+        for task in tasks:
+            yield function(task)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer, initargs)
+    try:
+        results = pool.imap(function, remote)
+        for task in tasks:
+            if task[0]:
+                yield next(results)
+            else:
+                yield function(task)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,241 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Out-of-core aggregation of histograms.  While a histogram is built,
+ the values it holds are counted, and when they exceed the memory
+ budget its groups are written to disk as a run sorted by group key,
+ and the histogram starts over empty.  At the end the runs are merged
+ by group key, like in an external sort, and each group is written
+ to the output as soon as it is complete.  So memory is bounded by
+ the budget plus the largest group, rather than by the whole dataset.
+
+ The groups are the dictionaries found at a fixed depth of the tree,
+ i.e. the number of grouping levels; the order of the values of a
+ group is the same as when building in memory.
+'''
+
+import heapq
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import histstore
+
+# Rough size of a value in a list, including the list slot
+VALUE = 48
+
+def flatten(tree, depth, keys=()):
+
+    '''
+     Yield the (key, group) pairs of the dictionaries at @depth of
+     @tree, where the key is the tuple of the keys along the path.
+     Groups left empty above @depth are yielded with a None group,
+     so that they are not lost.
+    '''
+
+    if len(keys) == depth:
+        yield keys, tree
+        return
+    if not tree:
+        if keys:
+            yield keys, None
+        return
+    for key, value in tree.items():
+        for item in flatten(value, depth, keys + (str(key),)):
+            yield item
+
+def merge_lists(old, new):
+    ''' Merge two groups that map names to lists or to groups '''
+    for name, value in new.items():
+        if name not in old:
+            old[name] = value
+        elif isinstance(value, dict):
+            merge_lists(old[name], value)
+        else:
+            old[name].extend(value)
+    return old
+
+def read_run(path):
+    ''' Yield the (key, group) pairs of the run at @path '''
+    with open(path, 'rb') as filep:
+        while True:
+            try:
+                yield pickle.load(filep)
+            except EOFError:
+                break
+
+class Spiller(object):
+
+    '''
+     Keeps the histogram @hist, whose groups are at @depth, within
+     @budget bytes, spilling it into a temporary directory, created
+     in @directory.  Equal groups from different runs are combined
+     with @merge, which appends the values of its second argument to
+     those of the first one.  Each value is priced @value bytes, by
+     default the size of a float in a list.
+    '''
+
+    def __init__(self, hist, depth, budget, merge=merge_lists,
+                 directory=None, value=VALUE):
+        self.hist = hist
+        self.depth = depth
+        self.budget = budget
+        self.merge = merge
+        self.value = value
+        self.directory = tempfile.mkdtemp(prefix='spill-', dir=directory)
+        self.runs = []
+        self.values = 0
+
+    def tick(self, count=1):
+
+        '''
+         Account for @count more values in the histogram.  Returns
+         True if the histogram has been spilled, in which case the
+         groups the caller holds are no longer part of it.
+        '''
+
+        self.values += count
+        if self.values * self.value > self.budget:
+            self.spill()
+            return True
+        return False
+
+    def spill(self):
+        ''' Write the histogram as a sorted run and empty it '''
+        if not self.hist:
+            return
+        path = os.path.join(self.directory, 'run-%06d' % len(self.runs))
+        with open(path, 'wb') as filep:
+            for item in sorted(flatten(self.hist, self.depth),
+                               key=lambda item: item[0]):
+                pickle.dump(item, filep, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(path)
+        self.hist.clear()
+        self.values = 0
+
+    def items(self):
+
+        '''
+         Yield the (key, group) pairs of the whole histogram, sorted
+         by key, merging the runs and what is still in memory.
+        '''
+
+        # Runs come first, and merge() is stable, so order is kept
+        sources = [read_run(path) for path in self.runs]
+        sources.append(sorted(flatten(self.hist, self.depth),
+                              key=lambda item: item[0]))
+        current, group = None, None
+        for key, value in heapq.merge(*sources, key=lambda item: item[0]):
+            if key == current and value is not None:
+                group = self.merge(group, value) if group else value
+                continue
+            if key == current:
+                continue
+            if current is not None:
+                yield current, group
+            current, group = key, value
+        if current is not None:
+            yield current, group
+
+    def close(self):
+        ''' Remove the runs '''
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def dump_json(items, outfp, pretty=False, default=None):
+
+    '''
+     Write the sorted (key, group) @items to @outfp as one JSON
+     document, the same json.dump() would write for the whole tree
+     (with sorted keys), but holding only one group at a time.  The
+     @default hook is passed to json.dump().
+    '''
+
+    indent, separator = None, ', '
+    if pretty:
+        indent, separator = 4, ','
+
+    def newline(depth):
+        ''' Start a new line at @depth when pretty printing '''
+        if pretty:
+            outfp.write('\n' + ' ' * 4 * depth)
+
+    stack, counts = [], [0]
+    for key, group in items:
+
+        # Without grouping, the only group is the whole tree
+        if not key:
+            json.dump(group, outfp, indent=indent, sort_keys=pretty,
+                      default=default)
+            return
+
+        if not counts[0]:
+            outfp.write('{')
+
+        # Close the groups that do not contain this one
+        path = key if group is None else key[:-1]
+        common = 0
+        while (common < len(stack) and common < len(path) and
+               stack[common] == path[common]):
+            common += 1
+        while len(stack) > common:
+            stack.pop()
+            if counts.pop():
+                newline(len(stack) + 1)
+            outfp.write('}')
+
+        # Open the groups that contain this one
+        for name in path[common:]:
+            if counts[-1]:
+                outfp.write(separator)
+            counts[-1] += 1
+            newline(len(stack) + 1)
+            outfp.write('%s: {' % json.dumps(name))
+            stack.append(name)
+            counts.append(0)
+
+        if group is not None:
+            if counts[-1]:
+                outfp.write(separator)
+            counts[-1] += 1
+            newline(len(stack) + 1)
+            text = json.dumps(group, indent=indent, sort_keys=pretty,
+                              default=default)
+            if pretty:
+                text = text.replace('\n', '\n' + ' ' * 4 * (len(stack) + 1))
+            outfp.write('%s: %s' % (json.dumps(key[-1]), text))
+
+    if not counts[0]:
+        outfp.write('{}')
+        return
+    while stack:
+        stack.pop()
+        if counts.pop():
+            newline(len(stack) + 1)
+        outfp.write('}')
+    newline(0)
+    outfp.write('}')
+
+def write_store(items, path, dtype='float64'):
+    ''' Write the sorted (key, group) @items as a store at @path '''
+    writer = histstore.Writer(path, dtype)
+    for key, group in items:
+        writer.group(list(key))
+        if group is not None:
+            writer.add_tree(list(key), group)
+    writer.close()
@@ -0,0 +1,193 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Columnar store of histograms.  The nested dictionaries built by
+ hist_build.py, hist.py and tool.py -H are saved as a directory with
+ the typed arrays of all the lists packed in one data file, and an
+ index with the same tree, where each list is replaced by the type,
+ offset and length of its array.  Readers memory-map the data and
+ only touch the arrays they select, so load time and memory scale
+ with the selection rather than with the whole dataset.
+
+ Lists of integers, e.g. the codes of histcode.py and the buckets of
+ sketch.py, become int64 arrays, so that they are stored exactly.  The
+ other numeric lists, i.e. the measurements, and arrays of doubles
+ (see histleaf.py), become float64 (or float32) arrays, where None is
+ NaN; lists of strings become arrays of UTF-8 bytes.
+
+ NumPy is imported only when a store is written or read, so that the
+ tools that use this module need it only to handle stores.
+'''
+
+import array
+import collections.abc
+import json
+import os
+
+INDEX = 'index.json'
+DATA = 'columns.bin'
+
+# Arrays start at multiples of this
+ALIGN = 8
+
+def to_array(values, dtype='float64'):
+    ''' Convert the list @values into an array of @dtype or strings '''
+    import numpy
+    if isinstance(values, array.array):
+        return numpy.frombuffer(values, dtype=values.typecode).astype(dtype)
+    if values and all(isinstance(value, int) for value in values):
+        return numpy.array(values, dtype=numpy.int64)
+    if all(value is None or isinstance(value, (int, float))
+           for value in values):
+        return numpy.array([numpy.nan if value is None else value
+                            for value in values], dtype=dtype)
+    if all(value is None or isinstance(value, str) for value in values):
+        return numpy.array([(value or '').encode('utf-8')
+                            for value in values], dtype=bytes)
+    raise RuntimeError('Cannot store mixed list')
+
+class Writer(object):
+
+    '''
+     Writes the store at @path, which is created if needed.  Lists
+     of measurements are converted to arrays of @dtype (float64 or
+     float32), and lists of integers to int64 arrays.  The index is
+     written by close(), so that readers never see a store that is
+     only partially written.
+    '''
+
+    def __init__(self, path, dtype='float64'):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.dtype = dtype
+        self.tree = {}
+        self.filep = open(os.path.join(path, DATA), 'wb')
+        self.offset = 0
+
+    def __node(self, keys):
+        ''' Return the index node at @keys, creating it if needed '''
+        node = self.tree
+        for key in keys:
+            node = node.setdefault(str(key), {})
+        return node
+
+    def add(self, keys, values):
+        ''' Save the list @values at the path @keys of the tree '''
+        import numpy
+        array = values
+        if not isinstance(array, numpy.ndarray):
+            array = to_array(values, self.dtype)
+        padding = -self.offset % ALIGN
+        self.filep.write(b'\0' * padding)
+        self.offset += padding
+        self.filep.write(array.tobytes())
+        self.__node(keys[:-1])[str(keys[-1])] = [array.dtype.str,
+          self.offset, len(array)]
+        self.offset += array.nbytes
+
+    def group(self, keys):
+        ''' Create the group at the path @keys, even if it stays empty '''
+        self.__node(keys)
+
+    def set(self, keys, value):
+        ''' Save the scalar @value at the path @keys of the tree '''
+        self.__node(keys[:-1])[str(keys[-1])] = value
+
+    def add_tree(self, keys, tree):
+        ''' Save the lists and scalars of @tree under the path @keys '''
+        for key, value in tree.items():
+            if isinstance(value, collections.abc.Mapping):
+                self.group(keys + [key])
+                self.add_tree(keys + [key], value)
+            elif (isinstance(value, (list, array.array)) or
+                  type(value).__name__ == 'ndarray'):
+                self.add(keys + [key], value)
+            else:
+                self.set(keys + [key], value)
+
+    def close(self):
+        ''' Flush the data and write the index '''
+        self.filep.close()
+        temporary = os.path.join(self.path, INDEX + '.new')
+        with open(temporary, 'w') as filep:
+            json.dump(self.tree, filep, separators=(',', ':'))
+        os.rename(temporary, os.path.join(self.path, INDEX))
+
+def write(tree, path, dtype='float64'):
+    ''' Save the nested dictionary @tree as a store at @path '''
+    writer = Writer(path, dtype)
+    writer.add_tree([], tree)
+    writer.close()
+
+class Node(collections.abc.Mapping):
+
+    '''
+     Read-only view of a subtree of the store @data, whose @index
+     is a subtree of the index.  Arrays are views on the memory
+     mapped data, and are created only when accessed.
+    '''
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    def __getitem__(self, key):
+        value = self.index[str(key)]
+        if isinstance(value, dict):
+            return Node(self.data, value)
+        if isinstance(value, list):
+            import numpy
+            dtype, offset, length = value
+            return numpy.frombuffer(self.data, dtype=numpy.dtype(dtype),
+                                    count=length, offset=offset)
+        return value
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+def is_store(path):
+    ''' Whether @path is a store rather than a JSON file '''
+    return os.path.isfile(os.path.join(path, INDEX))
+
+def open_store(path):
+    ''' Return the root Node of the store at @path '''
+    import numpy
+    with open(os.path.join(path, INDEX), 'r') as filep:
+        index = json.load(filep)
+    data = os.path.join(path, DATA)
+    if os.path.getsize(data):
+        data = numpy.memmap(data, dtype=numpy.uint8, mode='r')
+    else:
+        data = b''
+    return Node(data, index)
+
+def load(path):
+    ''' Load the histograms at @path, either a store or JSON '''
+    if is_store(path):
+        return open_store(path)
+    with open(path, 'r') as filep:
+        return json.load(filep)
+
+def select(tree, selection):
+    ''' Return the subtree of @tree at @selection, e.g. /Turin/rtt '''
+    for key in selection.split('/')[1:]:
+        tree = tree[key]
+    return tree
@@ -16,15 +16,25 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
-''' Info on Neubot database '''
+'''
+ Info on Neubot databases.  The info on many databases is computed
+ by a pool of processes and written as one JSON record per line.
+'''
 
+import functools
 import getopt
 import json
+import multiprocessing
+import os
 import sqlite3
 import sys
 import syslog
 import time
 
+from urllib.request import pathname2url
+
+import summary
+
 def __info_config(connection):
     ''' Returns config table content information '''
     dictionary = {}
@@ -34,125 +44,111 @@ def __info_config(connection):
         dictionary[name] = value
     return dictionary
 
-def __info_uuids(connection, table):
-    ''' How many unique uuids in table '''
-    cursor = connection.cursor()
-    cursor.execute('SELECT COUNT(DISTINCT(uuid)) FROM %s;' % table)
-    count = next(cursor)[0]
-    if not count:
-        return 0
-    return count
-
-def __info_tests(connection, table):
-    ''' How many tests in table '''
-    cursor = connection.cursor()
-    cursor.execute('SELECT COUNT(*) FROM %s;' % table)
-    count = next(cursor)[0]
-    if not count:
-        return 0
-    return count
-
-def __info_publishable(connection, table):
-    ''' How many publishable tests '''
-    cursor = connection.cursor()
-    cursor.execute('''SELECT COUNT(*) FROM %s
-      WHERE privacy_can_publish=1;''' % table)
-    count = next(cursor)[0]
-    if not count:
-        return 0
-    return count
-
-def __info_geolocated(connection, table):
-    ''' Tells whether the database is geolocated '''
-    cursor = connection.cursor()
-    cursor.execute('SELECT * FROM %s LIMIT 1;' % table)
-    for description in cursor.description:
-        if description[0] == 'city':
-            return True
-    return False
-
-def __info_anonymized(connection, table):
-    ''' Tells whether the database is anonimized '''
-    cursor = connection.cursor()
-    cursor.execute('''SELECT COUNT(*) FROM %s WHERE privacy_can_publish = 0
-      AND (real_address != '0.0.0.0' OR internal_address != '0.0.0.0');'''
-      % table)
-    count = next(cursor)[0]
-    return count == 0
-
-def __info_test_first(connection, table):
-    ''' Timestamp of first test '''
-    cursor = connection.cursor()
-    cursor.execute('SELECT MIN(timestamp) FROM %s;' % table)
-    minimum = next(cursor)[0]
-    if not minimum:
-        return 0
-    return minimum
-
-def __info_test_last(connection, table):
-    ''' Timestamp of last test '''
-    cursor = connection.cursor()
-    cursor.execute('SELECT MAX(timestamp) FROM %s;' % table)
-    maximum = next(cursor)[0]
-    if not maximum:
-        return 0
-    return maximum
-
 def __format_date(thedate):
     ''' Make a timestamp much more readable '''
     return time.ctime(int(thedate))
 
+def __info_file(pretty, path):
+
+    '''
+     Return the info on the database at @path.  Errors are reported
+     into the info itself, so that one bad file does not stop a run
+     over the whole archive.  The database is opened read-only, so
+     that a missing file is an error rather than a new database.
+    '''
+
+    try:
+        connection = sqlite3.connect('file:%s?mode=ro' %
+                                     pathname2url(os.path.abspath(path)),
+                                     uri=True)
+
+        dictionary = __info_config(connection)
+        dictionary['filename'] = path
+
+        for table in ('speedtest', 'bittorrent'):
+            counters = summary.table_summary(connection, table)
+            dictionary[table] = {}
+            dictionary[table]['count_uuids'] = counters['uuids']
+            dictionary[table]['count_tests'] = counters['tests']
+            dictionary[table]['count_tests_publishable'] = \
+                                                    counters['publishable']
+            dictionary[table]['geolocated'] = summary.is_geolocated(
+                                                    connection, table)
+            dictionary[table]['anonymized'] = counters['not_anonymized'] == 0
+
+            first = counters['first']
+            last = counters['last']
+
+            if pretty:
+                first = __format_date(first)
+                last = __format_date(last)
+
+            dictionary[table]['first'] = first
+            dictionary[table]['last'] = last
+
+        connection.close()
+
+    except sqlite3.Error as error:
+        syslog.syslog(syslog.LOG_WARNING, '%s: %s' % (path, error))
+        return {'filename': path, 'error': str(error)}
+
+    return dictionary
+
+USAGE = 'Usage: info.py [-r] [-j workers] [-o file] file...'
+
 def main():
 
-    ''' Info on Neubot database '''
+    ''' Info on Neubot databases '''
 
     syslog.openlog('info.py', syslog.LOG_PERROR, syslog.LOG_USER)
     outfp = sys.stdout
     pretty = True
+    workers = 0
 
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'ro:')
+        options, arguments = getopt.getopt(sys.argv[1:], 'j:ro:')
     except getopt.error:
-        sys.exit('Usage: info.py [-r] [-o file] file')
-    if len(arguments) != 1:
-        sys.exit('Usage: info.py [-r] [-o file] file')
+        sys.exit(USAGE)
+    if not arguments:
+        sys.exit(USAGE)
 
     for name, value in options:
-        if name == '-r':
+        if name == '-j':
+            workers = int(value)
+        elif name == '-r':
             pretty = False
         elif name == '-o':
             outfp = open(value, 'w')
 
-    connection = sqlite3.connect(arguments[0])
-
-    dictionary = __info_config(connection)
-    dictionary['filename'] = arguments[0]
-
-    for table in ('speedtest', 'bittorrent'):
-        dictionary[table] = {}
-        dictionary[table]['count_uuids'] = __info_uuids(connection, table)
-        dictionary[table]['count_tests'] = __info_tests(connection, table)
-        dictionary[table]['count_tests_publishable'] = \
-                                          __info_publishable(connection, table)
-        dictionary[table]['geolocated'] = __info_geolocated(connection, table)
-        dictionary[table]['anonymized'] = __info_anonymized(connection, table)
-
-        first = __info_test_first(connection, table)
-        last = __info_test_last(connection, table)
-
-        if pretty:
-            first = __format_date(first)
-            last = __format_date(last)
-
-        dictionary[table]['first'] = first
-        dictionary[table]['last'] = last
-
+    #
+    # One file is printed as always.  Many files are written as
+    # NDJSON, i.e. one compact record per line, so that the output
+    # of a run over the whole archive is machine-readable; without
+    # -r the dates of the records are still human-readable.
+    #
     indent, sort_keys = None, False
-    if pretty:
+    if pretty and len(arguments) == 1:
         indent, sort_keys = 4, True
-    json.dump(dictionary, outfp, indent=indent, sort_keys=sort_keys)
-    if pretty:
-        outfp.write("\n")
+
+    function = functools.partial(__info_file, pretty)
+    pool = None
+    if len(arguments) == 1 or workers == 1:
+        records = map(function, arguments)
+    else:
+        pool = multiprocessing.Pool(workers or None)
+        records = pool.imap(function, arguments)
+
+    try:
+        for dictionary in records:
+            json.dump(dictionary, outfp, indent=indent, sort_keys=sort_keys)
+            outfp.write("\n")
+            outfp.flush()
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
 
 if __name__ == '__main__':
     main()
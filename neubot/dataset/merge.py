@@ -18,17 +18,23 @@
 
 ''' Merge Neubot databases '''
 
-import atexit
-import bz2
+import functools
 import getopt
 import os
 import sqlite3
 import sys
 import syslog
-import tempfile
+import time
 
 sys.path.insert(0, '../neubot')
 
+import catalog
+import copytable
+import dumpcache
+import dumps
+import mergestats
+import pipeline
+
 from neubot.database import DatabaseManager
 from neubot.database import migrate
 from neubot.database import migrate2
@@ -38,17 +44,18 @@ from neubot.log import LOG
 # sqlite3
 # =======
 
-def __sqlite3_cleanup(*args):
-    ''' Cleanups temporary files '''
-    syslog.syslog(syslog.LOG_INFO, 'Cleanup: %s' % args[0])
-    os.unlink(args[0])
-
-def __sqlite3_connect(path):
+def __sqlite3_connect(path, memory_limit=0, cache=None, cap=0, stats=None,
+                      origin=None):
 
     '''
      Return a connection to the database at @path.  This function
      takes care of the cases when the database does not exist or
-     it is compressed and/or needs to be migrated.
+     it is compressed and/or needs to be migrated.  Compressed
+     databases are taken from the @cache directory, if any, whose
+     size is capped at @cap bytes, or decompressed into memory if
+     smaller than @memory_limit bytes.  Decompression and migration
+     are accounted into @stats.  The version of the database before
+     migration is stored into the @origin dictionary, if any.
     '''
 
     # Create new database if nonexistent
@@ -60,28 +67,18 @@ def __sqlite3_connect(path):
         connection.commit()
         return connection
 
-    # Decompress the database if needed
-    if path.endswith('.bz2'):
-        inputfp = bz2.BZ2File(path)
-        outputfp, npath = tempfile.mkstemp(suffix='.sqlite3', dir='.')
-        syslog.syslog(syslog.LOG_INFO, 'Bunzip2: %s -> %s' % (path, npath))
-        outputfp = os.fdopen(outputfp, 'w')
-        atexit.register(__sqlite3_cleanup, npath)
-        chunk = inputfp.read(262144)
-        while chunk:
-            outputfp.write(chunk)
-            chunk = inputfp.read(262144)
-        outputfp.close()
-        inputfp.close()
-    else:
-        npath = path
-
-    # Migrate to the latest version
-    syslog.syslog(syslog.LOG_INFO, 'Open existing: %s' % npath)
-    connection = sqlite3.connect(npath)
+    # Decompress the database if needed and migrate to the latest version
+    if cache:
+        path = dumpcache.get(cache, path, cap, stats=stats, origin=origin)
+    syslog.syslog(syslog.LOG_INFO, 'Open existing: %s' % path)
+    connection = dumps.connect(path, memory_limit, stats)
     connection.row_factory = sqlite3.Row
+    if origin is not None:
+        origin.setdefault('version', catalog.schema_version(connection))
+    ticks = time.time()
     migrate.migrate(connection)
     migrate2.migrate(connection)
+    mergestats.add(stats, 'migrate', time.time() - ticks)
     return connection
 
 # ======
@@ -92,7 +89,7 @@ def __lookup_last(connection, table):
     ''' Get the timestamp of the last test '''
     cursor = connection.cursor()
     cursor.execute('SELECT MAX(timestamp) FROM %s;' % table)
-    maximum = cursor.next()[0]
+    maximum = next(cursor)[0]
     if not maximum:
         return 0
     return maximum
@@ -114,58 +111,209 @@ def __construct_query(table, template):
     vector[-1] = ');'
     return ''.join(vector)
 
-def __copy_table(source, destination, table, beginning):
-    ''' Copy all the results after @beginning '''
+def __copy_table(source, destination, table, beginning, stats=None):
+    ''' Copy all the results after @beginning, return count '''
     query = None
+    ticks = time.time()
     cursor = source.cursor()
     cursor.execute('SELECT * FROM %s WHERE timestamp > ?;'
                    % table, (beginning,))
     count = 0
+    inserting = 0.0
     for result in cursor:
         result = dict(result)
         # Do NOT copy the original row ID
         del result['id']
         if not query:
             query = __construct_query(table, result)
+        started = time.time()
         destination.execute(query, result)
+        inserting += time.time() - started
         count = count + 1
-    syslog.syslog(syslog.LOG_INFO, 'Merged %s tuples from %s' % (count, table))
+    started = time.time()
     destination.commit()
+    inserting += time.time() - started
+    mergestats.add(stats, 'scan', time.time() - ticks - inserting,
+                   rows_read=count)
+    mergestats.add(stats, 'insert', inserting, rows_inserted=count,
+                   rows_skipped=0)
+    return count
 
 # ====
 # main
 # ====
 
+def __unchanged(catalogdb, digests, path, identity):
+
+    '''
+     Return True if the input at @path was already merged into the
+     output database, whose catalog id is @identity, and did not
+     change since then.  Remember its checksum into @digests for
+     later use.
+    '''
+
+    digests[path] = catalog.fingerprint(catalogdb, path)
+    if catalog.is_merged(catalogdb, digests[path], identity):
+        syslog.syslog(syslog.LOG_INFO, 'Unchanged: %s' % path)
+        return True
+    return False
+
+def __catalog_record(catalogdb, digests, identity, path, connection,
+                     version):
+    ''' Record the just merged input at @path into the catalog '''
+    catalog.record(catalogdb, path, digests[path], connection, version)
+    catalog.mark_merged(catalogdb, digests[path], identity)
+
+USAGE = '''\
+Usage: merge.py [-BKv] [-c cachedir] [-C catalog] [-j workers]
+                [-m megabytes] [-o output] [-Q depth] [--stats file]
+                [-z megabytes] file...'''
+
 def main():
 
     ''' Merge Neubot databases '''
 
     syslog.openlog('merge.py', syslog.LOG_PERROR, syslog.LOG_USER)
     output = 'database.sqlite3'
+    bulk = False
+    dedup = False
+    workers = 0
+    depth = pipeline.DEPTH
+    catalogdb = None
+    memory_limit = 0
+    cache = None
+    cap = dumpcache.CAP * dumps.MEGABYTE
+    statsfile = None
 
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'o:v')
+        options, arguments = getopt.getopt(sys.argv[1:], 'Bc:C:Kj:m:o:Q:vz:',
+                                           ['stats='])
     except getopt.error:
-        sys.exit('Usage: merge.py [-v] [-o output] file...')
+        sys.exit(USAGE)
     if not arguments:
-        sys.exit('Usage: merge.py [-v] [-o output] file...')
+        sys.exit(USAGE)
 
     for name, value in options:
-        if name == '-o':
+        if name == '-B':
+            bulk = True
+        elif name == '-c':
+            cache = value
+        elif name == '-C':
+            catalogdb = catalog.connect(value)
+        elif name == '-K':
+            dedup = True
+        elif name == '-j':
+            workers = int(value)
+        elif name == '-m':
+            memory_limit = int(value) * dumps.MEGABYTE
+        elif name == '-Q':
+            depth = int(value)
+        elif name == '-o':
             output = value
         elif value == '-v':
             LOG.verbose()
+        elif name == '-z':
+            cap = int(value) * dumps.MEGABYTE
+        elif name == '--stats':
+            statsfile = value
 
     beginning = {}
+    total_count, total_elapsed = 0, 0.0
+    reports = [] if statsfile else None
     destination = __sqlite3_connect(output)
+
+    #
+    # With -C skip the inputs that the catalog says were already
+    # merged into this output and that did not change since.  The
+    # output is identified by the id in its config table, so that
+    # a removed or restored output is merged into from scratch.
+    #
+    digests, identity = {}, None
+    if catalogdb:
+        identity = catalog.destination_id(catalogdb, destination)
+        arguments = [argument for argument in arguments if not
+                     __unchanged(catalogdb, digests, argument, identity)]
+
+    #
+    # With -j the sources are decompressed, migrated and read by
+    # a pool of processes while we write.  This implies -K.
+    #
+    if workers:
+        ticks = time.time()
+        def done(path, ready, version):
+            ''' Record the just merged input into the catalog '''
+            if catalogdb:
+                connection = pipeline.connect(ready)
+                __catalog_record(catalogdb, digests, identity, path,
+                                 connection, version)
+                connection.close()
+
+        count = pipeline.merge(arguments, destination,
+                               functools.partial(__sqlite3_connect,
+                               memory_limit=memory_limit, cache=cache,
+                               cap=cap), workers, depth, done, reports)
+        elapsed = time.time() - ticks
+        syslog.syslog(syslog.LOG_INFO, 'Merged %d tuples in %.3f s (%.1f '
+          'rows/s, %d workers)' % (count, elapsed, copytable.rate(count,
+          elapsed), workers))
+        if statsfile:
+            mergestats.dump(reports, statsfile)
+        return
+
+    #
+    # With -K we do not use the MAX(timestamp) watermark: every
+    # row is offered to the destination and the unique test key
+    # drops the ones we already have, so that late-arriving and
+    # overlapping sources can be merged in any order.
+    #
+    if dedup:
+        for table in ('speedtest', 'bittorrent'):
+            copytable.ensure_key(destination, table)
+
     for argument in arguments:
-        source = __sqlite3_connect(argument)
+        stats = mergestats.new(argument) if statsfile else None
+        origin = {}
+        source = __sqlite3_connect(argument, memory_limit, cache, cap, stats,
+                                   origin)
         for table in ('speedtest', 'bittorrent'):
-            # Just in case there are overlapping measurements
-            beginning[table] = __lookup_last(destination, table)
-            __copy_table(source, destination, table, beginning[table])
+            if dedup:
+                beginning[table] = None
+            else:
+                # Just in case there are overlapping measurements
+                beginning[table] = __lookup_last(destination, table)
+            ticks = time.time()
+            if bulk:
+                count = copytable.copy_table(source, destination, table,
+                                             beginning[table], ignore=dedup,
+                                             stats=stats)
+            elif dedup:
+                count = copytable.copy_batched(source, destination, table,
+                                               None, ignore=True, stats=stats)
+            else:
+                count = __copy_table(source, destination, table,
+                                     beginning[table], stats)
+            elapsed = time.time() - ticks
+            syslog.syslog(syslog.LOG_INFO, 'Merged %d tuples from %s in %.3f '
+              's (%.1f rows/s)' % (count, table, elapsed,
+              copytable.rate(count, elapsed)))
+            total_count += count
+            total_elapsed += elapsed
+
+        if catalogdb:
+            __catalog_record(catalogdb, digests, identity, argument,
+                             source, origin.get('version'))
+        if stats is not None:
+            reports.append(stats)
 
     destination.commit()
 
+    # So that bulk and per-row runs can be compared
+    syslog.syslog(syslog.LOG_INFO, 'Merged %d tuples in %.3f s (%.1f rows/s, '
+      '%s mode)' % (total_count, total_elapsed, copytable.rate(total_count,
+      total_elapsed), 'bulk' if bulk else 'batched' if dedup else 'per-row'))
+
+    if statsfile:
+        mergestats.dump(reports, statsfile)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Per-input and per-stage statistics of merge runs.  The stats of an
+ input are a plain dictionary, so that they can travel between
+ processes, and all functions accept None meaning "do not collect".
+
+ Stages are decompress (bytes), migrate, scan (rows_read) and insert
+ (rows_inserted, rows_skipped as duplicates).
+'''
+
+import json
+import sys
+
+STAGES = ('decompress', 'migrate', 'scan', 'insert')
+
+def new(path):
+    ''' Return empty stats for the input at @path '''
+    return {'input': path, 'stages': {}}
+
+def add(stats, stage, elapsed, **counters):
+    ''' Account @elapsed seconds and @counters to @stage of @stats '''
+    if stats is None:
+        return
+    entry = stats['stages'].setdefault(stage, {'wall': 0.0})
+    entry['wall'] += elapsed
+    for name, value in counters.items():
+        entry[name] = entry.get(name, 0) + value
+
+def __rate(entry):
+    ''' Add rows per second to the stage @entry '''
+    rows = (entry.get('rows_read', 0) + entry.get('rows_inserted', 0) +
+            entry.get('rows_skipped', 0))
+    if rows and entry['wall'] > 0:
+        entry['rows_per_second'] = rows / entry['wall']
+
+def report(inputs):
+
+    '''
+     Return the report for the list of stats @inputs, i.e. the
+     stats themselves with rows per second and the total per stage.
+    '''
+
+    total = new(None)
+    for stats in inputs:
+        for stage, entry in stats['stages'].items():
+            counters = dict(entry)
+            add(total, stage, counters.pop('wall'), **counters)
+            __rate(entry)
+    for entry in total['stages'].values():
+        __rate(entry)
+    del total['input']
+
+    return {'inputs': inputs, 'total': total}
+
+def dump(inputs, path):
+    ''' Write the report for @inputs as JSON into @path ('-' is stdout) '''
+    if path == '-':
+        outfp = sys.stdout
+    else:
+        outfp = open(path, 'w')
+    json.dump(report(inputs), outfp, indent=4, sort_keys=True)
+    outfp.write('\n')
+    if outfp is not sys.stdout:
+        outfp.close()
@@ -0,0 +1,210 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Pipelined merge of many Neubot databases.  A pool of reader
+ processes decompresses and migrates the sources, and hands the
+ ready databases (a path, or the serialized bytes of an in-memory
+ database) through a bounded queue to a single writer, i.e. the
+ calling process, which copies each of them inside SQLite with one
+ INSERT ... SELECT per table.
+
+ Since sources are consumed in no particular order, the pipeline
+ always relies on the unique test key (see copytable.ensure_key())
+ rather than on the timestamp watermark.
+'''
+
+import multiprocessing
+import os
+import queue
+import sqlite3
+import syslog
+import time
+
+import copytable
+import dumpcache
+import dumps
+import mergestats
+
+# Default number of ready databases that may wait in the queue
+DEPTH = 4
+
+TABLES = ('speedtest', 'bittorrent')
+
+def __reader(opener, collect, tasks, results):
+
+    '''
+     Reader process body.  Take paths from @tasks, open them with
+     @opener and put the ready database onto @results.
+     The @opener returns None for sources that must be skipped, and
+     may return a connection to a temporary copy of the path, which
+     the writer removes once copied.  When @collect is True, the
+     stats filled by @opener travel along with the ready database,
+     and so does, always, the version of the source before it was
+     migrated, which @opener stores into its origin dictionary.
+     Cached copies are leased to the writer, i.e. our parent, which
+     releases them once copied.
+    '''
+
+    dumpcache.CONSUMER = os.getppid()
+    while True:
+        path = tasks.get()
+        if path is None:
+            break
+
+        stats = mergestats.new(path) if collect else None
+        origin = {}
+        before = set(dumps.TEMPORARY)
+        try:
+            source = opener(path, stats=stats, origin=origin)
+            ready, temporary = None, False
+            if source is not None:
+                ready = copytable.database_path(source)
+                if ready:
+                    temporary = dumps.is_temporary(ready)
+                else:
+                    ticks = time.time()
+                    ready = source.serialize()
+                    mergestats.add(stats, 'scan', time.time() - ticks)
+                source.close()
+        except Exception as error:
+            # This process exits without running its atexit handlers
+            for npath in dumps.TEMPORARY - before:
+                if os.path.exists(npath):
+                    os.unlink(npath)
+            results.put((path, None, False, str(error), None, None))
+            continue
+
+        results.put((path, ready, temporary, None, stats,
+                     origin.get('version')))
+
+    results.put(None)
+
+def __drain(tasks, results, pending):
+
+    '''
+     Stop the @pending readers after a failure.  The paths not yet
+     taken are dropped, and the temporary copies that the readers
+     have already made are removed, because readers exit without
+     running their atexit handlers.
+    '''
+
+    try:
+        while True:
+            tasks.get_nowait()
+    except queue.Empty:
+        pass
+    for _ in range(pending):
+        tasks.put(None)
+
+    while pending:
+        item = results.get()
+        if item is None:
+            pending -= 1
+        elif item[2]:
+            os.unlink(item[1])
+        elif isinstance(item[1], str):
+            dumpcache.release(item[1])
+
+def connect(ready):
+    ''' Return a connection to a @ready database as passed to done() '''
+    if isinstance(ready, bytes):
+        connection = sqlite3.connect(':memory:')
+        connection.deserialize(ready)
+        return connection
+    return sqlite3.connect(ready)
+
+def merge(paths, destination, opener, workers=None, depth=DEPTH,
+          done=None, reports=None):
+
+    '''
+     Merge the databases at @paths into @destination using @workers
+     reader processes (by default one per CPU) that call @opener to
+     get a migrated connection for each path.  At most @depth ready
+     databases wait in the queue, which bounds the disk space used
+     by temporary copies.  If not None, @done is invoked with the
+     path, the ready database and the version of the source before
+     migration after each copy.  The @opener receives the stats of
+     the path and the origin dictionary, where it stores the version,
+     as keyword arguments, and, if @reports is not None, the stats
+     of each path are appended to it.
+     Returns the number of inserted rows.
+    '''
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+
+    for table in TABLES:
+        copytable.ensure_key(destination, table)
+
+    tasks = multiprocessing.Queue()
+    for path in paths:
+        tasks.put(path)
+    for _ in range(workers):
+        tasks.put(None)
+
+    results = multiprocessing.Queue(depth)
+    readers = []
+    for _ in range(workers):
+        reader = multiprocessing.Process(target=__reader,
+                                         args=(opener, reports is not None,
+                                               tasks, results))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+
+    count = 0
+    pending = workers
+    try:
+        while pending:
+            item = results.get()
+            if item is None:
+                pending -= 1
+                continue
+
+            path, ready, temporary, error, stats, version = item
+            if error is not None:
+                raise RuntimeError('Cannot read %s: %s' % (path, error))
+            if not ready:
+                syslog.syslog(syslog.LOG_WARNING, 'Skipped: %s' % path)
+                continue
+
+            try:
+                for table in TABLES:
+                    count += copytable.copy_attached(ready, destination,
+                                                     table, None, True,
+                                                     stats)
+                if stats is not None:
+                    reports.append(stats)
+
+                if done:
+                    done(path, ready, version)
+            finally:
+                if temporary:
+                    os.unlink(ready)
+                elif isinstance(ready, str):
+                    dumpcache.release(ready)
+
+            syslog.syslog(syslog.LOG_INFO, 'Done: %s' % path)
+
+    finally:
+        if pending:
+            __drain(tasks, results, pending)
+
+    for reader in readers:
+        reader.join()
+
+    return count
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Prepare Neubot databases for analysis.  Creates the indexes that
+ turn the time range, uuid, privacy and geolocation queries of the
+ analysis scripts into index lookups, and runs ANALYZE so that the
+ query planner knows about them.  Preparing twice is harmless.
+
+ Do not prepare merge destinations: each index slows down inserts.
+'''
+
+import getopt
+import sqlite3
+import sys
+import syslog
+
+import copytable
+
+TABLES = ('speedtest', 'bittorrent')
+
+# Index suffix and columns; the timestamp index also covers count.py
+INDEXES = (
+    ('timestamp', ('timestamp', 'uuid')),
+    ('uuid', ('uuid',)),
+    ('privacy', ('privacy_can_publish', 'timestamp')),
+    ('country_code', ('country_code',)),
+    ('city', ('city',)),
+    ('asname', ('asname',)),
+)
+
+def create_indexes(connection, table):
+
+    '''
+     Create the analysis indexes of @table in the database referenced
+     by @connection, unless they already exist.  Indexes on columns
+     that @table does not have (e.g. it is not geolocated) are skipped.
+     Returns the names of the indexes of @table.
+    '''
+
+    columns = copytable.table_columns(connection, table)
+    names = []
+    for suffix, indexed in INDEXES:
+        if [name for name in indexed if name not in columns]:
+            continue
+        name = '%s_%s' % (copytable.sanitize(table), suffix)
+        connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s);' %
+          (name, copytable.sanitize(table), ', '.join(indexed)))
+        names.append(name)
+    return names
+
+def index_space(connection, names):
+
+    '''
+     Return a dictionary that maps the indexes in @names to the bytes
+     they use, or None if this SQLite lacks the dbstat table.
+    '''
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT name, SUM(pgsize) FROM dbstat GROUP BY name;')
+        space = dict(cursor.fetchall())
+    except sqlite3.OperationalError:
+        return None
+    return dict((name, space.get(name, 0)) for name in names)
+
+def prepare(connection, tables=TABLES):
+
+    '''
+     Create the analysis indexes of @tables in the database referenced
+     by @connection and refresh the planner statistics.  Returns what
+     index_space() returns for the analysis indexes.
+    '''
+
+    names = []
+    for table in tables:
+        names.extend(create_indexes(connection, table))
+    connection.execute('ANALYZE;')
+    connection.commit()
+    return index_space(connection, names)
+
+def report(path, space):
+    ''' Log the space used by the indexes of the database at @path '''
+    if space is None:
+        syslog.syslog(syslog.LOG_WARNING, '%s: cannot measure the space '
+                      'used by indexes (no dbstat)' % path)
+        return
+    for name in sorted(space):
+        syslog.syslog(syslog.LOG_INFO, '%s: %s uses %d bytes' %
+                      (path, name, space[name]))
+    syslog.syslog(syslog.LOG_INFO, '%s: indexes use %d bytes' %
+                  (path, sum(space.values())))
+
+USAGE = 'Usage: prepare.py file...'
+
+def main():
+
+    ''' Prepare Neubot databases for analysis '''
+
+    syslog.openlog('prepare.py', syslog.LOG_PERROR, syslog.LOG_USER)
+
+    try:
+        arguments = getopt.getopt(sys.argv[1:], '')[1]
+    except getopt.error:
+        sys.exit(USAGE)
+    if not arguments:
+        sys.exit(USAGE)
+
+    for argument in arguments:
+        if argument.endswith('.bz2'):
+            raise RuntimeError('Cannot prepare compressed database')
+        syslog.syslog(syslog.LOG_INFO, 'Prepare: %s' % argument)
+        connection = sqlite3.connect(argument)
+        report(argument, prepare(connection))
+        connection.close()
+
+if __name__ == '__main__':
+    main()
@@ -24,52 +24,83 @@ import sys
 import syslog
 import zipfile
 
+import copyout
+import copytable
+
+TABLES = ('speedtest', 'bittorrent')
+
+# Do not disclose bits of maxmind database
+HIDDEN = "CASE WHEN privacy_can_publish != 0 THEN '' ELSE %s END"
+
+USAGE = 'Usage: publish.py [-n] [-o output] file'
+
 def main():
 
     ''' Publish Neubot database '''
 
     syslog.openlog('publish.py', syslog.LOG_PERROR, syslog.LOG_USER)
     compress = True
+    output = None
 
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'n')
+        options, arguments = getopt.getopt(sys.argv[1:], 'no:')
     except getopt.error:
-        sys.exit('Usage: info.py file')
+        sys.exit(USAGE)
     if len(arguments) != 1:
-        sys.exit('Usage: info.py file')
+        sys.exit(USAGE)
 
-    for tpl in options:
-        if tpl[0] == '-n':
+    for name, value in options:
+        if name == '-n':
             compress = False
+        elif name == '-o':
+            output = value
 
     connection = sqlite3.connect(arguments[0])
-    for table in ('speedtest', 'bittorrent'):
+    for table in TABLES:
 
         # Check real and internal address
         cursor = connection.cursor()
-        cursor.execute('''SELECT COUNT(*) FROM %s WHERE privacy_can_publish != 1
-          AND (real_address != '0.0.0.0' OR internal_address != '0.0.0.0');'''
-           % table)
+        cursor.execute('''SELECT COUNT(*) FROM %s WHERE privacy_can_publish
+          != 1 AND (real_address != '0.0.0.0' OR internal_address
+          != '0.0.0.0');''' % table)
         count = next(cursor)[0]
         if count > 0:
             raise RuntimeError('Not properly anonymized')
 
-        # Do not disclose bits of maxmind database
-        connection.execute('''UPDATE %s SET city='', asname='', country_code=''
-           WHERE privacy_can_publish != 0;''' % table)
+    #
+    # With -o the publishable rows are written once into a new
+    # database and the original one is not modified, otherwise
+    # we update in place and VACUUM, writing the database twice.
+    #
+    if output:
+        syslog.syslog(syslog.LOG_INFO, 'Output: %s' % output)
+        transforms = {}
+        for table in TABLES:
+            columns = copytable.table_columns(connection, table)
+            transforms[table] = dict((name, HIDDEN % name) for name in
+              ('city', 'asname', 'country_code') if name in columns)
+        copyout.copy_out(connection, output, transforms)
+        path = output
+
+    else:
+        for table in TABLES:
+            connection.execute('''UPDATE %s SET city='', asname='',
+              country_code='' WHERE privacy_can_publish != 0;''' % table)
 
-    # Rebuild from scratch
-    connection.execute('VACUUM;')
-    connection.commit()
+        # Rebuild from scratch (not allowed within a transaction)
+        connection.commit()
+        connection.execute('VACUUM;')
+        connection.commit()
+        path = arguments[0]
 
     if not compress:
         sys.exit(0)
 
-    dirname = arguments[0].replace('.sqlite3', '')
+    dirname = path.replace('.sqlite3', '')
     zfile = zipfile.ZipFile(dirname + '.zip', 'w', zipfile.ZIP_DEFLATED)
     zfile.write('database-skel/README-txt', '%s/README.txt' % dirname)
     zfile.write('database-skel/LICENSE-txt', '%s/LICENSE.txt' % dirname)
-    zfile.write(arguments[0], '%s/database.sqlite3' % dirname)
+    zfile.write(path, '%s/database.sqlite3' % dirname)
     zfile.close()
 
 if __name__ == '__main__':
@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Mergeable quantile sketches.  Rather than keeping every value, a
+ sketch counts the values that fall in logarithmic buckets, whose
+ bounds grow by a factor of (1 + alpha) / (1 - alpha), so that the
+ quantiles and the CDF it returns have relative error below alpha.
+ Its size depends on the range of the values, not on their number,
+ and sketches built from different databases, shards or days merge
+ exactly, by adding their counts.  Zero and negative values, which
+ have no logarithm, are counted as zeros.
+'''
+
+import collections
+import collections.abc
+import math
+
+# Default relative error
+ALPHA = 0.01
+
+# Marker of the sketches in JSON trees
+KIND = 'logbins'
+
+class Sketch(object):
+
+    ''' Quantile sketch with relative error @alpha '''
+
+    def __init__(self, alpha=ALPHA):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.bins = collections.Counter()
+        self.zeros = 0
+        self.count = 0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        ''' Add the number @value, unless it is None '''
+        if value is None:
+            return
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise RuntimeError('Cannot sketch non-number: %r' % (value,))
+        self.count += 1
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if value <= 0:
+            self.zeros += 1
+        else:
+            self.bins[int(math.ceil(math.log(value, self.gamma)))] += 1
+
+    def merge(self, other):
+        ''' Add the values of the sketch @other to this sketch '''
+        if other.alpha != self.alpha:
+            raise RuntimeError('Cannot merge sketches with different alpha')
+        self.bins.update(other.bins)
+        self.zeros += other.zeros
+        self.count += other.count
+        for value in (other.minimum, other.maximum):
+            if value is not None:
+                if self.minimum is None or value < self.minimum:
+                    self.minimum = value
+                if self.maximum is None or value > self.maximum:
+                    self.maximum = value
+        return self
+
+    def __value(self, index):
+        ''' Return the value that represents the bucket @index '''
+        value = 2 * self.gamma ** index / (self.gamma + 1)
+        return min(max(value, self.minimum), self.maximum)
+
+    def quantile(self, fraction):
+        ''' Return the quantile at @fraction, e.g. 0.5 for the median '''
+        if not self.count:
+            return None
+        rank = fraction * (self.count - 1)
+        if rank < self.zeros:
+            return self.minimum
+        seen = self.zeros
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return self.__value(index)
+        return self.maximum
+
+    def cdf(self):
+        ''' Return the points (xdata, ydata) of the CDF '''
+        xdata, ydata = [], []
+        if not self.count:
+            return xdata, ydata
+        seen = 0
+        if self.zeros:
+            seen = self.zeros
+            xdata.append(self.minimum)
+            ydata.append(seen / float(self.count))
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            xdata.append(self.__value(index))
+            ydata.append(seen / float(self.count))
+        return xdata, ydata
+
+    def to_dict(self):
+        ''' Return the JSON representation of the sketch '''
+        keys = sorted(self.bins)
+        return {
+            'sketch': KIND,
+            'alpha': self.alpha,
+            'count': self.count,
+            'zeros': self.zeros,
+            'min': self.minimum,
+            'max': self.maximum,
+            'keys': keys,
+            'counts': [self.bins[key] for key in keys],
+        }
+
+def from_dict(mapping):
+    ''' Return the sketch whose JSON representation is @mapping '''
+    result = Sketch(float(mapping['alpha']))
+    result.count = int(mapping['count'])
+    result.zeros = int(mapping['zeros'])
+    result.minimum = mapping['min']
+    result.maximum = mapping['max']
+    for key, count in zip(mapping['keys'], mapping['counts']):
+        result.bins[int(key)] = int(count)
+    return result
+
+def is_sketch(value):
+    ''' Whether @value is the JSON representation of a sketch '''
+    return (isinstance(value, collections.abc.Mapping) and
+            value.get('sketch') == KIND)
+
+def from_tree(tree):
+    ''' Return a copy of @tree where sketches are Sketch objects '''
+    if is_sketch(tree):
+        return from_dict(tree)
+    if isinstance(tree, collections.abc.Mapping):
+        return dict((key, from_tree(value)) for key, value in tree.items())
+    return tree
+
+def to_tree(tree):
+    ''' Return a copy of @tree where Sketch objects are JSON '''
+    if isinstance(tree, Sketch):
+        return tree.to_dict()
+    if isinstance(tree, dict):
+        return dict((key, to_tree(value)) for key, value in tree.items())
+    return tree
+
+def merge_tree(old, new):
+
+    '''
+     Merge the tree @new, as returned by from_tree(), into @old and
+     return it.  Both trees must hold sketches rather than values.
+    '''
+
+    for key, value in new.items():
+        if key not in old:
+            old[key] = value
+        elif isinstance(value, dict):
+            merge_tree(old[key], value)
+        elif isinstance(value, Sketch):
+            old[key].merge(value)
+        else:
+            raise RuntimeError('Cannot merge values: %s' % key)
+    return old
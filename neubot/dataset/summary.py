@@ -0,0 +1,54 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+'''
+ Summary of the tests in a Neubot database table.  All the counters
+ that info.py and tool.py -i print are computed by a single aggregate
+ query, i.e. with one scan of the table rather than one per counter.
+'''
+
+import copytable
+
+# Note: tool.py historically counts non-NULL timestamps only
+QUERY = '''SELECT COUNT(DISTINCT uuid), COUNT(*), COUNT(timestamp),
+  SUM(privacy_can_publish = 1),
+  COUNT(CASE WHEN privacy_can_publish = 1 THEN timestamp END),
+  SUM(privacy_can_publish = 0 AND (real_address != '0.0.0.0'
+    OR internal_address != '0.0.0.0')),
+  MIN(timestamp), MAX(timestamp) FROM %s;'''
+
+NAMES = ('uuids', 'tests', 'timestamped', 'publishable',
+         'publishable_timestamped', 'not_anonymized', 'first', 'last')
+
+def table_summary(connection, table):
+
+    '''
+     Return a dictionary with the counters of @table in the database
+     referenced by @connection: number of uuids, of tests (also only
+     the ones with a timestamp), of publishable tests, of tests that
+     are not publishable yet carry an address, and the timestamps of
+     the first and of the last test.  Missing values are zero.
+    '''
+
+    cursor = connection.cursor()
+    cursor.execute(QUERY % copytable.sanitize(table))
+    row = next(cursor)
+
+    return dict((name, value or 0) for name, value in zip(NAMES, row))
+
+def is_geolocated(connection, table):
+    ''' Whether @table has been geolocated '''
+    return 'city' in copytable.table_columns(connection, table)
@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+''' Regression tests for the catalog of catalog.py '''
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'neubot', 'dataset'))
+
+import catalog
+
+def create(path):
+    ''' Create a database with one test per table at @path '''
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE config (name TEXT PRIMARY KEY, '
+                       'value TEXT);')
+    connection.execute("INSERT INTO config VALUES ('version', '4.0');")
+    for table in catalog.TABLES:
+        connection.execute('CREATE TABLE %s (id INTEGER PRIMARY KEY, '
+                           'timestamp INTEGER);' % table)
+        connection.execute('INSERT INTO %s (timestamp) VALUES (1000);'
+                           % table)
+    connection.commit()
+    return connection
+
+class FingerprintTest(unittest.TestCase):
+
+    ''' Tests catalog.fingerprint() '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'input.sqlite3')
+        connection = create(self.path)
+        self.catalog = catalog.connect(':memory:')
+        self.digest = catalog.checksum(self.path)
+        catalog.record(self.catalog, self.path, self.digest, connection,
+                       catalog.schema_version(connection))
+        connection.close()
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.directory)
+
+    def test_unknown(self):
+        ''' Inputs not in the catalog are read '''
+        other = os.path.join(self.directory, 'other.sqlite3')
+        shutil.copyfile(self.path, other)
+        self.assertEqual(catalog.fingerprint(self.catalog, other),
+                         self.digest)
+
+    def test_unchanged(self):
+        ''' Inputs with the same size and mtime are not read '''
+        stat = os.stat(self.path)
+        with open(self.path, 'r+b') as filep:
+            filep.write(b'X')
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(catalog.fingerprint(self.catalog, self.path),
+                         self.digest)
+
+    def test_touched(self):
+        ''' Touched inputs are read, and then remembered '''
+        os.utime(self.path, (1, 1))
+        self.assertEqual(catalog.fingerprint(self.catalog, self.path),
+                         self.digest)
+        cursor = self.catalog.cursor()
+        cursor.execute('SELECT mtime FROM dumps;')
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_modified(self):
+        ''' Modified inputs have a new checksum '''
+        with open(self.path, 'ab') as filep:
+            filep.write(b'X')
+        self.assertNotEqual(catalog.fingerprint(self.catalog, self.path),
+                            self.digest)
+
+    def test_record(self):
+        ''' The original version and the tables are recorded '''
+        cursor = self.catalog.cursor()
+        cursor.execute('SELECT version FROM dumps;')
+        self.assertEqual(cursor.fetchone()[0], '4.0')
+        self.assertEqual(catalog.overlapping(self.catalog, 0, 2000),
+                         [os.path.realpath(self.path)])
+        self.assertEqual(catalog.overlapping(self.catalog, 2000, 3000), [])
+
+class DestinationTest(unittest.TestCase):
+
+    ''' Tests that merges are skipped only into the same destination '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'database.sqlite3')
+        self.catalog = catalog.connect(':memory:')
+        self.digest = 'x' * 40
+        self.merge()
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.directory)
+
+    def merge(self):
+        ''' Pretend to merge the input into the destination '''
+        if os.path.exists(self.path):
+            connection = sqlite3.connect(self.path)
+        else:
+            connection = create(self.path)
+        identity = catalog.destination_id(self.catalog, connection)
+        connection.close()
+        merged = catalog.is_merged(self.catalog, self.digest, identity)
+        catalog.mark_merged(self.catalog, self.digest, identity)
+        return merged
+
+    def test_same(self):
+        ''' The input is skipped by the next merges '''
+        self.assertTrue(self.merge())
+        self.assertTrue(self.merge())
+
+    def test_removed(self):
+        ''' A new destination at the same path gets the input '''
+        os.unlink(self.path)
+        self.assertFalse(self.merge())
+
+    def test_restored(self):
+        ''' A destination restored from a backup gets the input again '''
+        backup = os.path.join(self.directory, 'backup.sqlite3')
+        shutil.copyfile(self.path, backup)
+        self.assertTrue(self.merge())
+        os.rename(backup, self.path)
+        self.assertFalse(self.merge())
+
+    def test_other(self):
+        ''' Another destination gets the input '''
+        self.path = os.path.join(self.directory, 'other.sqlite3')
+        self.assertFalse(self.merge())
+
+if __name__ == '__main__':
+    unittest.main()
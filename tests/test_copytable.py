@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+''' Regression tests for the key-based merge of copytable.py '''
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'neubot', 'dataset'))
+
+import copytable
+import mergestats
+
+SCHEMA = '''CREATE TABLE speedtest (id INTEGER PRIMARY KEY, uuid TEXT,
+  timestamp INTEGER, latency REAL);'''
+
+def create(path, rows):
+    ''' Create the database at @path with the (uuid, timestamp) @rows '''
+    connection = sqlite3.connect(path)
+    connection.execute(SCHEMA)
+    connection.executemany('''INSERT INTO speedtest (uuid, timestamp,
+      latency) VALUES (?, ?, ?);''', [(uuid, timestamp, 0.1 * index)
+                                      for index, (uuid, timestamp)
+                                      in enumerate(rows)])
+    connection.commit()
+    return connection
+
+def keys(connection):
+    ''' Return the sorted (id, uuid, timestamp) of the tests '''
+    cursor = connection.cursor()
+    cursor.execute('SELECT id, uuid, timestamp FROM speedtest ORDER BY id;')
+    return cursor.fetchall()
+
+class EnsureKeyTest(unittest.TestCase):
+
+    ''' Tests copytable.ensure_key() '''
+
+    def setUp(self):
+        self.connection = create(':memory:', [('a', 1), ('a', 1), ('b', 1),
+                                              (None, 2), (None, 2),
+                                              ('a', 2)])
+
+    def test_duplicates(self):
+        ''' Duplicates are removed keeping the oldest copy '''
+        copytable.ensure_key(self.connection, 'speedtest')
+        self.assertEqual(keys(self.connection), [(1, 'a', 1), (3, 'b', 1),
+                                                 (4, None, 2), (6, 'a', 2)])
+
+    def test_null_uuid(self):
+        ''' A missing uuid violates the key like any other '''
+        copytable.ensure_key(self.connection, 'speedtest')
+        self.assertRaises(sqlite3.IntegrityError, self.connection.execute,
+                          '''INSERT INTO speedtest (uuid, timestamp)
+                          VALUES (NULL, 2);''')
+
+    def test_old_index(self):
+        ''' The index on the plain columns is replaced '''
+        connection = create(':memory:', [])
+        connection.execute('''CREATE UNIQUE INDEX speedtest_test_key
+          ON speedtest (uuid, timestamp);''')
+        copytable.ensure_key(connection, 'speedtest')
+        cursor = connection.cursor()
+        cursor.execute('''SELECT sql FROM sqlite_master
+          WHERE name='speedtest_test_key';''')
+        self.assertIn('COALESCE', cursor.fetchone()[0])
+
+    def test_idempotent(self):
+        ''' Running twice changes nothing '''
+        copytable.ensure_key(self.connection, 'speedtest')
+        copytable.ensure_key(self.connection, 'speedtest')
+        self.assertEqual(len(keys(self.connection)), 4)
+
+class CopyAttachedTest(unittest.TestCase):
+
+    ''' Tests copytable.copy_attached() with @ignore '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source.sqlite3')
+        create(self.source, [('a', 1), ('b', 2), (None, 3),
+                             ('c', 4)]).close()
+        self.destination = create(':memory:', [('a', 1), (None, 3)])
+        copytable.ensure_key(self.destination, 'speedtest')
+
+    def tearDown(self):
+        self.destination.close()
+        shutil.rmtree(self.directory)
+
+    def test_skip_existing(self):
+        ''' Only the tests missing from the destination are copied '''
+        count = copytable.copy_attached(self.source, self.destination,
+                                        'speedtest', None, ignore=True)
+        self.assertEqual(count, 2)
+        self.assertEqual([row[1:] for row in keys(self.destination)],
+                         [('a', 1), (None, 3), ('b', 2), ('c', 4)])
+
+    def test_twice(self):
+        ''' Merging the same input again adds nothing '''
+        copytable.copy_attached(self.source, self.destination, 'speedtest',
+                                None, ignore=True)
+        count = copytable.copy_attached(self.source, self.destination,
+                                        'speedtest', None, ignore=True)
+        self.assertEqual(count, 0)
+        self.assertEqual(len(keys(self.destination)), 4)
+
+    def test_stats(self):
+        ''' Skipped rows are accounted '''
+        stats = mergestats.new(self.source)
+        copytable.copy_attached(self.source, self.destination, 'speedtest',
+                                None, ignore=True, stats=stats)
+        self.assertEqual(stats['stages']['insert']['rows_inserted'], 2)
+        self.assertEqual(stats['stages']['insert']['rows_skipped'], 2)
+
+    @unittest.skipUnless(hasattr(sqlite3.Connection, 'serialize'),
+                         'needs Python >= 3.11')
+    def test_serialized(self):
+        ''' In-memory sources are deduplicated as well '''
+        source = sqlite3.connect(self.source)
+        count = copytable.copy_attached(source.serialize(), self.destination,
+                                        'speedtest', None, ignore=True)
+        source.close()
+        self.assertEqual(count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+''' Regression tests for the cache of dumpcache.py '''
+
+import bz2
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'neubot', 'dataset'))
+
+import dumpcache
+
+class EvictTest(unittest.TestCase):
+
+    ''' Tests the eviction of the least recently used copies '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = os.path.join(self.directory, 'cache')
+        self.inputs = [self.create(name) for name in ('a', 'b', 'c')]
+        self.cap = os.path.getsize(self.inputs[0][:-len('.bz2')])
+
+    def tearDown(self):
+        dumpcache.CONSUMER = None
+        shutil.rmtree(self.directory)
+
+    def create(self, name):
+        ''' Create the compressed database @name and return its path '''
+        path = os.path.join(self.directory, '%s.sqlite3' % name)
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE config (name TEXT PRIMARY KEY, '
+                           'value TEXT);')
+        connection.execute("INSERT INTO config VALUES ('version', '4.0');")
+        connection.execute("INSERT INTO config VALUES ('name', ?);", (name,))
+        connection.commit()
+        connection.close()
+        with open(path, 'rb') as inputfp:
+            with bz2.BZ2File(path + '.bz2', 'wb') as outputfp:
+                outputfp.write(inputfp.read())
+        return path + '.bz2'
+
+    def get(self, index):
+        ''' Return the cached copy of the input @index '''
+        return dumpcache.get(self.cache, self.inputs[index], self.cap)
+
+    def test_hit(self):
+        ''' The copy is made once, and the version remembered '''
+        origin = {}
+        cached = dumpcache.get(self.cache, self.inputs[0], self.cap,
+                               origin=origin)
+        self.assertTrue(dumpcache.contains(self.cache, cached))
+        self.assertEqual(origin['version'], '4.0')
+        os.utime(cached, (1, 1))
+        self.assertEqual(self.get(0), cached)
+        self.assertEqual(os.stat(cached).st_mtime, 1)
+
+    def test_evict(self):
+        ''' The least recently used copy goes over the cap '''
+        first = self.get(0)
+        second = self.get(1)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    def test_leased(self):
+        ''' Leased copies stay until they are released '''
+        dumpcache.CONSUMER = os.getpid()
+        first = self.get(0)
+        dumpcache.CONSUMER = None
+        second = self.get(1)
+        self.assertTrue(os.path.exists(first))
+        dumpcache.release(first)
+        third = self.get(2)
+        self.assertFalse(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+    def test_leased_twice(self):
+        ''' Each lease must be released '''
+        dumpcache.CONSUMER = os.getpid()
+        first = self.get(0)
+        self.get(0)
+        dumpcache.CONSUMER = None
+        dumpcache.release(first)
+        self.get(1)
+        self.assertTrue(os.path.exists(first))
+        dumpcache.release(first)
+        self.get(2)
+        self.assertFalse(os.path.exists(first))
+
+    def test_dead(self):
+        ''' The leases of dead processes are dropped '''
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        dumpcache.CONSUMER = process.pid
+        first = self.get(0)
+        dumpcache.CONSUMER = None
+        self.get(1)
+        self.assertFalse(os.path.exists(first))
+
+    def test_plain(self):
+        ''' Non-compressed databases are cached only when asked '''
+        path = self.inputs[0][:-len('.bz2')]
+        self.assertEqual(dumpcache.get(self.cache, path), path)
+        cached = dumpcache.get(self.cache, path, copy=True)
+        self.assertNotEqual(cached, path)
+        self.assertTrue(dumpcache.contains(self.cache, cached))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+''' Regression tests for the dictionary encoding of histcode.py '''
+
+import collections.abc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'neubot', 'dataset'))
+
+import histcode
+import histstore
+
+TREE = {
+    'AS1 Provider': {
+        'Turin': {
+            'speedtest': {'uuid': ['u1', 'u2', 'u1'],
+                          'latency': [0.5, None, 0.25]},
+        },
+        'Rome': {
+            'bittorrent': {'uuid': ['u3'], 'latency': [0.125]},
+        },
+    },
+    'AS2 Other': {
+        'Turin': {
+            'speedtest': {'uuid': ['u2'], 'latency': [0.5]},
+        },
+    },
+}
+
+def to_python(tree):
+    ''' Return a copy of the @tree loaded from a store as plain Python '''
+    if isinstance(tree, collections.abc.Mapping):
+        return dict((key, to_python(value)) for key, value in tree.items())
+    if hasattr(tree, 'tolist'):
+        return [None if value != value else value for value in
+                tree.tolist()]
+    return tree
+
+class EncodeTest(unittest.TestCase):
+
+    ''' Tests encoding and decoding histograms '''
+
+    def test_round_trip(self):
+        ''' Decoding returns the original histogram '''
+        document = histcode.encode(TREE, 2)
+        self.assertEqual(histcode.decode(document), TREE)
+
+    def test_json(self):
+        ''' The encoded document survives a trip through JSON '''
+        document = json.loads(json.dumps(histcode.encode(TREE, 2)))
+        self.assertTrue(histcode.is_encoded(document))
+        self.assertEqual(histcode.decode(document), TREE)
+
+    def test_strings_once(self):
+        ''' Each label and uuid is written once '''
+        document = histcode.encode(TREE, 2)
+        self.assertEqual(sorted(document['strings']),
+                         ['AS1 Provider', 'AS2 Other', 'Rome', 'Turin',
+                          'u1', 'u2', 'u3'])
+
+    def test_not_encoded(self):
+        ''' Plain histograms are returned as they are '''
+        self.assertFalse(histcode.is_encoded(TREE))
+        self.assertIs(histcode.decode(TREE), TREE)
+
+    def test_select(self):
+        ''' Selections name the groups by their labels '''
+        document = histcode.encode(TREE, 2)
+        tree = histcode.select(document, '/AS1 Provider/Rome/bittorrent')
+        self.assertEqual(tree['latency'], [0.125])
+        self.assertEqual([histcode.label(document['strings'], code)
+                          for code in tree['uuid']], ['u3'])
+
+    def test_store(self):
+        ''' Encoded histograms survive a float32 store '''
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs numpy')
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'store')
+            histstore.write(histcode.encode(TREE, 2), path, 'float32')
+            document = histstore.load(path)
+            self.assertTrue(histcode.is_encoded(document))
+            self.assertEqual(to_python(histcode.decode(document)), TREE)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_large_codes(self):
+        ''' Codes are stored exactly even with float32 '''
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs numpy')
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'store')
+            codes = [2 ** 24 + 1, 2 ** 31 + 1, 0]
+            histstore.write({'uuid': codes, 'latency': [0.5]}, path,
+                            'float32')
+            store = histstore.load(path)
+            self.assertEqual(store['uuid'].dtype, numpy.int64)
+            self.assertEqual(store['uuid'].tolist(), codes)
+            self.assertEqual(store['latency'].dtype, numpy.float32)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
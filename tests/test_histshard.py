@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+''' Regression tests for the sharded builds of histshard.py '''
+
+import json
+import os
+import random
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'neubot', 'dataset'))
+
+import histshard
+import histspill
+
+CITIES = ('Turin', 'Rome', 'Milan', 'Naples', 'Bari')
+
+def create(path, count=1000):
+    ''' Create the database at @path with @count random tests '''
+    generator = random.Random(count)
+    connection = sqlite3.connect(path)
+    connection.execute('''CREATE TABLE speedtest (id INTEGER PRIMARY KEY,
+      timestamp INTEGER, city TEXT, uuid TEXT, latency REAL);''')
+    connection.executemany('''INSERT INTO speedtest (timestamp, city, uuid,
+      latency) VALUES (?, ?, ?, ?);''', [(generator.randrange(count // 10),
+      generator.choice(CITIES), 'u%d' % generator.randrange(50),
+      generator.random()) for _ in range(count)])
+    connection.commit()
+    return connection
+
+def build(connection, shard=('', ()), where='', order=''):
+    ''' Build the histogram of the rows of @shard, grouped by city '''
+    condition, params = shard
+    conditions = [clause for clause in (where, condition) if clause]
+    query = 'SELECT city, uuid, latency FROM speedtest'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    if order:
+        query += ' ORDER BY ' + order
+    hist = {}
+    cursor = connection.cursor()
+    cursor.execute(query, params)
+    for city, uuid, latency in cursor:
+        if city not in hist:
+            hist[city] = {'uuid': [], 'latency': []}
+        hist[city]['uuid'].append(uuid)
+        hist[city]['latency'].append(latency)
+    return hist
+
+def double(task):
+    ''' Return twice the second item of @task '''
+    return task[1] * 2
+
+class ShardTest(unittest.TestCase):
+
+    ''' Tests that sharded builds equal the serial one '''
+
+    def setUp(self):
+        self.shard = histshard.SHARD
+        histshard.SHARD = 50
+        self.connection = create(':memory:')
+
+    def tearDown(self):
+        histshard.SHARD = self.shard
+        self.connection.close()
+
+    def sharded(self, column='id', where='', order=''):
+        ''' Build the histogram shard by shard and merge the parts '''
+        shards = histshard.slices(self.connection, 'speedtest', column,
+                                  where, workers=4)
+        self.assertEqual(len(shards), 4)
+        hist = {}
+        for shard in shards:
+            histshard.merge(hist, build(self.connection, shard, where,
+                                        order), 1, histspill.merge_lists)
+        return hist
+
+    def assertSame(self, first, second):
+        ''' Check that the two histograms are equal, key order too '''
+        self.assertEqual(json.dumps(first), json.dumps(second))
+
+    def test_rowid(self):
+        ''' Slices by rowid give the serial histogram '''
+        self.assertSame(self.sharded(), build(self.connection))
+
+    def test_where(self):
+        ''' Slices honour the filter of the query '''
+        where = 'latency > 0.5'
+        self.assertSame(self.sharded(where=where),
+                        build(self.connection, where=where))
+
+    def test_order(self):
+        ''' Slices by the ORDER BY column give the serial histogram '''
+        order = 'timestamp, id'
+        self.assertSame(self.sharded('timestamp', order=order),
+                        build(self.connection, order=order))
+
+    def test_partition(self):
+        ''' Each row is in exactly one slice '''
+        cursor = self.connection.cursor()
+        seen = []
+        for condition, params in histshard.slices(self.connection,
+                                                  'speedtest', 'timestamp',
+                                                  workers=3):
+            cursor.execute('SELECT id FROM speedtest WHERE %s;' % condition,
+                           params)
+            seen.extend(row[0] for row in cursor)
+        self.assertEqual(sorted(seen), list(range(1, 1001)))
+
+    def test_small(self):
+        ''' Small tables are one slice '''
+        histshard.SHARD = 1000
+        self.assertEqual(histshard.slices(self.connection, 'speedtest',
+                                          workers=4), [('', ())])
+
+    def test_ungrouped(self):
+        ''' Without grouping the leaves are merged directly '''
+        old, new = {'rtt': [1]}, {'rtt': [2], 'uuid': ['u']}
+        self.assertEqual(histshard.merge(old, new, 0, histspill.merge_lists),
+                         {'rtt': [1, 2], 'uuid': ['u']})
+
+class RunTest(unittest.TestCase):
+
+    ''' Tests histshard.run() '''
+
+    def test_order(self):
+        ''' Results come in the order of the tasks '''
+        path = 'input.sqlite3'
+        tasks = [(path, 1), ('', 2), (path, 3), ('', 4), (path, 5)]
+        self.assertEqual(list(histshard.run(double, tasks, 2)),
+                         [2, 4, 6, 8, 10])
+
+    def test_local(self):
+        ''' In-memory tasks alone do not need workers '''
+        tasks = [('', 1), ('', 2)]
+        self.assertEqual(list(histshard.run(double, tasks, 2)), [2, 4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+''' Regression tests for the out-of-core builds of histspill.py '''
+
+import collections.abc
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'neubot', 'dataset'))
+
+import histleaf
+import histspill
+import histstore
+
+PROVIDERS = ('AS1', 'AS2', 'AS3')
+CITIES = ('Turin', 'Rome', 'Milan', 'Naples')
+
+def rows(count=2000):
+    ''' Return @count random (provider, city, uuid, latency) rows '''
+    generator = random.Random(count)
+    return [(generator.choice(PROVIDERS), generator.choice(CITIES),
+             'u%d' % generator.randrange(50), generator.random())
+            for _ in range(count)]
+
+def build(hist, spiller=None):
+    ''' Build into @hist the histogram of rows(), within @spiller '''
+    for provider, city, uuid, latency in rows():
+        group = hist.setdefault(provider, {}).setdefault(city, {})
+        table = group.setdefault('speedtest', {'uuid': [], 'latency': []})
+        table['uuid'].append(uuid)
+        table['latency'].append(latency)
+        if spiller:
+            spiller.tick(2)
+    return hist
+
+def ordered(tree, depth):
+    ''' Return @tree with the groups above @depth sorted by key '''
+    if not depth:
+        return tree
+    return dict((key, ordered(tree[key], depth - 1))
+                for key in sorted(tree))
+
+def to_python(tree):
+    ''' Return a copy of the @tree loaded from a store as plain Python '''
+    if isinstance(tree, collections.abc.Mapping):
+        return dict((key, to_python(value)) for key, value in tree.items())
+    if hasattr(tree, 'tolist'):
+        return [value.decode('utf-8') if isinstance(value, bytes)
+                else value for value in tree.tolist()]
+    return tree
+
+class SpillTest(unittest.TestCase):
+
+    ''' Tests that spilled builds equal the in-memory one '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.expected = build({})
+        self.hist = {}
+        self.spiller = histspill.Spiller(self.hist, 2, 4096,
+                                         directory=self.directory)
+        build(self.hist, self.spiller)
+
+    def tearDown(self):
+        self.spiller.close()
+        shutil.rmtree(self.directory)
+
+    def test_spilled(self):
+        ''' The budget forces many runs '''
+        self.assertGreater(len(self.spiller.runs), 10)
+
+    def test_items(self):
+        ''' Groups come sorted by key, with their values in order '''
+        self.assertEqual(list(self.spiller.items()),
+                         list(histspill.flatten(ordered(self.expected, 2),
+                                                2)))
+
+    def test_json(self):
+        ''' The JSON output is the one of the in-memory build '''
+        for pretty in (False, True):
+            outfp = io.StringIO()
+            histspill.dump_json(self.spiller.items(), outfp, pretty)
+            if pretty:
+                text = json.dumps(self.expected, indent=4, sort_keys=True)
+            else:
+                text = json.dumps(ordered(self.expected, 2))
+            self.assertEqual(outfp.getvalue(), text)
+
+    def test_store(self):
+        ''' The store is the one of the in-memory build '''
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs numpy')
+        path = os.path.join(self.directory, 'spilled')
+        histspill.write_store(self.spiller.items(), path)
+        expected = os.path.join(self.directory, 'expected')
+        histstore.write(self.expected, expected)
+        self.assertEqual(to_python(histstore.load(path)),
+                         to_python(histstore.load(expected)))
+
+    def test_closed(self):
+        ''' Closing removes the runs '''
+        self.spiller.close()
+        self.assertFalse(os.path.exists(self.spiller.directory))
+
+class EmptyTest(unittest.TestCase):
+
+    ''' Tests groups that are empty above the grouping depth '''
+
+    def test_empty(self):
+        ''' Empty groups are kept '''
+        tree = {'AS1': {}, 'AS2': {'Turin': {'rtt': [1]}}}
+        outfp = io.StringIO()
+        histspill.dump_json(histspill.flatten(tree, 2), outfp)
+        self.assertEqual(json.loads(outfp.getvalue()), tree)
+
+    def test_nothing(self):
+        ''' Empty histograms are empty objects '''
+        outfp = io.StringIO()
+        histspill.dump_json(iter(()), outfp)
+        self.assertEqual(outfp.getvalue(), '{}')
+
+class BudgetTest(unittest.TestCase):
+
+    ''' Tests the accounting of the memory budget '''
+
+    def check(self, value, count):
+        ''' Check that @count values of @value bytes fill 96 bytes '''
+        hist = {'AS1': {'rtt': [1]}}
+        spiller = histspill.Spiller(hist, 1, 96, value=value)
+        try:
+            for _ in range(count):
+                self.assertFalse(spiller.tick())
+            self.assertTrue(spiller.tick())
+            self.assertEqual(hist, {})
+            self.assertEqual(len(spiller.runs), 1)
+        finally:
+            spiller.close()
+
+    def test_lists(self):
+        ''' Values in lists are priced VALUE bytes by default '''
+        self.check(histspill.VALUE, 96 // histspill.VALUE)
+
+    def test_arrays(self):
+        ''' Values in arrays of doubles are priced their size '''
+        self.assertEqual(histleaf.VALUE, 8)
+        self.check(histleaf.VALUE, 12)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#
+# Copyright (c) 2011 Simone Basso <bassosimone@gmail.com>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+#
+
+''' Regression tests for the quantile sketches of sketch.py '''
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'neubot', 'dataset'))
+
+import histstore
+import sketch
+
+def sample(seed, count=5000):
+    ''' Return @count values spread over many orders of magnitude '''
+    generator = random.Random(seed)
+    return [generator.lognormvariate(10, 3) for _ in range(count)]
+
+def build(values):
+    ''' Return the sketch of @values '''
+    result = sketch.Sketch()
+    for value in values:
+        result.add(value)
+    return result
+
+class QuantileTest(unittest.TestCase):
+
+    ''' Tests the error bound of the quantiles '''
+
+    def check(self, result, values):
+        ''' Check the quantiles of @result against the exact ones '''
+        values = sorted(values)
+        for fraction in [index / 100.0 for index in range(101)]:
+            exact = values[int(fraction * (len(values) - 1))]
+            estimate = result.quantile(fraction)
+            self.assertLessEqual(abs(estimate - exact),
+                                 result.alpha * exact * (1 + 1e-9))
+
+    def test_bound(self):
+        ''' Quantiles have relative error below alpha '''
+        values = sample(1)
+        self.check(build(values), values)
+
+    def test_extremes(self):
+        ''' Quantiles never fall outside the range of the values '''
+        values = sample(2)
+        result = build(values)
+        self.assertEqual(result.quantile(0), min(values))
+        self.assertLessEqual(result.quantile(1), max(values))
+        xdata, ydata = result.cdf()
+        self.assertEqual(xdata, sorted(xdata))
+        self.assertGreaterEqual(xdata[0], min(values))
+        self.assertLessEqual(xdata[-1], max(values))
+        self.assertEqual(ydata[-1], 1.0)
+
+    def test_zeros(self):
+        ''' Zero and negative values are counted, but not binned '''
+        result = build([-1, 0, 0, 5])
+        self.assertEqual(result.zeros, 3)
+        self.assertEqual(result.quantile(0), -1)
+        self.assertEqual(result.quantile(0.5), -1)
+        self.assertEqual(result.count, 4)
+
+    def test_none(self):
+        ''' None is skipped and other non-numbers are refused '''
+        result = build([None, 1.0])
+        self.assertEqual(result.count, 1)
+        self.assertRaises(RuntimeError, result.add, 'x')
+        self.assertRaises(RuntimeError, result.add, True)
+
+    def test_empty(self):
+        ''' Empty sketches have no quantiles '''
+        self.assertIsNone(sketch.Sketch().quantile(0.5))
+        self.assertEqual(sketch.Sketch().cdf(), ([], []))
+
+class MergeTest(unittest.TestCase):
+
+    ''' Tests merging and serializing sketches '''
+
+    def test_merge(self):
+        ''' Merging is the same as sketching all values '''
+        first, second = sample(3), sample(4)
+        merged = build(first).merge(build(second))
+        self.assertEqual(merged.to_dict(), build(first + second).to_dict())
+
+    def test_alpha(self):
+        ''' Sketches with different alpha do not merge '''
+        self.assertRaises(RuntimeError, sketch.Sketch(0.01).merge,
+                          sketch.Sketch(0.02))
+
+    def test_json(self):
+        ''' Sketches survive a trip through JSON '''
+        result = build(sample(5))
+        copy = sketch.from_dict(json.loads(json.dumps(result.to_dict())))
+        self.assertEqual(copy.to_dict(), result.to_dict())
+
+    def test_merge_tree(self):
+        ''' Trees of sketches merge leaf by leaf '''
+        first, second = sample(6), sample(7)
+        old = {'Turin': {'rtt': build(first)}}
+        new = {'Turin': {'rtt': build(second)}, 'Rome': {'rtt': build([1])}}
+        tree = sketch.merge_tree(old, new)
+        self.assertEqual(sorted(tree), ['Rome', 'Turin'])
+        self.assertEqual(tree['Turin']['rtt'].to_dict(),
+                         build(first + second).to_dict())
+
+    def test_store(self):
+        ''' Sketches are stored exactly even with float32 '''
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('needs numpy')
+        result = build(sample(8))
+        result.bins[max(result.bins) + 1] = 2 ** 24 + 1
+        result.count += 2 ** 24 + 1
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'store')
+            histstore.write({'rtt': result.to_dict()}, path, 'float32')
+            copy = sketch.from_tree(histstore.load(path))['rtt']
+            self.assertEqual(copy.to_dict(), result.to_dict())
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
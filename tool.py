@@ -24,53 +24,45 @@
 
 import collections
 import decimal
+import functools
 import getopt
 import json
 import syslog
 import sqlite3
 import time
-import bz2
 import re
 import sys
 import os
 
+from urllib.request import pathname2url
+
 from matplotlib import pyplot
 from matplotlib import dates
 
 sys.path.insert(0, '../neubot')
+sys.path.insert(0, 'neubot/dataset')
 
 from neubot.database import DATABASE
+from neubot.database import DatabaseManager
 from neubot.database import migrate
 
-class __FakeGeoIP:
-    ''' Fake geoip provider '''
-
-    def record_by_addr(self, address):
-        ''' Fake record_by_addr method '''
-
-    def org_by_addr(self, address):
-        ''' Fake org_by_addr method '''
-
-def __get_geoloc_city():
-    ''' Return a geoloc city provider '''
-    try:
-        import GeoIP
-        return GeoIP.open('/usr/local/share/GeoIP/GeoLiteCity.dat',
-                          GeoIP.GEOIP_STANDARD)
-    except:
-        return __FakeGeoIP()
-
-def __get_geoloc_asn():
-    ''' Return a geoloc asn provider '''
-    try:
-        import GeoIP
-        return GeoIP.open('/usr/local/share/GeoIP/GeoIPASNum.dat',
-                          GeoIP.GEOIP_STANDARD)
-    except:
-        return __FakeGeoIP()
-
-GEOLOC_CITY = __get_geoloc_city()
-GEOLOC_ASN = __get_geoloc_asn()
+import catalog
+import copyout
+import copytable
+import dumpcache
+import dumps
+import geoloc
+import histleaf
+import histshard
+import histspill
+import histstore
+import mergestats
+import pipeline
+import prepare
+import summary
+
+# Geolocation is memoized, and optional
+GEOLOCATOR = geoloc.Geolocator(fallback=True)
 
 def __connect(path):
 
@@ -84,6 +76,19 @@ def __connect(path):
     connection.row_factory = sqlite3.Row
     return connection
 
+def __connect_readonly(path):
+
+    '''
+     Like __connect() but the database at @path is opened read-only,
+     so that it is never locked for writing or modified.
+    '''
+
+    connection = sqlite3.connect('file:%s?mode=ro' %
+                                 pathname2url(os.path.abspath(path)),
+                                 uri=True)
+    connection.row_factory = sqlite3.Row
+    return connection
+
 def __info(connection):
 
     '''
@@ -100,27 +105,6 @@ def __info(connection):
 
     return result
 
-def __decompress(path):
-
-    '''
-     This function decompress a compressed Neubot database
-     on the current working directory
-    '''
-
-    outputpath = os.path.basename(path).replace('.bz2', '')
-
-    inputfp = bz2.BZ2File(path)
-    outputfp = open(outputpath, 'w')
-    while True:
-        chunk = inputfp.read(262144)
-        if not chunk:
-            break
-        outputfp.write(chunk)
-    outputfp.close()
-    inputfp.close()
-
-    return outputpath
-
 def __create_empty(path):
 
     '''
@@ -143,76 +127,117 @@ def __migrate(connection):
 
     migrate.migrate(connection)
 
-def __sanitize(table):
+def __cached(cache, cap, path, stats=None, origin=None):
 
     '''
-     Write query making sure that the table name contains only
-     lowercase letters or underscores.
+     This function returns the path of the decompressed copy of
+     the database at @path in the @cache directory, whose size is
+     capped at @cap bytes, or @path itself when there is no cache.
+     The version of the copy before migration goes into @origin.
     '''
 
-    stripped = re.sub(r'[^a-z_]', '', table)
-    if stripped != table:
-        raise RuntimeError("Invalid table name")
-
-    return table
+    if not cache:
+        return path
+    return dumpcache.get(cache, path, cap, stats=stats, origin=origin)
 
-def __lookup_can_publish(connection, table):
+def __current_version():
 
     '''
-     This function lookups the number of measurement with the
-     can_publish permission in @table in the database referenced
-     by @connection.
+     This function returns the version of the current database
+     format, i.e. the one of a database freshly created by Neubot.
     '''
 
-    cursor = connection.cursor()
-    cursor.execute('''SELECT COUNT(timestamp) FROM %s
-      WHERE privacy_can_publish=1;''' % __sanitize(table))
-    count = next(cursor)[0]
-    if not count:
-        return 0
-    return count
+    manager = DatabaseManager()
+    manager.set_path(':memory:')
+    connection = manager.connection()
+    version = __info(connection)['version']
+    connection.close()
+    return version
 
-def __lookup_count_uuids(connection, table):
+def __open_target(path, current, cache, cap, memory_limit):
 
     '''
-     This function lookups the number of uuids in @table in the
-     database referenced by @connection.
+     This function returns a connection to the database at @path
+     for analysis.  Databases in the @current format are opened
+     read-only and never migrated, so that many processes can scan
+     the same files at once.  Out of date databases are migrated
+     into a copy, which lives in the @cache directory, if any, or
+     is temporary.
     '''
 
-    cursor = connection.cursor()
-    cursor.execute('SELECT COUNT(DISTINCT(uuid)) FROM %s;' % __sanitize(table))
-    count = next(cursor)[0]
-    if not count:
-        return 0
-    return count
+    # Compressed and not cached: we own the decompressed copy
+    if path.endswith('.bz2') and not cache:
+        target = dumps.connect(path, memory_limit)
+        target.row_factory = sqlite3.Row
+        __migrate(target)
+        return target
+
+    path = __cached(cache, cap, path)
+
+    target = __connect_readonly(path)
+    if __info(target).get('version') == current:
+        return target
+    target.close()
+
+    if not cache:
+        path = dumps.copy(path)
+    elif not dumpcache.contains(cache, path):
+        path = dumpcache.get(cache, path, cap, copy=True)
+
+    syslog.syslog(syslog.LOG_INFO, 'migrate %s' % path)
+    target = __connect(path)
+    __migrate(target)
+    return target
 
-def __lookup_count(connection, table):
+def __open_source(force, memory_limit, cache, cap, path, stats=None,
+                  origin=None):
 
     '''
-     This function lookups the number of measurement in @table in the
-     database referenced by @connection.
+     This function returns a migrated connection to the database
+     at @path, decompressing it if needed, or None if the database
+     is too old and @force is False.  Compressed databases are taken
+     from the @cache, if any, or decompressed into memory if smaller
+     than @memory_limit bytes, or into a temporary file.  The time
+     spent decompressing and migrating is accounted into @stats, and
+     the version before migration is stored into @origin, if any.
     '''
 
-    cursor = connection.cursor()
-    cursor.execute('SELECT COUNT(timestamp) FROM %s;' % __sanitize(table))
-    count = next(cursor)[0]
-    if not count:
-        return 0
-    return count
+    # Decompress if needed
+    source = dumps.connect(__cached(cache, cap, path, stats, origin),
+                           memory_limit, stats)
+    source.row_factory = sqlite3.Row
+
+    # Query configuration
+    info = __info(source)
+    version = decimal.Decimal(info['version'])
+    if origin is not None:
+        origin.setdefault('version', info['version'])
+
+    # Skip old databases
+    if version <= decimal.Decimal('2.0') and not force:
+        syslog.syslog(syslog.LOG_WARNING, 'skipping old %s' % path)
+        return None
 
-def __lookup_first(connection, table):
+    # Migrate
+    syslog.syslog(syslog.LOG_INFO, 'migrate %s' % path)
+    ticks = time.time()
+    __migrate(source)
+    mergestats.add(stats, 'migrate', time.time() - ticks)
+
+    return source
+
+def __sanitize(table):
 
     '''
-     This function lookups the first measurement in @table in the
-     database referenced by @connection.
+     Write query making sure that the table name contains only
+     lowercase letters or underscores.
     '''
 
-    cursor = connection.cursor()
-    cursor.execute('SELECT MIN(timestamp) FROM %s;' % __sanitize(table))
-    minimum = next(cursor)[0]
-    if not minimum:
-        return 0
-    return minimum
+    stripped = re.sub(r'[^a-z_]', '', table)
+    if stripped != table:
+        raise RuntimeError("Invalid table name")
+
+    return table
 
 def __lookup_last(connection, table):
 
@@ -228,14 +253,19 @@ def __lookup_last(connection, table):
         return 0
     return maximum
 
-def __copyto_after(source, destination, table, limit):
+def __copyto_after(source, destination, table, limit, stats=None):
 
     '''
      Copy from @source to @destination the content of @table
-     which has timestamp greater than @limit.
+     which has timestamp greater than @limit.  Returns the number
+     of copied rows.  Reading and writing are accounted separately
+     into @stats.
     '''
 
     query = None
+    count = 0
+    ticks = time.time()
+    inserting = 0.0
 
     cursor = source.cursor()
     cursor.execute('SELECT * FROM %s WHERE timestamp > ?;'
@@ -261,186 +291,421 @@ def __copyto_after(source, destination, table, limit):
             query = "".join(vector)
 
         # Insert
+        started = time.time()
         destination.execute(query, dictionary)
+        inserting += time.time() - started
+        count += 1
 
     # Save
+    started = time.time()
     destination.commit()
+    inserting += time.time() - started
+
+    mergestats.add(stats, 'scan', time.time() - ticks - inserting,
+                   rows_read=count)
+    mergestats.add(stats, 'insert', inserting, rows_inserted=count,
+                   rows_skipped=0)
+
+    return count
+
+def __resolve(location):
+
+    '''
+     Return asname, country_code and city of the (org, record)
+     @location, where the values that are not known are None.
+    '''
+
+    asname, country_code, city = None, None, None
+    org, geodata = location
+
+    # Provider information
+    if org:
+        asname = org.decode('latin-1')
+
+    # Geo information
+    if geodata:
+        if geodata['country_code']:
+            country_code = geodata['country_code'].decode('latin-1')
+        if geodata['city']:
+            city = geodata['city'].decode('latin-1')
+
+    return asname, country_code, city
+
+def __geoloc_table(connection, tables):
+
+    '''
+     Create the temporary table geoloc that maps each distinct
+     address of the non publishable tests in @tables to its
+     asname, country_code and city.
+    '''
+
+    connection.execute('''CREATE TEMPORARY TABLE geoloc (address TEXT
+      PRIMARY KEY, asname TEXT, country_code TEXT, city TEXT);''')
+    cursor = connection.cursor()
+
+    # Avoid violating MaxMind copyright
+    cursor.execute(' UNION '.join(['''SELECT DISTINCT real_address FROM %s
+      WHERE privacy_can_publish = 0 AND real_address IS NOT NULL'''
+      % __sanitize(table) for table in tables]) + ';')
+    addresses = [row[0] for row in cursor]
+
+    # Geolocate all the addresses in one batch
+    rows = []
+    for address, location in zip(addresses,
+                                 GEOLOCATOR.lookup_many(addresses)):
+        location = __resolve(location)
+        if location != (None, None, None):
+            rows.append((address,) + location)
+    connection.executemany('INSERT INTO temp.geoloc VALUES (?, ?, ?, ?);',
+                           rows)
 
 def __anonimize(connection, table):
 
-    ''' Anonimize @table of the database referenced by @connection '''
+    '''
+     Anonimize @table of the database referenced by @connection.
+     Each distinct address is geolocated once into a temporary
+     table, which is then applied with a few set-based UPDATEs.
+    '''
+
+    table = __sanitize(table)
 
     # Add columns
     connection.execute(''' ALTER TABLE %s ADD COLUMN asname TEXT;'''
-                                % __sanitize(table))
+                                % table)
     connection.execute(''' ALTER TABLE %s ADD COLUMN country_code TEXT;'''
-                                % __sanitize(table))
+                                % table)
     connection.execute(''' ALTER TABLE %s ADD COLUMN city TEXT;'''
-                                % __sanitize(table))
+                                % table)
+
+    __geoloc_table(connection, (table,))
+
+    if sqlite3.sqlite_version_info >= (3, 33, 0):
+        connection.execute('''UPDATE %s SET asname = geoloc.asname,
+          country_code = geoloc.country_code, city = geoloc.city
+          FROM temp.geoloc WHERE %s.privacy_can_publish = 0
+          AND %s.real_address = geoloc.address;''' % (table, table, table))
+    else:
+        for column in ('asname', 'country_code', 'city'):
+            connection.execute('''UPDATE %s SET %s = (SELECT %s
+              FROM temp.geoloc WHERE address = real_address)
+              WHERE privacy_can_publish = 0 AND real_address IN
+              (SELECT address FROM temp.geoloc);''' % (table, column,
+              column))
+
+    # Ditch user address (only after geolocation!)
+    connection.execute('''UPDATE %s SET internal_address='0.0.0.0',
+      real_address='0.0.0.0' WHERE privacy_can_publish = 0;''' % table)
+
+    connection.execute('DROP TABLE temp.geoloc;')
+    connection.commit()
 
-    # Gather location and provider info
-    cursor = connection.cursor()
-    cursor.execute('SELECT * FROM %s' % __sanitize(table))
-    for row in cursor:
+    # Rebuild the database
+    connection.execute('VACUUM')
+    connection.commit()
 
-        # Avoid violating MaxMind copyright
-        if int(row['privacy_can_publish']):
-            continue
+def __anonimize_into(connection, path):
 
-        # Ditch user address
-        connection.execute('''UPDATE %s SET internal_address="0.0.0.0",
-          real_address="0.0.0.0" WHERE id=?;''' %
-          __sanitize(table), (row['id'],))
-
-        # Provider information
-        asname = GEOLOC_ASN.org_by_addr(row['real_address'])
-        if asname:
-            asname = asname.decode('latin-1')
-            connection.execute(''' UPDATE %s SET asname=?
-              WHERE id=?''' % __sanitize(table), (asname, row['id']))
-
-        # Geo information
-        geodata = GEOLOC_CITY.record_by_addr(row['real_address'])
-        if geodata:
-            if geodata['country_code']:
-                country_code = geodata['country_code'].decode('latin-1')
-                connection.execute(''' UPDATE %s SET country_code=?
-                  WHERE id=?''' % __sanitize(table), (country_code, row['id']))
-            if geodata['city']:
-                city = geodata['city'].decode('latin-1')
-                connection.execute(''' UPDATE %s SET city=?
-                  WHERE id=?''' % __sanitize(table), (city, row['id']))
+    '''
+     Write into a new database at @path the anonimized copy of the
+     database referenced by @connection, which is not modified.
+     The result is the same as __anonimize() of both tables, but
+     the output is written once rather than updated and rebuilt.
+    '''
 
-    # Rebuild the database
-    connection.execute('VACUUM')
+    __geoloc_table(connection, ('speedtest', 'bittorrent'))
+
+    transforms, added = {}, {}
+    for table in ('speedtest', 'bittorrent'):
+        transforms[table] = {}
+        added[table] = []
+        for column in ('asname', 'country_code', 'city'):
+            transforms[table][column] = '''(SELECT %s FROM temp.geoloc
+              WHERE privacy_can_publish = 0 AND address = real_address)''' \
+              % column
+            added[table].append((column, 'TEXT'))
+        for column in ('internal_address', 'real_address'):
+            transforms[table][column] = '''CASE WHEN privacy_can_publish = 0
+              THEN '0.0.0.0' ELSE %s END''' % column
+
+    copyout.copy_out(connection, path, transforms, added)
+    connection.execute('DROP TABLE temp.geoloc;')
     connection.commit()
 
 def __format_date(thedate):
     ''' Make a timestamp much more readable '''
     return time.ctime(int(thedate))
 
-def __build_histogram(connection, table, histogram, modifiers):
+#
+# Modifiers that SQLite can group by itself, and the expression
+# of the group.  The hour is computed for CEST, see below.
+#
+GROUPING = {
+    'per_instance': 'uuid',
+    'per_hour': '(timestamp / 3600 + 2) % 24',
+}
+
+# Modifiers that need geolocation, which happens in Python
+GEOGRAPHIC = ('per_provider', 'per_country', 'per_city')
+
+# Tests without uuid belong to no instance
+INSTANCE = "uuid IS NOT NULL AND uuid != ''"
+
+def __plan_histogram(table, modifiers, condition=''):
+
+    '''
+     Return the query that reads from @table only the columns that
+     are needed to build the histogram with @modifiers, and the
+     names of the columns that decide the group of each row.  The
+     groups that SQLite can compute are returned as columns named
+     after their modifier, and rows are ordered by them, so that each
+     group is read as a contiguous run, in table order.  The optional
+     @condition restricts the query to a shard (see histshard.py).
+    '''
+
+    columns = ['id', 'timestamp', 'download_speed', 'upload_speed',
+               'connect_time']
+    where, order, keys = [], [], []
+    geographic = False
+    for modifier in modifiers:
+        if modifier in GROUPING:
+            if modifier not in keys:
+                columns.append('%s AS %s' % (GROUPING[modifier], modifier))
+                order.append(modifier)
+                keys.append(modifier)
+        elif modifier in GEOGRAPHIC:
+            geographic = True
+        else:
+            raise RuntimeError('Invalid modifier: %s' % modifier)
+
+    if 'per_instance' in modifiers:
+        where.append(INSTANCE)
+    if condition:
+        where.append(condition)
+    if geographic:
+        columns.append('real_address')
+        keys.append('real_address')
+
+    query = 'SELECT %s FROM %s' % (', '.join(columns), __sanitize(table))
+    if where:
+        query += ' WHERE %s' % ' AND '.join(where)
+    if order:
+        query += ' ORDER BY %s, id' % ', '.join(order)
+    return query, keys
+
+def __plan_shards(connection, table, modifiers, workers):
+
+    '''
+     Split the rows of @table that __plan_histogram() reads into at
+     most @workers shards, by ranges of the first ORDER BY column or
+     of id, so that each shard is a slice of the serial read order.
+    '''
+
+    column = 'id'
+    for modifier in modifiers:
+        if modifier in GROUPING:
+            column = GROUPING[modifier]
+            break
+    where = INSTANCE if 'per_instance' in modifiers else ''
+    return histshard.slices(connection, table, column, where, workers)
+
+def __build_histogram(connection, table, histogram, modifiers,
+                      spiller=None, shard=('', ()), order=None, sequence=0):
 
     '''
      This function walks the @table of the database referenced by
      @connection and collects statistics.  Depending on the params
      the result dictionary contains more or less aggregated data.
+     If @spiller is not None, it keeps @histogram within its memory
+     budget.  The @shard is the (condition, params) pair that selects
+     the rows to walk (see histshard.py), by default all of them.
+     Unless @order is None, it maps the path of each group to the
+     (@sequence, id) of its first row, where @sequence numbers the
+     tables walked so far (see __restore_order()).
     '''
 
+    condition, params = shard
+    query, keys = __plan_histogram(table, modifiers, condition)
     cursor = connection.cursor()
-    cursor.execute('SELECT * FROM %s' % __sanitize(table))
+    cursor.execute(query, params)
+
+    current, stats = None, None
     for row in cursor:
 
-        stats = histogram
-        skip = False
+        # Rows with the same key take the same path
+        key = tuple(row[name] for name in keys)
+        if current is None or key != current:
+            current = key
+            path = []
+            stats = __find_group(histogram, modifiers, row, path)
+            if order is not None:
+                __first_row(order, path, (sequence, row['id']))
+        if stats is None:
+            continue
+
+        stats.add(table, row['timestamp'], row['download_speed'],
+                  row['upload_speed'], row['connect_time'])
+
+        # After spilling, the group must be created again
+        if spiller and spiller.tick(3):
+            current = None
+
+def __child(stats, key, leaf):
+    ''' Return the group @key of @stats, creating it if needed '''
+    if not key in stats:
+        if leaf:
+            stats[key] = histleaf.Stats()
+        else:
+            stats[key] = {}
+    return stats[key]
+
+def __first_row(order, path, stamp):
+    ''' Make @stamp the first row of the groups along @path, if earlier '''
+    for index in range(1, len(path) + 1):
+        prefix = tuple(path[:index])
+        if prefix not in order or stamp < order[prefix]:
+            order[prefix] = stamp
 
-        for modifier in modifiers:
+def __restore_order(histogram, order, depth, path=()):
 
-            if modifier == 'per_instance':
-                instance = row['uuid']
-                if not instance:
-                    skip = True
-                    break
+    '''
+     Sort the groups of @histogram, which are at @depth, by their
+     first row in @order.  Rows are read ordered by group, so this
+     restores the order in which the groups appear in the tables,
+     which is the one of the output before the grouping was pushed
+     down into SQLite.
+    '''
 
-                if not instance in stats:
-                    stats[instance] = {}
+    if not depth:
+        return
+    keys = sorted(histogram, key=lambda key: order[path + (key,)])
+    for key in keys:
+        value = histogram.pop(key)
+        __restore_order(value, order, depth - 1, path + (key,))
+        histogram[key] = value
 
-                stats = stats[instance]
+def __merge_order(order, partial):
+    ''' Merge the first rows in @partial into @order '''
+    for prefix, stamp in partial.items():
+        if prefix not in order or stamp < order[prefix]:
+            order[prefix] = stamp
 
-            elif modifier == 'per_provider':
-                provider = GEOLOC_ASN.org_by_addr(row['real_address'])
-                if not provider:
-                    skip = True
-                    break
+def __find_group(histogram, modifiers, row, path=None):
 
-                # Avoid issues with provider name
-                provider = provider.decode('latin-1')
+    '''
+     Return the group of @histogram where the @row, as returned by
+     the query of __plan_histogram(), belongs, creating it if needed,
+     or None if the row must be skipped.  The groups of the last
+     modifier are histleaf.Stats.  The keys of the groups that are
+     walked are appended to @path, if not None.
+    '''
 
-                if not provider in stats:
-                    stats[provider] = {}
+    stats = histogram
+    for depth, modifier in enumerate(modifiers, 1):
+        leaf = depth == len(modifiers)
 
-                stats = stats[provider]
+        if modifier == 'per_instance':
+            instance = row['per_instance']
 
-            elif modifier == 'per_country':
-                geodata = GEOLOC_CITY.record_by_addr(row['real_address'])
-                if not geodata or not geodata['country_code']:
-                    skip = True
-                    break
+            stats = __child(stats, instance, leaf)
+            if path is not None:
+                path.append(instance)
 
-                # Avoid issues with country code
-                country = geodata['country_code'].decode('latin-1')
+        elif modifier == 'per_provider':
+            provider = GEOLOCATOR.org(row['real_address'])
+            if not provider:
+                return None
 
-                if not country in stats:
-                    stats[country] = {}
+            # Avoid issues with provider name
+            provider = provider.decode('latin-1')
 
-                stats = stats[country]
+            stats = __child(stats, provider, leaf)
+            if path is not None:
+                path.append(provider)
 
-            elif modifier == 'per_city':
-                geodata = GEOLOC_CITY.record_by_addr(row['real_address'])
-                if not geodata or not geodata['city']:
-                    skip = True
-                    break
+        elif modifier == 'per_country':
+            geodata = GEOLOCATOR.record(row['real_address'])
+            if not geodata or not geodata['country_code']:
+                return None
 
-                # Avoid issues with city name
-                city = geodata['city'].decode('latin-1')
+            # Avoid issues with country code
+            country = geodata['country_code'].decode('latin-1')
 
-                if not city in stats:
-                    stats[city] = {}
+            stats = __child(stats, country, leaf)
+            if path is not None:
+                path.append(country)
 
-                stats = stats[city]
+        elif modifier == 'per_city':
+            geodata = GEOLOCATOR.record(row['real_address'])
+            if not geodata or not geodata['city']:
+                return None
 
-            elif modifier == 'per_hour':
+            # Avoid issues with city name
+            city = geodata['city'].decode('latin-1')
 
-                #
-                # FIXME The problem with the hour calculator
-                # below is that it does not take into account
-                # the time zone.  Since we're interested in
-                # Italy at the moment and we're in summer we
-                # optimize for CEST.
-                #
-                hour = (((row['timestamp']/3600) + 2) % 24)
+            stats = __child(stats, city, leaf)
+            if path is not None:
+                path.append(city)
 
-                if not hour in stats:
-                    stats[hour] = {}
+        elif modifier == 'per_hour':
 
-                stats = stats[hour]
+            #
+            # FIXME The problem with the hour calculator
+            # in GROUPING is that it does not take into
+            # account the time zone.  Since we're interested
+            # in Italy at the moment and we're in summer we
+            # optimize for CEST.
+            #
+            hour = row['per_hour']
 
-            else:
-                raise RuntimeError('Invalid modifier: %s' % modifier)
+            stats = __child(stats, hour, leaf)
+            if path is not None:
+                path.append(hour)
 
-        if skip:
-            continue
+    return stats
 
-        #
-        # Save stats
-        #
-        if not stats:
-            stats.update({
-                            'bittorrent':
-                              {
-                                'dload': [],
-                                'upload': [],
-                                'rtt': [],
-                              },
-                            'speedtest':
-                              {
-                                'dload': [],
-                                'upload': [],
-                                'rtt': [],
-                              },
-                            'first_test': 0,
-                            'last_test': 0,
-                          })
-
-        # First and last test info
-        if not stats['first_test']:
-            stats['first_test'] = row['timestamp']
-        if row['timestamp'] > stats['last_test']:
-            stats['last_test'] = row['timestamp']
-
-        stats[table]['dload'].append(row['download_speed'])
-        stats[table]['upload'].append(row['upload_speed'])
-        stats[table]['rtt'].append(row['connect_time'])
+def __count_values(histogram, depth):
+    ''' Return the number of values of @histogram, grouped at @depth '''
+    count = 0
+    for _, stats in histspill.flatten(histogram, depth):
+        if stats:
+            count += stats.size()
+    return count
+
+def __empty_histogram(modifiers):
+    ''' Return an empty histogram, which is one group without modifiers '''
+    if not modifiers:
+        return histleaf.Stats()
+    return {}
+
+def __histogram_init(geocache):
+    ''' Set up the geolocation of a worker process '''
+    GEOLOCATOR.open_cache(geocache)
+
+def __histogram_shard(task):
+
+    '''
+     Build and return the partial histogram of the shard @task, i.e.
+     (path, connection, table, modifiers, shard, sequence), where
+     connection is None, and the database at path is opened here,
+     unless the database is only in memory (see histshard.run()),
+     along with the first rows of its groups (see __build_histogram()).
+    '''
+
+    path, connection, table, modifiers, shard, sequence = task
+    if path:
+        connection = __connect_readonly(path)
+    histogram, order = __empty_histogram(modifiers), {}
+    __build_histogram(connection, table, histogram, modifiers, shard=shard,
+                      order=order, sequence=sequence)
+    if path:
+        connection.close()
+    return histogram, order
+
+USAGE = '''\
+Usage: tool.py -AMHiNPT [-BKfl] [-c cachedir] [-C catalog] [-G geocache]
+               [-j workers] [-m megabytes] [-o output] [-Q depth]
+               [--budget megabytes] [--columnar dir] [--single]
+               [--stats file] [-X modifier] [-z megabytes] input ...'''
 
 def main():
 
@@ -449,11 +714,15 @@ def main():
     syslog.openlog('neubot [tool]', syslog.LOG_PERROR, syslog.LOG_USER)
 
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'AMHiflNo:TX:')
+        options, arguments = getopt.getopt(sys.argv[1:],
+                                           'ABc:C:G:MHiKfj:lm:No:PQ:TX:z:',
+                                           ['budget=', 'columnar=',
+                                            'single', 'stats='])
     except getopt.error:
-        sys.exit('Usage: tool.py -AMHiNT [-fl] [-o output] [-X modifier] input ...')
+        sys.exit(USAGE)
 
     outfile = 'database.sqlite3'
+    flag_output = False
     modifiers = []
 
     flag_histogram = False
@@ -464,6 +733,20 @@ def main():
     flag_force = False
     flag_number = False
     flag_tests = False
+    flag_prepare = False
+    flag_bulk = False
+    flag_dedup = False
+    workers = 0
+    depth = pipeline.DEPTH
+    catalogdb = None
+    memory_limit = 0
+    cache = None
+    cap = dumpcache.CAP * dumps.MEGABYTE
+    statsfile = None
+    geocache = geoloc.CACHE
+    store = None
+    dtype = 'float64'
+    budget = 0
 
     for name, value in options:
 
@@ -479,10 +762,28 @@ def main():
             flag_number = True
         elif name == '-T':
             flag_tests = True
+        elif name == '-P':
+            flag_prepare = True
 
         elif name == '-X':
             modifiers.append(value)
 
+        elif name == '-B':
+            flag_bulk = True
+        elif name == '-c':
+            cache = value
+        elif name == '-C':
+            catalogdb = catalog.connect(value)
+        elif name == '-G':
+            geocache = value
+        elif name == '-K':
+            flag_dedup = True
+        elif name == '-j':
+            workers = int(value)
+        elif name == '-m':
+            memory_limit = int(value) * dumps.MEGABYTE
+        elif name == '-Q':
+            depth = int(value)
         elif name == '-f':
             flag_force = True
         elif name == '-l':
@@ -490,14 +791,35 @@ def main():
 
         elif name == '-o':
             outfile = value
+            flag_output = True
+
+        elif name == '-z':
+            cap = int(value) * dumps.MEGABYTE
+        elif name == '--budget':
+            budget = int(value) * dumps.MEGABYTE
+        elif name == '--columnar':
+            store = value
+        elif name == '--single':
+            dtype = 'float32'
+        elif name == '--stats':
+            statsfile = value
 
     sum_all = flag_anonimize + flag_merge + flag_info + flag_histogram + \
-              flag_number + flag_tests
+              flag_number + flag_tests + flag_prepare
 
     if sum_all > 1:
-        sys.exit('Only one of -AMHiNT may be specified')
+        sys.exit('Only one of -AMHiNPT may be specified')
     if sum_all == 0:
-        sys.exit('Usage: tool.py -AMHiNT [-fl] [-o output] [-X modifier] input ...')
+        sys.exit(USAGE)
+
+    # Geolocation results are kept across runs
+    if flag_anonimize or flag_histogram:
+        GEOLOCATOR.open_cache(geocache)
+        GEOLOCATOR.workers = workers
+
+    # Analysis never migrates in place databases
+    if flag_info or flag_histogram or flag_number or flag_tests:
+        current = __current_version()
 
     #
     # Collate takes a set of (possibly compressed) databases
@@ -506,6 +828,24 @@ def main():
     # against the same set of files.
     # Note that merge will skip old databases unless the
     # force parameter is True.
+    # With -B the rows are copied inside SQLite rather than
+    # one at a time through Python.
+    # With -K the timestamp watermark is replaced by a unique
+    # key on (uuid, timestamp) and INSERT OR IGNORE, so that
+    # older and overlapping databases are merged correctly.
+    # With -j the inputs are decompressed and migrated by a
+    # pool of processes while we write: this implies -K.
+    # With -C the inputs that were already merged into the
+    # output and did not change since are skipped.
+    # With -m compressed inputs that fit the given number of
+    # megabytes are decompressed into memory.
+    # With -c compressed inputs are decompressed (and migrated)
+    # once into the given cache directory, also for -iHNT.
+    # Note that -iHNT open current databases read-only and only
+    # migrate a copy of the out of date ones.
+    # With --stats a JSON report of the time spent, the bytes
+    # and the rows handled per input and per stage is written
+    # into the given file ('-' means stdout).
     #
     if flag_merge:
 
@@ -517,32 +857,98 @@ def main():
         destination = __connect(outfile)
         __migrate(destination)
 
-        for argument in arguments:
-
-            # Decompress if needed
-            if argument.endswith('.bz2'):
-                syslog.syslog(syslog.LOG_INFO, 'decompress %s' % argument)
-                argument = __decompress(argument)
-
-            # Query configuration
-            source = __connect(argument)
-            info = __info(source)
-            version = decimal.Decimal(info['version'])
-
-            # Skip old databases
-            if version <= decimal.Decimal('2.0') and not flag_force:
-                syslog.syslog(syslog.LOG_WARNING, 'skipping old %s' % argument)
-                continue
-
-            # Migrate
-            syslog.syslog(syslog.LOG_INFO, 'migrate %s' % argument)
-            __migrate(source)
-
-            # Save
+        if flag_dedup or workers:
             for table in ('speedtest', 'bittorrent'):
-                syslog.syslog(syslog.LOG_INFO, 'merging table %s' % table)
-                limit = __lookup_last(destination, table)
-                __copyto_after(source, destination, table, limit)
+                copytable.ensure_key(destination, table)
+
+        # The output is identified by the id in its config table
+        digests, changed, identity = {}, [], None
+        if catalogdb:
+            identity = catalog.destination_id(catalogdb, destination)
+        for argument in arguments:
+            if catalogdb:
+                digests[argument] = catalog.fingerprint(catalogdb, argument)
+                if catalog.is_merged(catalogdb, digests[argument], identity):
+                    syslog.syslog(syslog.LOG_INFO, 'unchanged %s' % argument)
+                    continue
+            changed.append(argument)
+        arguments = changed
+
+        def record(argument, source, version):
+            ''' Record the just merged input into the catalog '''
+            if catalogdb:
+                catalog.record(catalogdb, argument, digests[argument], source,
+                               version)
+                catalog.mark_merged(catalogdb, digests[argument], identity)
+
+        def done(argument, ready, version):
+            ''' Record the input the pipeline just merged '''
+            if catalogdb:
+                connection = pipeline.connect(ready)
+                record(argument, connection, version)
+                connection.close()
+
+        total_count, total_elapsed = 0, 0.0
+        reports = [] if statsfile else None
+        if workers:
+            ticks = time.time()
+            total_count = pipeline.merge(arguments, destination,
+              functools.partial(__open_source, flag_force, memory_limit,
+                                cache, cap),
+              workers, depth, done, reports)
+            total_elapsed = time.time() - ticks
+
+        else:
+            for argument in arguments:
+
+                stats = mergestats.new(argument) if statsfile else None
+                origin = {}
+                source = __open_source(flag_force, memory_limit, cache, cap,
+                                       argument, stats, origin)
+                if source is None:
+                    continue
+
+                # Save
+                for table in ('speedtest', 'bittorrent'):
+                    syslog.syslog(syslog.LOG_INFO, 'merging table %s'
+                                  % table)
+                    limit = None
+                    if not flag_dedup:
+                        limit = __lookup_last(destination, table)
+                    ticks = time.time()
+                    if flag_bulk:
+                        count = copytable.copy_table(source, destination,
+                                                     table, limit,
+                                                     ignore=flag_dedup,
+                                                     stats=stats)
+                    elif flag_dedup:
+                        count = copytable.copy_batched(source, destination,
+                                                       table, None,
+                                                       ignore=True,
+                                                       stats=stats)
+                    else:
+                        count = __copyto_after(source, destination, table,
+                                               limit, stats)
+                    elapsed = time.time() - ticks
+                    syslog.syslog(syslog.LOG_INFO, 'merged %d rows in %.3f '
+                      's (%.1f rows/s)' % (count, elapsed,
+                      copytable.rate(count, elapsed)))
+                    total_count += count
+                    total_elapsed += elapsed
+
+                record(argument, source, origin.get('version'))
+                if stats is not None:
+                    reports.append(stats)
+
+        # So that bulk and per-row runs can be compared
+        syslog.syslog(syslog.LOG_INFO, 'merged %d rows in %.3f s (%.1f '
+          'rows/s, %s mode)' % (total_count, total_elapsed,
+          copytable.rate(total_count, total_elapsed),
+          'pipelined' if workers else 'bulk' if flag_bulk else
+          'batched' if flag_dedup else 'per-row'))
+
+        if statsfile:
+            mergestats.dump(reports, statsfile)
 
     #
     # Print information on the database so that one can get
@@ -551,20 +957,20 @@ def main():
     elif flag_info:
 
         for argument in arguments:
-            target = __connect(argument)
-            __migrate(target)
+            target = __open_target(argument, current, cache, cap,
+                                   memory_limit)
 
             dictionary = __info(target)
             dictionary['filename'] = argument
             for table in ('speedtest', 'bittorrent'):
+                counters = summary.table_summary(target, table)
                 dictionary[table] = {}
-                dictionary[table]['count_uuids'] = __lookup_count_uuids(target,
-                                                                        table)
-                dictionary[table]['count'] = __lookup_count(target, table)
-                dictionary[table]['can_publish'] = __lookup_can_publish(target,
-                                                                    table)
-                first = __lookup_first(target, table)
-                last = __lookup_last(target, table)
+                dictionary[table]['count_uuids'] = counters['uuids']
+                dictionary[table]['count'] = counters['timestamped']
+                dictionary[table]['can_publish'] = \
+                  counters['publishable_timestamped']
+                first = counters['first']
+                last = counters['last']
 
                 if flag_pretty:
                     first = __format_date(first)
@@ -588,11 +994,29 @@ def main():
     #
     elif flag_anonimize:
 
-        for argument in arguments:
-            target = __connect(argument)
-            __migrate(target)
-            __anonimize(target, 'speedtest')
-            __anonimize(target, 'bittorrent')
+        #
+        # With -o the (single) input is not modified and its
+        # anonimized copy is written once into the output, rather
+        # than being updated and then rebuilt with VACUUM.
+        # With -j the addresses are geolocated by a pool of
+        # processes.
+        #
+        if flag_output:
+            if len(arguments) != 1:
+                sys.exit(USAGE)
+            target = __open_target(arguments[0], __current_version(),
+                                   cache, cap, memory_limit)
+            __anonimize_into(target, outfile)
+
+        else:
+            for argument in arguments:
+                target = __connect(argument)
+                __migrate(target)
+                __anonimize(target, 'speedtest')
+                __anonimize(target, 'bittorrent')
+
+        GEOLOCATOR.close()
+        GEOLOCATOR.report()
 
     #
     # Walk the database and collect statistics where the
@@ -600,21 +1024,99 @@ def main():
     #
     elif flag_histogram:
 
-        histogram = {}
-        for argument in arguments:
-            target = __connect(argument)
-            __migrate(target)
-            for table in ('speedtest', 'bittorrent'):
-                __build_histogram(target, table, histogram, modifiers)
+        #
+        # With --budget the histogram is spilled to disk each time
+        # it grows beyond the budget, and the groups are merged
+        # back and written one at a time (see histspill.py).
+        #
+        histogram = __empty_histogram(modifiers)
+        spiller = None
+        if budget:
+            spiller = histspill.Spiller(histogram, len(modifiers), budget,
+                                        histleaf.merge,
+                                        value=histleaf.VALUE)
+
+        # Spilled groups are written in key order, the others in table one
+        order = None if spiller else {}
+
+        #
+        # With -j each table is split into shards that a pool of
+        # processes turns into partial histograms, which are then
+        # merged in order (see histshard.py).  The addresses are
+        # geolocated here first, so workers find them in the cache.
+        #
+        if workers > 1:
+            targets, tasks, sequence = [], [], 0
+            for argument in arguments:
+                target = __open_target(argument, current, cache, cap,
+                                       memory_limit)
+                # Keep the databases that are only in memory alive
+                targets.append(target)
+                path = copytable.database_path(target)
+                for table in ('speedtest', 'bittorrent'):
+                    if set(modifiers) & set(GEOGRAPHIC):
+                        GEOLOCATOR.resolve(target, table)
+                    for shard in __plan_shards(target, table, modifiers,
+                                               workers):
+                        tasks.append((path, None if path else target,
+                                      table, modifiers, shard, sequence))
+                    sequence += 1
+            GEOLOCATOR.close()
+            for partial, first in histshard.run(__histogram_shard, tasks,
+                                                workers, __histogram_init,
+                                                (geocache,)):
+                histshard.merge(histogram, partial, len(modifiers),
+                                histleaf.merge)
+                if order is not None:
+                    __merge_order(order, first)
+                if spiller:
+                    spiller.tick(__count_values(partial, len(modifiers)))
+
+        else:
+            sequence = 0
+            for argument in arguments:
+                target = __open_target(argument, current, cache, cap,
+                                       memory_limit)
+                for table in ('speedtest', 'bittorrent'):
+                    __build_histogram(target, table, histogram, modifiers,
+                                      spiller, order=order,
+                                      sequence=sequence)
+                    sequence += 1
+
+        if order is not None:
+            __restore_order(histogram, order, len(modifiers))
+
+        GEOLOCATOR.close()
+        GEOLOCATOR.report()
+
+        #
+        # With --columnar the lists are written as typed arrays
+        # that readers can memory-map (see histstore.py), and
+        # with --single they are float32.
+        #
+        if spiller:
+            if store:
+                histspill.write_store(spiller.items(), store, dtype)
+            else:
+                histspill.dump_json(spiller.items(), sys.stdout,
+                                    flag_pretty, histleaf.to_json)
+                if flag_pretty:
+                    sys.stdout.write("\n")
+            spiller.close()
+
+        elif store:
+            histstore.write(histogram, store, dtype)
 
-        sort_keys, indent = False, None
-        if flag_pretty:
-            sort_keys, indent = True, 4
+        else:
+            sort_keys, indent = False, None
+            if flag_pretty:
+                sort_keys, indent = True, 4
 
-        json.dump(histogram, sys.stdout, indent=indent, sort_keys=sort_keys)
+            json.dump(histogram, sys.stdout, indent=indent,
+                      sort_keys=sort_keys, default=histleaf.to_json)
 
-        if flag_pretty:
-            sys.stdout.write("\n")
+            if flag_pretty:
+                sys.stdout.write("\n")
 
     #
     # Compute the cumulated number of active agents at a
@@ -625,11 +1127,12 @@ def main():
         number_of_agents = collections.defaultdict(set)
 
         for argument in arguments:
-            target = __connect(argument)
-            __migrate(target)
+            target = __open_target(argument, current, cache, cap,
+                                   memory_limit)
             for table in ('speedtest', 'bittorrent'):
                 cursor = target.cursor()
-                cursor.execute('SELECT * FROM %s;' % __sanitize(table))
+                cursor.execute('SELECT timestamp, uuid FROM %s;'
+                               % __sanitize(table))
                 for row in cursor:
                     when = int(dates.epoch2num(row['timestamp']))
                     number_of_agents[when].add(row['uuid'])
@@ -649,11 +1152,12 @@ def main():
         helper = collections.defaultdict(int)
 
         for argument in arguments:
-            target = __connect(argument)
-            __migrate(target)
+            target = __open_target(argument, current, cache, cap,
+                                   memory_limit)
             for table in ('speedtest', 'bittorrent'):
                 cursor = target.cursor()
-                cursor.execute('SELECT * FROM %s;' % __sanitize(table))
+                cursor.execute('SELECT timestamp, uuid FROM %s;'
+                               % __sanitize(table))
                 for row in cursor:
                     when = int(dates.epoch2num(row['timestamp']))
                     helper[when] += 1
@@ -665,5 +1169,22 @@ def main():
         pyplot.plot_date(xdata, ydata)
         pyplot.show()
 
+    #
+    # Create the indexes used by the analysis and refresh
+    # the statistics of the query planner, so that -iHNT
+    # and the scripts in neubot/dataset run faster.  With
+    # -c the cached copies of compressed inputs are prepared.
+    #
+    elif flag_prepare:
+
+        for argument in arguments:
+            path = __cached(cache, cap, argument)
+            if path.endswith('.bz2'):
+                raise RuntimeError('Cannot prepare compressed database')
+            syslog.syslog(syslog.LOG_INFO, 'prepare %s' % path)
+            target = __connect(path)
+            prepare.report(argument, prepare.prepare(target))
+            target.close()
+
 if __name__ == '__main__':
     main()